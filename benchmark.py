@@ -0,0 +1,259 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the PolicyTool pipeline with synthetic policies of growing size
+
+The policies and the account databases are generated in a temporary
+directory. The accounts are modified natively in the generated databases,
+the PAM configuration files are edited in a temporary PAM directory and
+the system commands (setquota) are answered by a fake executor, so the
+benchmark runs anywhere without privileges. Each size runs in a separate
+process, so that the peak memory use is measured separately.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import traceback
+from optparse import OptionParser
+import yaml
+import syspolicy.change
+import syspolicy.config
+from syspolicy.executor import Command
+from syspolicy.policytool import PolicyTool
+
+class FakeExecutor:
+    """
+    Executor that completes every command successfully without running it.
+    """
+    
+    def __init__(self):
+        self.commands = {}
+    
+    def submit(self, argv, input=None, timeout=None):
+        command = Command(argv, input, timeout)
+        self.commands[command.binary] = self.commands.get(command.binary, 0) + 1
+        command.returncode = 0
+        command.stdout = ''
+        command.stderr = ''
+        command.done.set()
+        return command
+    
+    def call(self, argv, input=None, timeout=None):
+        return self.submit(argv, input, timeout).wait()
+    
+    def call_many(self, commands, timeout=None):
+        return [self.call(argv, input, timeout) for (argv, input) in commands]
+
+def write_lines(filename, lines):
+    f = file(filename, 'w')
+    f.writelines(lines)
+    f.close()
+
+def write_yaml(filename, data):
+    f = file(filename, 'w')
+    yaml.dump(data, f, Dumper=syspolicy.config.Dumper, default_flow_style=False)
+    f.close()
+
+def generate(basedir, users, group_size, opts):
+    """
+    Generate the account databases, the policies, the PAM configuration and
+    the main configuration for `users` users in groups of `group_size`.
+    
+    @return: Path of the main configuration file
+    """
+    groups = max(users // group_size, 1)
+    root = os.path.join(basedir, 'root')
+    pamdir = os.path.join(basedir, 'pam.d')
+    for d in [os.path.join(root, 'etc'), pamdir, os.path.join(basedir, 'state')]:
+        os.makedirs(d)
+    
+    # the users have the shell /bin/bash, which the policy changes
+    write_lines(os.path.join(root, 'etc', 'passwd'),
+                ['root:x:0:0:root:/root:/bin/bash\n'] +
+                ['user%d:x:%d:%d::/home/user%d:/bin/bash\n' % (i, 10000 + i, 10000 + i % groups, i)
+                 for i in range(users)])
+    write_lines(os.path.join(root, 'etc', 'shadow'),
+                ['root:*:15000:0:99999:7:::\n'] +
+                ['user%d:!:15000:0:99999:7:::\n' % i for i in range(users)])
+    write_lines(os.path.join(root, 'etc', 'group'),
+                ['root:x:0:\n'] + ['group%d:x:%d:\n' % (g, 10000 + g) for g in range(groups)])
+    write_lines(os.path.join(root, 'etc', 'gshadow'),
+                ['root:*::\n'] + ['group%d:!::\n' % g for g in range(groups)])
+    
+    policy = {'_default_': {'basedir': '/home', 'shell': '/bin/bash', 'create_homedir': False,
+                            'expire': -1, 'inactive': -1, 'uid_min': 1000, 'uid_max': 60000,
+                            'userquota': {}, 'groupquota': {}}}
+    for g in range(groups):
+        policy['group%d' % g] = {'shell': '/bin/sh',
+                                 'userquota': {'/srv': '1G', '/home': ['100M', '200M']},
+                                 'groupquota': {'/srv': '5G'}}
+    write_yaml(os.path.join(basedir, 'groups.conf'), policy)
+    
+    # the inline PAM rules can only allow a single group
+    allowed = ['group%d' % g for g in range(groups)]
+    if opts.list_mode == 'inline':
+        allowed = allowed[:1]
+    write_yaml(os.path.join(basedir, 'services.conf'), {
+        '_default_': {'groups_allow': [], 'groups_deny': [], 'users_allow': [], 'users_deny': []},
+        'sshd': {'groups_allow': allowed,
+                 'users_deny': ['user%d' % i for i in range(0, users, 100)]},
+        'system-auth': {'password': {'retry': 3, 'minlen': 11, 'minclass': 3, 'difok': 3}},
+    })
+    for service in ['sshd', 'system-auth']:
+        write_lines(os.path.join(pamdir, service),
+                    ['auth required pam_unix.so\n', 'account required pam_unix.so\n',
+                     'password required pam_unix.so\n'])
+    
+    conf = {
+        'general': {'policy-path': basedir, 'state-path': os.path.join(basedir, 'state'),
+                    'worker-batch': opts.batch, 'worker-threads': opts.threads,
+                    'planning-workers': opts.planning},
+        'policy': {'groups': 'groups.conf', 'services': 'services.conf'},
+        'module-pam': {'pam-dir': pamdir, 'password': 'system-auth', 'list-mode': opts.list_mode},
+        'module-shadow': {'backend': 'files', 'root': root, 'executor': 'native'},
+    }
+    configfile = os.path.join(basedir, 'main.conf')
+    write_yaml(configfile, conf)
+    return configfile
+
+def run(configfile):
+    """
+    Run the pipeline once and measure each stage.
+    
+    @return: Dictionary of the results
+    """
+    stages = []
+    def measure(name, start):
+        stages.append({'stage': name, 'seconds': time.time() - start,
+                       'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+    
+    start = time.time()
+    pt = PolicyTool(configfile)
+    pt.executor.stop()
+    pt.executor = FakeExecutor()
+    measure('load', start)
+    
+    start = time.time()
+    records = 0
+    for type in pt.policy:
+        for record in pt.policy[type].iter_diff(pt.state[type], pt.list_diff_mode(), depth=2):
+            records += 1
+    measure('diff', start)
+    
+    start = time.time()
+    changesets = pt.get_policy_updates()
+    measure('plan', start)
+    
+    start = time.time()
+    for cs in changesets:
+        pt.accept_changeset(cs)
+    pt.enqueue_changesets(pt.changesets_with_state(syspolicy.change.STATE_ACCEPTED))
+    pt.worker.queue.join()
+    measure('execute', start)
+    
+    start = time.time()
+    pt.save_state()
+    measure('save', start)
+    
+    # only planning and execution handle the Changes
+    changes = sum([len(cs.changes) for cs in changesets])
+    for s in stages:
+        if s['stage'] in ('plan', 'execute'):
+            s['changes_per_second'] = s['seconds'] and changes / s['seconds']
+    failed = len([cs for cs in changesets if cs.state != syspolicy.change.STATE_COMPLETED])
+    return {'diff_records': records, 'changesets': len(changesets), 'changes': changes,
+            'failed_changesets': failed, 'commands': pt.executor.commands,
+            'seconds': sum([s['seconds'] for s in stages]), 'stages': stages}
+
+def run_size(users, opts):
+    """
+    Generate the fixtures for `users` users and run the pipeline in a child
+    process.
+    
+    @return: Dictionary of the results
+    """
+    basedir = tempfile.mkdtemp(prefix='syspolicy-bench-')
+    (r, w) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            try:
+                os.close(r)
+                result = {'users': users, 'group_size': opts.group_size}
+                result.update(run(generate(basedir, users, opts.group_size, opts)))
+                f = os.fdopen(w, 'w')
+                json.dump(result, f)
+                f.close()
+            except:
+                traceback.print_exc()
+                status = 1
+        finally:
+            os._exit(status)
+    
+    os.close(w)
+    data = []
+    while True:
+        chunk = os.read(r, 65536)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(r)
+    (pid, status) = os.waitpid(pid, 0)
+    if opts.keep:
+        print >>sys.stderr, "fixtures kept in", basedir
+    else:
+        shutil.rmtree(basedir)
+    if status != 0:
+        raise Exception("The benchmark of %d users failed" % users)
+    return json.loads(''.join(data))
+
+parser = OptionParser(usage="%prog [options] [USERS...]")
+parser.add_option("--group-size", dest="group_size", type="int", default=100,
+                  help="number of users in each group (default: 100)")
+parser.add_option("--batch", dest="batch", type="int", default=64,
+                  help="general: worker-batch (default: 64)")
+parser.add_option("--threads", dest="threads", type="int", default=4,
+                  help="general: worker-threads (default: 4)")
+parser.add_option("--planning", dest="planning", type="int", default=1,
+                  help="general: planning-workers (default: 1)")
+parser.add_option("--list-mode", dest="list_mode", default='listfile',
+                  help="module-pam: list-mode (default: listfile)")
+parser.add_option("--json", dest="json", metavar="FILE",
+                  help="write the results as JSON to FILE (- for the standard output)")
+parser.add_option("--keep", dest="keep", action="store_true", default=False,
+                  help="keep the generated fixtures")
+(opts, args) = parser.parse_args()
+sizes = [int(a) for a in args] or [1000, 10000]
+
+results = []
+for users in sizes:
+    result = run_size(users, opts)
+    results.append(result)
+    if opts.json == '-':
+        continue
+    print "%d users, %d ChangeSets, %d Changes (%d failed ChangeSets), commands: %s" % (
+        users, result['changesets'], result['changes'], result['failed_changesets'],
+        ', '.join(['%s %d' % c for c in sorted(result['commands'].items())]) or 'none')
+    print '-' * 60
+    for s in result['stages']:
+        if 'changes_per_second' in s:
+            throughput = "%10.0f Changes/s" % s['changes_per_second']
+        else:
+            throughput = ' ' * 20
+        print "%-8s %8.3fs %s %8d kB peak RSS" % (s['stage'], s['seconds'], throughput, s['maxrss_kb'])
+    print "%-8s %8.3fs" % ('total', result['seconds'])
+    print
+
+if opts.json == '-':
+    print json.dumps(results, indent=2, sort_keys=True)
+elif opts.json:
+    f = file(opts.json, 'w')
+    json.dump(results, f, indent=2, sort_keys=True)
+    f.close()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Test of the files backend against the fixture account databases in
+testdata/accounts and testdata/broken
+"""
+
+import os.path
+from syspolicy.modules.filesdb import FilesDatabase, FilesIndex
+from syspolicy.modules import shadow
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata', 'accounts')
+BROKEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata', 'broken')
+
+# the offset index skips the comments, empty lines and NIS compat entries
+passwd = FilesDatabase(os.path.join(ROOT, 'etc', 'passwd'), 2)
+assert len(passwd) == 7, len(passwd)
+assert [f[0] for f in passwd.records()] == ['root', 'alice', 'bob', 'carol', 'alice', 'dave', 'eve']
+for record in xrange(len(passwd)):
+    assert passwd.data[passwd.offsets[record]:].startswith(passwd.fields(record)[0] + ':')
+assert passwd.offsets[-1] == len(passwd.data)
+
+# the first record wins for duplicate names and ids, like in NSS
+assert passwd.by_name('alice')[2] == '1000'
+assert passwd.by_id(1001)[0] == 'bob'
+assert passwd.by_name('nisuser') is None and passwd.by_name('+nisuser') is None
+# the last record has no line end
+assert passwd.by_name('eve') == ['eve', 'x', '1004', '100', 'Eve', '/home/eve', '/bin/zsh']
+
+# a missing database has no records
+assert len(FilesDatabase(os.path.join(ROOT, 'etc', 'missing'))) == 0
+
+index = FilesIndex(ROOT, fallback=False)
+assert index.user_by_name('carol').pw_uid == 1002
+assert index.user_by_uid(1000).pw_name == 'alice'
+assert index.group_by_name('admins').gr_mem == ['alice', 'bob']
+assert index.group_by_gid(1002).gr_name == 'carol'
+assert index.group_members('users') == ['carol', 'dave']
+assert [u.pw_name for u in index.users()] == ['root', 'alice', 'bob', 'carol', 'alice', 'dave', 'eve']
+assert [g.gr_name for g in index.groups()] == ['root', 'users', 'carol', 'admins']
+
+# the shadow database and the primary groups are decoded when first needed
+assert index.shadow is None and index.primary_members is None
+sp = index.shadow_by_name('alice')
+assert (sp.sp_lstchg, sp.sp_min, sp.sp_max, sp.sp_inact, sp.sp_expire) == (15100, 1, 90, 30, -1)
+assert [u.pw_name for u in index.users_with_gid(100)] == ['alice', 'bob', 'alice', 'dave', 'eve']
+assert index.primary_members is not None
+
+# without the fallback the missing accounts aren't found
+for lookup, key in ((index.user_by_name, 'daemon'), (index.user_by_uid, 1),
+                    (index.group_by_name, 'daemon'), (index.group_by_gid, 1),
+                    (index.shadow_by_name, 'daemon')):
+    try:
+        lookup(key)
+        assert False, "%s(%r) didn't fail" % (lookup.__name__, key)
+    except KeyError:
+        pass
+assert index.group_members('daemon') == []
+
+# with the fallback they are looked up through NSS
+index = FilesIndex(ROOT, fallback=True)
+assert index.user_by_name('daemon').pw_uid == 1
+assert index.group_by_gid(1).gr_name == 'daemon'
+assert index.user_by_name('carol').pw_uid == 1002
+
+# the malformed records are indexed by the name, but fail to decode
+index = FilesIndex(BROKEN, fallback=False)
+assert len(index.passwd) == 2
+assert index.user_by_name('good').pw_uid == 2000
+try:
+    index.user_by_name('badid')
+    assert False, "the malformed record was decoded"
+except ValueError:
+    pass
+try:
+    index.user_by_name('short')
+    assert False, "the short record was indexed"
+except KeyError:
+    pass
+
+# the shadow module looks the accounts up from the files under the root
+shadow.set_backend(ROOT, nss_fallback=False)
+try:
+    assert shadow.user_exists('bob') and not shadow.user_exists('daemon')
+    assert shadow.get_group_by_name('users').gr_gid == 100
+    assert [u.pw_name for u in shadow.list_users_with_gid(1002)] == ['carol']
+finally:
+    shadow.set_backend(None)
+
+print "ok"
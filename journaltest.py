@@ -0,0 +1,146 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Test of recovering the policy states from a damaged state journal
+
+A journal that ends in the middle of a record or has a record with a wrong
+checksum is replayed up to the last intact record. The damaged tail is
+discarded, so that the new records follow the intact ones, and the
+recovered states are saved in full by compact_state.
+"""
+
+import os
+import shutil
+import tempfile
+import yaml
+from syspolicy.journal import Journal, HEADER
+from syspolicy.policytool import PolicyTool
+
+def write_yaml(filename, data):
+    f = file(filename, 'w')
+    yaml.dump(data, f, default_flow_style=False)
+    f.close()
+
+def read_file(filename):
+    f = file(filename, 'rb')
+    data = f.read()
+    f.close()
+    return data
+
+def write_file(filename, data):
+    f = file(filename, 'wb')
+    f.write(data)
+    f.close()
+
+def record_ends(filename):
+    """
+    Return the offsets of the record ends in a journal file.
+    """
+    data = read_file(filename)
+    ends = []
+    offset = 0
+    while offset < len(data):
+        offset += HEADER.size + HEADER.unpack_from(data, offset)[0]
+        ends.append(offset)
+    return ends
+
+def write_journal(filename, count):
+    """
+    Write a new journal of `count` state updates and return the offsets of
+    the record ends.
+    """
+    if os.path.exists(filename):
+        os.unlink(filename)
+    journal = Journal(filename, commit_size=2)
+    for i in range(count):
+        journal.append('groups', ['group%d' % i, 'note'], 'note %d' % i, 'added')
+    journal.close()
+    ends = record_ends(filename)
+    assert len(ends) == count and ends[-1] == os.path.getsize(filename)
+    return ends
+
+def replayed(journal):
+    return [path[0] for (policy, path, value, diff_type) in journal.replay()]
+
+basedir = tempfile.mkdtemp(prefix='syspolicy-journaltest-')
+try:
+    filename = os.path.join(basedir, 'state.journal')
+    
+    # an intact journal is replayed in full
+    ends = write_journal(filename, 5)
+    journal = Journal(filename)
+    assert journal.replay() == [('groups', ['group%d' % i, 'note'], 'note %d' % i, 'added')
+                                for i in range(5)]
+    assert journal.records == 5
+    
+    # a record that was cut off in the middle, or even in its header, is
+    # discarded with everything after it
+    for (cut, intact) in ((ends[4] - 3, 4), (ends[2] + HEADER.size - 1, 3),
+                          (ends[2] + 1, 3), (HEADER.size + 1, 0)):
+        write_journal(filename, 5)
+        write_file(filename, read_file(filename)[:cut])
+        journal = Journal(filename)
+        assert replayed(journal) == ['group%d' % i for i in range(intact)]
+        assert os.path.getsize(filename) == ([0] + ends)[intact]
+    
+    # a record with a wrong checksum ends the replay, the new records are
+    # appended after the last intact one
+    ends = write_journal(filename, 5)
+    data = read_file(filename)
+    corrupt = ends[1] + HEADER.size + 2
+    write_file(filename, data[:corrupt] + chr(ord(data[corrupt]) ^ 0xff) + data[corrupt + 1:])
+    journal = Journal(filename)
+    assert replayed(journal) == ['group0', 'group1']
+    assert journal.records == 2 and os.path.getsize(filename) == ends[1]
+    journal.append('groups', ['group9', 'note'], 'note 9')
+    journal.close()
+    assert replayed(Journal(filename)) == ['group0', 'group1', 'group9']
+    
+    # a missing journal has nothing to replay
+    os.unlink(filename)
+    assert Journal(filename).replay() == []
+    
+    # the PolicyTool recovers the intact updates after a crash and saves them
+    os.makedirs(os.path.join(basedir, 'state'))
+    write_yaml(os.path.join(basedir, 'groups.conf'), {})
+    configfile = os.path.join(basedir, 'main.conf')
+    write_yaml(configfile, {
+        'general': {'policy-path': basedir, 'state-path': os.path.join(basedir, 'state'),
+                    'state-journal': True, 'journal-commit': 1000},
+        'policy': {'groups': 'groups.conf'},
+    })
+    statefile = os.path.join(basedir, 'state', 'groups.conf')
+    filename = os.path.join(basedir, 'state', 'state.journal')
+    
+    pt = PolicyTool(configfile)
+    for i in range(4):
+        pt.set_state('groups', ['group%d' % i, 'note'], 'note %d' % i)
+    pt.set_state('groups', ['group1', 'note'], None)
+    pt.commit_state()
+    ends = record_ends(filename)
+    assert len(ends) == 5
+    # the last update (removing group1's note) was only partially written
+    # when the process was killed, and the states weren't saved
+    write_file(filename, read_file(filename)[:ends[3] + 5])
+    assert yaml.safe_load(file(statefile)) in (None, {})
+    
+    pt = PolicyTool(configfile)
+    state = pt.state['groups']
+    assert [state.get(['group%d' % i, 'note']) for i in range(4)] == ['note %d' % i for i in range(4)]
+    # the recovered states have been saved, and the journal was emptied
+    assert os.path.getsize(filename) == 0
+    saved = yaml.safe_load(file(statefile))
+    assert sorted(saved.keys()) == ['group0', 'group1', 'group2', 'group3']
+    assert saved['group1'] == {'note': 'note 1'}
+    
+    # the updates after the recovery are journaled and recovered as usual
+    pt.set_state('groups', ['group4', 'note'], 'note 4')
+    pt.commit_state()
+    pt = PolicyTool(configfile)
+    assert pt.state['groups'].get(['group4', 'note']) == 'note 4'
+    assert pt.state['groups'].get(['group1', 'note']) == 'note 1'
+    assert os.path.getsize(filename) == 0
+    print "ok"
+finally:
+    shutil.rmtree(basedir)
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Test of planning the policy updates while the Worker implements them
+
+The state updates of the ChangeSets that are implemented during the
+planning must not reach the state trees that are being diffed. They are
+applied when the planning ends, and a second planning pass finds nothing
+to do.
+"""
+
+import os
+import shutil
+import tempfile
+import yaml
+import syspolicy.change
+from syspolicy.policytool import PolicyTool
+
+GROUPS = 2000
+
+def write_yaml(filename, data):
+    f = file(filename, 'w')
+    yaml.dump(data, f, default_flow_style=False)
+    f.close()
+
+basedir = tempfile.mkdtemp(prefix='syspolicy-plantest-')
+try:
+    os.makedirs(os.path.join(basedir, 'state'))
+    # the attribute has no handler, so it is only recorded in the state
+    write_yaml(os.path.join(basedir, 'groups.conf'),
+               dict([('group%d' % g, {'note': 'note %d' % g}) for g in range(GROUPS)]))
+    configfile = os.path.join(basedir, 'main.conf')
+    write_yaml(configfile, {
+        'general': {'policy-path': basedir, 'state-path': os.path.join(basedir, 'state'),
+                    'queue-size': 4, 'worker-threads': 2, 'planning-workers': 2},
+        'policy': {'groups': 'groups.conf'},
+    })
+    
+    pt = PolicyTool(configfile)
+    state = pt.state['groups']
+    
+    # watch the state tree and the Worker while the groups are planned
+    seen = {'sections': set(), 'completed': 0}
+    check_group = pt.check_group
+    def watch(task):
+        seen['sections'].add(len(state.data))
+        seen['completed'] = max(seen['completed'], pt.worker.metrics.counters.get(
+            ('syspolicy_changesets_total', (('state', 'completed'),)), 0))
+        return check_group(task)
+    pt.check_group = watch
+    
+    changesets = pt.get_policy_updates(pt.is_state_change)
+    assert len(changesets) == GROUPS, len(changesets)
+    assert seen['completed'] > 0, "the Worker didn't run during the planning"
+    assert len(seen['sections']) == 1, "the state was modified during the planning"
+    
+    pt.worker.queue.join()
+    pt.save_state()
+    assert [cs for cs in changesets if cs.state != syspolicy.change.STATE_COMPLETED] == []
+    for g in range(GROUPS):
+        assert state.get(['group%d' % g, 'note']) == 'note %d' % g
+    
+    # the states are complete, so there is nothing more to do
+    pt = PolicyTool(configfile)
+    assert pt.get_policy_updates() == []
+    print "ok"
+finally:
+    shutil.rmtree(basedir)
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Test of reading the current quota limits from the captured repquota -p -v
+reports in testdata/repquota, and of skipping the set_quota Changes whose
+limits are already in place
+"""
+
+import os.path
+from syspolicy.modules.quota import Quota, parse_repquota
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata', 'repquota')
+
+def read_report(name):
+    f = file(os.path.join(DATA, name))
+    text = f.read()
+    f.close()
+    return parse_repquota(text)
+
+# the grace times of the objects over their limits are shown as timestamps,
+# the rows of the ids without a name are kept under the #id
+users = read_report('user.txt')
+assert len(users) == 8, len(users)
+assert users.get('root') == (0, 0, 0, 0)
+assert users.get('alice') == (102400, 204800, 2000, 4000)
+assert users.get('bob') == (102400, 204800, 2000, 4000)
+assert users.get('carol') == (102400, 204800, 2000, 4000)
+assert users.get('dave') == (102400, 204800, 2000, 4000)
+assert users.get('#1005') == (51200, 102400, 1000, 2000)
+assert users.get('#1006') == (0, 0, 0, 0)
+# the objects without a quota record have no limits
+assert users.get('frank') == (0, 0, 0, 0)
+# the statistics at the end of the report aren't rows
+assert 'Total' not in users.rows and 'Statistics:' not in users.rows
+
+groups = read_report('group.txt')
+assert sorted(groups.rows.keys()) == ['#2000', 'root', 'staff', 'users']
+assert groups.get('users') == (409600, 819200, 50000, 100000)
+assert groups.get('staff') == (1048576, 2097152, 0, 0)
+
+# the reports without the grace time columns
+table = parse_repquota("""*** Report for user quotas on device /dev/sdb1
+Block grace time: 7days; Inode grace time: 7days
+                        Block limits                File limits
+User            used    soft    hard  grace    used  soft  hard  grace
+----------------------------------------------------------------------
+alice     --   52340  102400  204800            812  2000  4000
+bob       +-  131072  102400  204800  6days    1532  2000  4000
+carol     -+    1024  102400  204800           4120  2000  4000  5days
+""")
+assert [table.get(u) for u in ('alice', 'bob', 'carol')] == [(102400, 204800, 2000, 4000)] * 3
+
+# with the drift check, only the Changes of the differing limits are proposed
+quota = Quota()
+quota.drift_check = True
+quota.tables[('/home', 'user')] = users
+quota.tables[('/home', 'group')] = groups
+proposed = []
+for type, object, limits in (('user', 'alice', ['100M', '200M', '2000', '4000']),
+                             ('user', 'bob', '200M'),
+                             ('user', 'eve', None),
+                             ('user', 'frank', None),
+                             ('user', 'frank', '1G'),
+                             ('group', 'users', ['400M', '800M', '50000', '100000']),
+                             ('group', 'staff', ['1G', '2G'])):
+    proposed.extend([(c.parameters['type'], c.parameters['object'])
+                     for c in quota.c_set_quota({'/home': limits}, type, object)])
+assert proposed == [('user', 'bob'), ('user', 'frank')], proposed
+assert quota.skipped == 5, quota.skipped
+
+# the limits are read again and the count starts over in the next planning pass
+quota.begin_plan()
+assert quota.skipped == 0 and quota.tables == {}
+
+print "ok"
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of spawning commands from a large process with and without the spawn helper
+"""
+
+import sys
+import time
+from syspolicy.executor import Executor
+from syspolicy.spawner import SpawnHelper
+
+commands = 2000
+if len(sys.argv) > 1:
+    commands = int(sys.argv[1])
+groups = 200000
+if len(sys.argv) > 2:
+    groups = int(sys.argv[2])
+rounds = 3
+
+def timed(function, *args):
+    """
+    Run `function` `rounds` times and return the best time in seconds.
+    """
+    best = None
+    for i in range(rounds):
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def spawn(executor):
+    """
+    Run `commands` trivial commands through the executor.
+    """
+    results = executor.call_many([(['/bin/true'], None)] * commands)
+    assert [r[0] for r in results] == [0] * commands
+
+# the helper is forked while the process is still small, like in PolicyTool
+helper = SpawnHelper()
+helper.start()
+
+# grow the process like a large group policy does
+policy = {}
+for i in range(groups):
+    policy['group%d' % i] = {'shell': '/bin/sh', 'uid_min': 10000 + i,
+                             'userquota': {'/home': '1G', '/srv': ['100M', '200M']},
+                             'groupquota': {'/home': '5G'}}
+
+executor = Executor()
+executor.start()
+
+print "%d commands, %d groups in the process" % (commands, groups)
+print '-' * 40
+
+for name, e in (("executor", executor), ("spawn helper", helper)):
+    elapsed = timed(spawn, e)
+    print "%s: %.3fs, %.0f spawns/s" % (name, elapsed, commands / elapsed)
@@ -29,6 +29,9 @@ class OptParser(OptionParser):
         self.set_defaults(config='config/main.conf')
         self.set_defaults(debug=False)
         self.set_defaults(pretend=False)
+        self.set_defaults(pipeline=False)
+        self.set_defaults(trace=None)
+        self.set_defaults(trace_memory=False)
         self.set_defaults(mode_update=False)
         self.set_defaults(mode_deploy=False)
 
@@ -41,6 +44,15 @@ class OptParser(OptionParser):
         self.add_option("-P", "--pretend",
                 dest="pretend", action="store_true", 
                 help="only show proposed changes, don't ask for confirmation")
+        self.add_option("--pipeline",
+                dest="pipeline", action="store_true", 
+                help="implement state changes while checking for updates")
+        self.add_option("--trace",
+                dest="trace", metavar="FILE", 
+                help="write a trace of the run phases to FILE (Chrome trace JSON)")
+        self.add_option("--trace-memory",
+                dest="trace_memory", action="store_true", 
+                help="record the peak memory use in the trace")
         
         mode = OptionGroup(self, "Run mode")      
         mode.add_option("-u", "--update",
@@ -13,6 +13,8 @@ from __future__ import with_statement
 
 import yaml
 import syspolicy.change
+import syspolicy.trace
+from syspolicy.trace import span
 from syspolicy.policytool import PolicyTool
 from syspolicy.cli.prompt import confirm, setpwd
 from syspolicy.cli.arguments import OptParser
@@ -35,18 +37,28 @@ def main():
     if len(o) - o.count(None) - o.count(False) != 1:
         parser.error("You have to specify exactly 1 run mode option")
     
+    # trace the phases of the run to a file (--trace)
+    if opts.trace:
+        syspolicy.trace.start(opts.trace, memory=opts.trace_memory)
+    
     # launch the PolicyTool
-    pt = PolicyTool(opts.config, debug=opts.debug)
+    with span('policytool_init'):
+        pt = PolicyTool(opts.config, debug=opts.debug)
     shadow = pt.module['shadow']
     cs = None
     password = None
 
+    # state changes can be implemented while the updates are being checked
+    accept = None
+    if opts.pipeline and not opts.pretend:
+        accept = pt.is_state_change
+    
     if opts.mode_update:
-        pt.get_policy_updates()
+        pt.get_policy_updates(accept)
         pt.accept_state_changes()
     elif opts.mode_deploy:
         pt.clear_state()
-        pt.get_policy_updates()
+        pt.get_policy_updates(accept)
         pt.accept_state_changes()
     elif opts.add_user is not None:
         if type(opts.group) != list or len(opts.group) < 1:
@@ -106,21 +118,26 @@ def main():
         cs = shadow.cs_del_group(group=opts.del_group)
         pt.add_changeset(cs)
     
+    # report the quota limits that were found to be in place already
+    if (opts.mode_update or opts.mode_deploy) and pt.module['quota'].skipped > 0:
+        print "Skipped %d quota changes, the limits are already set" % pt.module['quota'].skipped
+    
     # list all the ChangeSets and get confirmations
-    with pt.cs_mlock:
-        if len(pt.changesets) > 0:
-            print "------- ChangeSets -------"
-        for cs in pt.changesets:
-            print yaml.dump(cs)
-            if not opts.pretend and cs.state == syspolicy.change.STATE_PROPOSED:
-                pt.accept_changeset(cs, confirm("Approve this ChangeSet?"))
-            print "==> This ChangeSet is", syspolicy.change._state_strings[cs.state]
-            print
+    with span('approval'):
+        with pt.cs_mlock:
+            if len(pt.changesets) > 0:
+                print "------- ChangeSets -------"
+            for cs in pt.changesets:
+                print yaml.dump(cs)
+                if not opts.pretend and cs.state == syspolicy.change.STATE_PROPOSED:
+                    pt.accept_changeset(cs, confirm("Approve this ChangeSet?"))
+                print "==> This ChangeSet is", syspolicy.change._state_strings[cs.state]
+                print
     
     #: list of accepted ChangeSets that need to be implemented
     accepted = pt.changesets_with_state(syspolicy.change.STATE_ACCEPTED)
     
-    if not opts.pretend and len(accepted) > 0:
+    if not opts.pretend and (len(accepted) > 0 or len(pt.enqueued) > 0):
         print "------- %d accepted ChangeSets -------" % len(accepted)
         
         # display a summary of accepted ChangeSets
@@ -133,21 +150,28 @@ def main():
                 print ', '.join(descr)
         
         # get a final confirmation from the user to proceed and enqueue the work
-        if confirm("Enqueue %d ChangeSets?" % len(accepted)):
+        if len(accepted) > 0 and confirm("Enqueue %d ChangeSets?" % len(accepted)):
             pt.enqueue_changesets(accepted)
         
         # wait until the Worker has finished processing and save the state
-        pt.worker.queue.join()
+        with span('worker_wait'):
+            pt.worker.queue.join()
         pt.save_state()
         
-        print "------- %d processed ChangeSets -------" % len(accepted)
+        # the processed ChangeSets include the ones enqueued during planning
+        processed = [cs for cs in pt.changesets if cs in pt.enqueued]
+        
+        print "------- %d processed ChangeSets -------" % len(processed)
         
         # display a summary of the work including status (completed/failed)
-        for cs in accepted:
+        for cs in processed:
             with pt.get_cs_lock(cs):
-                print "* ChangeSet %d:" % (accepted.index(cs) + 1), 
+                print "* ChangeSet %d:" % (processed.index(cs) + 1), 
                 descr = []
                 for c in cs.changes:
                     descr.append(c.subsystem + ":" + c.operation)
                 print ', '.join(descr), "=>", syspolicy.change._state_strings[cs.state]
-
+    
+    # export the metrics of the run (general: metrics-file)
+    pt.write_metrics()
+    syspolicy.trace.finish()
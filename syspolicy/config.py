@@ -9,8 +9,23 @@
 Base configuration class Config and comparison functions
 """
 
+import os
+import os.path
+import stat
 import copy
+import marshal
+import cPickle
+import tempfile
 import yaml
+from hashlib import md5, sha1
+from collections import Mapping, namedtuple
+from syspolicy.trace import span
+
+# use the libyaml bindings when they are available
+try:
+    from yaml import CLoader as Loader, CDumper as Dumper
+except ImportError:
+    from yaml import Loader, Dumper
 
 DEFAULT = "_default_" #: the config section containing the defaults
 
@@ -18,22 +33,41 @@ CONFIG_ADDED = 1
 CONFIG_CHANGED = 2
 CONFIG_REMOVED = 3
 
+DIGEST_MODULUS = 2 ** 128 #: digests of branches are summed modulo this value
+
+LIST_REPLACE = 0 #: changed lists are reported with their new value
+LIST_ELEMENTS = 1 #: changed lists are reported with ListDiffs of their elements
+LIST_ORDERED = 2 #: like LIST_ELEMENTS, but changes in the order are reported too
+
+CACHE_VERSION = 1 #: format version of the YAML load cache files
+CACHE_SUFFIX = '.yamlcache' #: suffix of the YAML load cache files
+
+#: A single difference reported by iter_diff(): the location, type
+#: of the difference (CONFIG_*), new and old values and the difference
+#: as compare_trees() would report it
+DiffRecord = namedtuple('DiffRecord', 'path operation new_value old_value diff')
+
 class Config:
     name = None #: the identifier name for this Config
     data = None #: the data dictionary tree
+    digest = None #: the Digest tree (fingerprints) of the data
     source = None #: the source configuration file
+    cache = False #: whether to use the YAML load cache
     
-    def __init__(self, name, source=None, load=True):
+    def __init__(self, name, source=None, load=True, cache=False):
         """
         Initialize the Config class and load the configuration if `load` is True
         
         @param name: The identifier name for the Config
         @param source: Source file name where to load/save the configuration
         @param load: Whether to load the configuration at start (default: True)
+        @param cache: Whether to use the YAML load cache (default: False)
         """
         self.name = name
         self.data = {}
+        self.digest = fingerprint(self.data)
         self.source = source
+        self.cache = cache
         if load and source:
             self.load()
     
@@ -50,16 +84,32 @@ class Config:
             # that was set in the constructor, if any
             configfile = self.source
         if configfile is not None:
-            # load the data using YAML
-            cf = file(configfile, 'r')
-            self.data = yaml.load(cf)
-            cf.close()
-            # verify that the data is a dictionary
-            if type(self.data) is not dict:
-                self.data = {}
+            with span('config_load', file=configfile):
+                # load the data using YAML
+                self.data = load_yaml(configfile, self.cache)
+                # verify that the data is a dictionary
+                if type(self.data) is not dict:
+                    self.data = {}
+                self.loaded()
             return True
         return False
     
+    def loaded(self):
+        """
+        This function is called each time new data has been loaded into
+        the Config. Subclasses can override it to post-process the data, but
+        they must keep the digest tree up to date by calling rehash().
+        """
+        self.rehash()
+    
+    def rehash(self):
+        """
+        This function recomputes the digest tree for the whole data tree.
+        It only needs to be called after self.data has been modified directly,
+        since set() and clear() keep the digests up to date.
+        """
+        self.digest = fingerprint(self.data)
+    
     def save(self, configfile=None):
         """
         Function that saves the configuration to `configfile` using YAML.
@@ -72,10 +122,28 @@ class Config:
             # that was set in the constructor, if any
             configfile = self.source
         if configfile is not None:
-            # dump the data using YAML
-            cf = file(configfile, 'w')
-            yaml.dump(self.data, cf, default_flow_style=False)
-            cf.close()
+            # dump the data using YAML into a temporary file and replace
+            # the configuration file with it atomically
+            basename = os.path.basename(configfile)
+            basedir = os.path.dirname(configfile) or '.'
+            temp_file = tempfile.NamedTemporaryFile(prefix='.'+basename+'.', suffix='.syspolicy', dir=basedir, delete=False)
+            try:
+                yaml.dump(self.data, temp_file, Dumper=Dumper, default_flow_style=False)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+                temp_file.close()
+                # keep the permissions of the existing file
+                if os.path.exists(configfile):
+                    os.chmod(temp_file.name, stat.S_IMODE(os.stat(configfile).st_mode))
+                else:
+                    umask = os.umask(0)
+                    os.umask(umask)
+                    os.chmod(temp_file.name, 0666 & ~umask)
+                os.rename(temp_file.name, configfile)
+            except:
+                temp_file.close()
+                os.remove(temp_file.name)
+                raise
             return True
         return False
     
@@ -84,7 +152,7 @@ class Config:
         This function dumps the configuration data to the console for
         debugging purposes. The data is formatted using YAML.
         """
-        print yaml.dump(self.data, default_flow_style=False)
+        print yaml.dump(self.data, Dumper=Dumper, default_flow_style=False)
     
     def sections(self):
         """
@@ -99,7 +167,7 @@ class Config:
         @param section: The section which's attributes are to be listed
         @return: The list of attributes in `section`
         """
-        if section in self.data and type(self.data[section]) is dict:
+        if section in self.data and is_branch(self.data[section]):
             return self.data[section].keys()
         else:
             return []
@@ -123,25 +191,11 @@ class Config:
         @param value: The new value for the attribute at `path`
         @return: True if the operation was successful
         """
-        tpath = list(path)
         if type(path) is list:
-            element = tpath.pop()
-            branch = self.data
-            
-            # walk the path until the parent node
-            for node in tpath:
-                if node not in branch or type(branch[node]) is not dict:
-                    branch[node] = {}
-                branch = branch[node]
-            
-            # see if we need to set the value or erase the attribute
-            if value is not None:
-                # set a new value
-                branch[element] = value
-            elif element in branch:
-                # in case value is None, delete the attribute alltogether
-                del branch[element]
+            set_branch(self.data, path, value)
             
+            # update the fingerprints of the branches along the path
+            self.digest = refresh_digest(self.digest, self.data, list(path))
             return True
         return False
     
@@ -150,17 +204,217 @@ class Config:
         This function clears the data of this Config
         """
         self.data.clear()
+        self.rehash()
     
-    def compare_to(self, other_config):
+    def compare_to(self, other_config, lists=LIST_REPLACE):
         """
         This function compares this Config element to another.
         
         @param other_config: An other Config (or it's subclass) element
+        @param lists: How the changed lists are reported (LIST_REPLACE,
+            LIST_ELEMENTS or LIST_ORDERED)
         @return: A dictionary tree of differences
         """
         if isinstance(other_config, Config):
-            return compare_trees(self.data, other_config.data)
+            return compare_trees(self.data, other_config.data,
+                                 self.digest, other_config.digest, lists)
+    
+    def iter_diff(self, other_config, lists=LIST_REPLACE, depth=None):
+        """
+        This function compares this Config element to another and yields
+        the differences one by one while walking the trees.
+        
+        @param other_config: An other Config (or it's subclass) element
+        @param lists: How the changed lists are reported
+        @param depth: The depth at which the differences are reported
+        @return: A generator of DiffRecords (see iter_diff())
+        """
+        return iter_diff(self.data, other_config.data,
+                         self.digest, other_config.digest, lists, depth)
+
+
+class Digest:
+    """
+    This class is a node in the digest tree of a configuration. The digest
+    tree mirrors the dictionary tree, so that each branch carries a content
+    fingerprint of everything beneath it, and the children of the branch
+    are available as Digest nodes as well (Merkle tree).
+    
+    The digest of a branch is the sum of its entries' digests modulo
+    DIGEST_MODULUS, which allows updating a single entry without
+    revisiting its siblings.
+    """
+    __slots__ = ('value', 'children')
+    
+    def __init__(self, value, children=None):
+        self.value = value #: the fingerprint as an integer
+        self.children = children #: dictionary of child Digests or None for leaves
+    
+    def __eq__(self, other):
+        return isinstance(other, Digest) and self.value == other.value
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    
+    def child(self, key):
+        """
+        This function returns the Digest of the child `key` or None.
+        """
+        if self.children is not None:
+            return self.children.get(key, None)
+        return None
+
+
+def load_yaml(filename, cache=False):
+    """
+    This function parses a YAML file and returns the data.
+    
+    If `cache` is True, the parsed data is also stored in a sidecar cache
+    file next to the YAML file, and subsequent loads return the data from
+    there for as long as the path, size, modification time and content hash
+    of the YAML file stay the same.
+    
+    @param filename: The YAML file to be loaded
+    @param cache: Whether to use the load cache
+    @return: The parsed data
+    """
+    cf = file(filename, 'r')
+    try:
+        if not cache:
+            return yaml.load(cf, Loader=Loader)
+        
+        # build the cache key of the file
+        st = os.fstat(cf.fileno())
+        content = cf.read()
+        key = (os.path.abspath(filename), st.st_size, st.st_mtime,
+               sha1(content).hexdigest())
+    finally:
+        cf.close()
+    
+    cachefile = cache_filename(filename)
+    found, data = read_cache(cachefile, key)
+    if not found:
+        # parse the YAML and store the result for the next time
+        data = yaml.load(content, Loader=Loader)
+        write_cache(cachefile, key, data)
+    return data
+
+def cache_filename(filename):
+    """
+    This function returns the name of the load cache file for `filename`.
+    """
+    return os.path.join(os.path.dirname(filename),
+                        '.' + os.path.basename(filename) + CACHE_SUFFIX)
+
+def read_cache(cachefile, key):
+    """
+    This function reads the cached data from `cachefile` if the key
+    stored in the cache matches `key`.
+    
+    @param cachefile: The cache file name
+    @param key: The expected cache key
+    @return: A tuple of (True, data) on a cache hit and (False, None) otherwise
+    """
+    try:
+        cf = file(cachefile, 'rb')
+        try:
+            blob = cf.read()
+        finally:
+            cf.close()
+        if blob[:1] == 'M':
+            (version, cached_key, data) = marshal.loads(blob[1:])
+        elif blob[:1] == 'P':
+            (version, cached_key, data) = cPickle.loads(blob[1:])
+        else:
+            return (False, None)
+    except Exception:
+        # a missing or broken cache file is simply a cache miss
+        return (False, None)
+    
+    if version == CACHE_VERSION and cached_key == key:
+        return (True, data)
+    return (False, None)
+
+def write_cache(cachefile, key, data):
+    """
+    This function atomically writes `data` with its `key` to `cachefile`.
+    The data is serialized with marshal when possible and with pickle
+    when it contains types that marshal does not support.
+    
+    Failures are ignored, since the cache is only an optimization.
+    
+    @param cachefile: The cache file name
+    @param key: The cache key
+    @param data: The parsed data to be cached
+    """
+    record = (CACHE_VERSION, key, data)
+    try:
+        blob = 'M' + marshal.dumps(record)
+    except ValueError:
+        blob = 'P' + cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL)
+    
+    try:
+        temp_file = tempfile.NamedTemporaryFile(prefix=os.path.basename(cachefile) + '.',
+                        dir=os.path.dirname(cachefile) or '.', delete=False)
+        try:
+            temp_file.write(blob)
+            temp_file.close()
+            os.rename(temp_file.name, cachefile)
+        except:
+            temp_file.close()
+            os.remove(temp_file.name)
+            raise
+    except (IOError, OSError):
+        pass
+
+def is_branch(value):
+    """
+    This function checks whether `value` is a branch of a configuration
+    tree, that is a dictionary or a read-only mapping (eg. a PolicyView).
+    
+    @param value: Any value from a configuration tree
+    @return: True if `value` is a branch, False otherwise
+    """
+    return isinstance(value, Mapping)
+
+def plain(value):
+    """
+    This function returns `value` as a plain dictionary tree if it is a
+    read-only mapping, otherwise `value` itself is returned.
+    """
+    if is_branch(value) and type(value) is not dict:
+        return copy.deepcopy(value)
+    return value
 
+def set_branch(tree, path, value):
+    """
+    This function sets the value at `path` in a dictionary tree, creating
+    the missing branches along the way. If `value` is None, the value at
+    `path` is removed instead.
+    
+    Read-only mappings are stored as plain dictionary trees.
+    
+    @param tree: A dictionary tree
+    @param path: A non-empty list of keys to the location of the value
+    @param value: The new value
+    """
+    tpath = list(path)
+    element = tpath.pop()
+    branch = tree
+    
+    # walk the path until the parent node
+    for node in tpath:
+        if node not in branch or type(branch[node]) is not dict:
+            branch[node] = {}
+        branch = branch[node]
+    
+    # see if we need to set the value or erase the attribute
+    if value is not None:
+        # set a new value
+        branch[element] = plain(value)
+    elif element in branch:
+        # in case value is None, delete the attribute alltogether
+        del branch[element]
 
 def walk(tree, path=[]):
     """
@@ -174,14 +428,172 @@ def walk(tree, path=[]):
     if type(path) is list:
         branch = tree
         for node in path:
-            if type(branch) is dict and node in branch:
+            if is_branch(branch) and node in branch:
                 branch = branch[node]
             else:
                 return None
         return branch
     return None
 
-def compare_trees(a, b):
+class ListDiff:
+    """
+    This class describes the difference between two lists element by element.
+    
+    The new list itself is referenced and not copied, so a ListDiff must
+    not be modified.
+    """
+    
+    value = None #: the new list
+    added = None #: elements that are present only in the new list
+    removed = None #: elements that are present only in the old list
+    reordered = False #: whether the common elements were reordered
+    
+    def __init__(self, value, added, removed, reordered=False):
+        self.value = value
+        self.added = added
+        self.removed = removed
+        self.reordered = reordered
+    
+    def __repr__(self):
+        return "ListDiff(added=%r, removed=%r, reordered=%r)" % \
+                            (self.added, self.removed, self.reordered)
+    
+    def apply(self, old):
+        """
+        This function applies the element changes to another version of
+        the old list, keeping the order of the remaining elements.
+        
+        @param old: The old list
+        @return: A new list with the elements removed and added
+        """
+        removed = set(map(_hashable, self.removed))
+        result = [x for x in old if _hashable(x) not in removed]
+        present = set(map(_hashable, result))
+        for x in self.added:
+            if _hashable(x) not in present:
+                result.append(x)
+                present.add(_hashable(x))
+        return result
+
+
+def fingerprint(value):
+    """
+    This function computes the Digest tree of a value. Dictionaries are
+    fingerprinted recursively, while all other values are leaves.
+    
+    @param value: A dictionary tree or a simple value
+    @return: Digest of the value
+    """
+    if is_branch(value):
+        node = Digest(0, {})
+        for key, item in value.items():
+            child = fingerprint(item)
+            node.children[key] = child
+            node.value += _entry_digest(key, child.value)
+        node.value %= DIGEST_MODULUS
+        return node
+    return Digest(long(md5(canonical(value)).hexdigest(), 16))
+
+def refresh_digest(node, branch, path):
+    """
+    This function updates the Digest tree `node` of `branch` after the
+    value at `path` has been changed. Only the digests of the branches
+    along the path are recomputed.
+    
+    @param node: The current Digest of `branch` (or None)
+    @param branch: The dictionary tree that was changed
+    @param path: The location of the changed value
+    @return: The updated Digest of `branch`
+    """
+    if not path or node is None or node.children is None or not is_branch(branch):
+        return fingerprint(branch)
+    key = path[0]
+    
+    # remove the contribution of the old child
+    old = node.children.pop(key, None)
+    if old is not None:
+        node.value = (node.value - _entry_digest(key, old.value)) % DIGEST_MODULUS
+    
+    # add the contribution of the new child, if it still exists
+    if key in branch:
+        new = refresh_digest(old, branch[key], path[1:])
+        node.children[key] = new
+        node.value = (node.value + _entry_digest(key, new.value)) % DIGEST_MODULUS
+    return node
+
+def canonical(value):
+    """
+    This function returns a canonical string representation of a value,
+    which does not depend on the ordering of dictionary keys.
+    
+    @param value: Any value from a configuration tree
+    @return: String representation of `value`
+    """
+    if is_branch(value):
+        items = [canonical(k) + ':' + canonical(v) for k, v in value.items()]
+        items.sort()
+        return '{' + ','.join(items) + '}'
+    elif type(value) in (list, tuple):
+        return '[' + ','.join([canonical(v) for v in value]) + ']'
+    return type(value).__name__ + ':' + repr(value)
+
+def _entry_digest(key, value):
+    """
+    This function returns the digest of a dictionary entry, which is 
+    combined into the digest of the dictionary.
+    """
+    return long(md5(canonical(key) + '=%x' % value).hexdigest(), 16)
+
+def _hashable(item):
+    """
+    This function returns a hashable key for a list item, so that lists
+    containing dictionaries or other lists can be compared as sets.
+    """
+    if is_branch(item) or type(item) in (list, tuple):
+        return canonical(item)
+    return item
+
+def list_diff(a, b, ordered=False):
+    """
+    This function compares two lists element by element.
+    
+    @param a: The new list
+    @param b: The old list
+    @param ordered: Whether a change in the order is a difference as well
+    @return: A ListDiff or None when the lists don't differ
+    """
+    ak = map(_hashable, a)
+    bk = map(_hashable, b)
+    aset = set(ak)
+    bset = set(bk)
+    
+    added = [x for x, k in zip(a, ak) if k not in bset]
+    removed = [x for x, k in zip(b, bk) if k not in aset]
+    reordered = False
+    if ordered:
+        reordered = [k for k in ak if k in bset] != [k for k in bk if k in aset]
+    
+    if added or removed or reordered:
+        return ListDiff(a, added, removed, reordered)
+    return None
+
+def expand_list_diffs(diff):
+    """
+    This function replaces the ListDiffs in a tree of differences with
+    copies of the new lists, as they would be reported with LIST_REPLACE.
+    
+    @param diff: A tree of differences or a single difference
+    @return: The tree of differences without ListDiffs
+    """
+    if isinstance(diff, ListDiff):
+        return copy.deepcopy(diff.value)
+    elif type(diff) is dict:
+        for key, item in diff.items():
+            if isinstance(item, ListDiff) or type(item) is dict:
+                diff[key] = expand_list_diffs(item)
+    return diff
+
+def compare_trees(a, b, a_digest=None, b_digest=None, lists=LIST_REPLACE):
     """
     This function does an in-depth comparison of 2 dictionary trees and
     produces another tree of their differences. This function calls itself
@@ -190,11 +602,25 @@ def compare_trees(a, b):
     Changed and newly set attribute values are present in the result as
     their new values. Removed values and branches appear as None.
     
+    When the Digest trees of A and B are given, the branches which have
+    identical fingerprints are skipped without walking them.
+    
+    With `lists` set to LIST_ELEMENTS or LIST_ORDERED, lists that are
+    present in both A and B are reported as ListDiffs.
+    
     @param a: Dictionary tree A
     @param b: Dictionary tree B
+    @param a_digest: Digest tree of A (optional)
+    @param b_digest: Digest tree of B (optional)
+    @param lists: How the changed lists are reported
     @return: Differences between A and B
     """
     r = {}
+    
+    # identical fingerprints mean identical trees
+    if a_digest is not None and b_digest is not None and a_digest == b_digest:
+        return r
+    
     ak = set(a.keys())
     bk = set(b.keys())
     
@@ -203,7 +629,7 @@ def compare_trees(a, b):
         r[key] = copy.deepcopy(a[key])
     for key in bk.difference(ak):
         # investigate each key that is not present in A
-        if type(b[key]) is dict:
+        if is_branch(b[key]):
             # if the value was a dictionary, recurse and report the result
             r[key] = compare_trees({}, b[key])
         else:
@@ -211,15 +637,29 @@ def compare_trees(a, b):
             r[key] = None
     for key in ak.intersection(bk):
         # investigate each key that appears both in A and B
+        a_child = None
+        b_child = None
+        if a_digest is not None and b_digest is not None:
+            a_child = a_digest.child(key)
+            b_child = b_digest.child(key)
+            if a_child is not None and a_child == b_child:
+                # the fingerprints match, so skip this subtree
+                continue
         
-        if type(a[key]) is dict and type(b[key]) is dict:
+        if is_branch(a[key]) and is_branch(b[key]):
             # if values are dictionaries, recurse and report if they differ
-            diff = compare_trees(a[key], b[key])
+            diff = compare_trees(a[key], b[key], a_child, b_child, lists)
             if diff:
                 r[key] = diff
+        elif type(a[key]) is list and type(b[key]) is list and lists != LIST_REPLACE:
+            # if values are lists, report the differing elements
+            diff = list_diff(a[key], b[key], lists == LIST_ORDERED)
+            if diff is not None:
+                r[key] = diff
         elif type(a[key]) is list and type(b[key]) is list:
             # if values are lists, check if they differ
-            if set(a[key]).symmetric_difference(set(b[key])):
+            if set(map(_hashable, a[key])).symmetric_difference(
+                            set(map(_hashable, b[key]))):
                 # the lists are different, so return the value in A
                 r[key] = copy.deepcopy(a[key])
         elif type(a[key]) is not type(b[key]) or a[key] != b[key]:
@@ -228,6 +668,102 @@ def compare_trees(a, b):
         
     return r
 
+def iter_diff(a, b, a_digest=None, b_digest=None, lists=LIST_REPLACE,
+              depth=None, path=[]):
+    """
+    This function compares 2 dictionary trees like compare_trees(), but
+    instead of building a tree of differences it yields a DiffRecord for
+    each difference as soon as it is found.
+    
+    The differences are reported at the paths of length `depth`, where the
+    `diff` field of a record holds the difference of the whole branch
+    at that path. Without `depth`, each changed leaf value is reported.
+    
+    The operation of a record is CONFIG_ADDED when the value is missing
+    from B, CONFIG_REMOVED when it is missing from A (or is None there),
+    and CONFIG_CHANGED otherwise, the same as diff_type() would report.
+    
+    @param a: Dictionary tree A
+    @param b: Dictionary tree B
+    @param a_digest: Digest tree of A (optional)
+    @param b_digest: Digest tree of B (optional)
+    @param lists: How the changed lists are reported
+    @param depth: The length of the reported paths (optional)
+    @param path: The location of A and B in the full trees
+    @return: A generator of DiffRecords
+    """
+    # identical fingerprints mean identical trees
+    if a_digest is not None and b_digest is not None and a_digest == b_digest:
+        return
+    
+    # whether to descend into the branches or report them as a whole
+    descend = depth is None or len(path) + 1 < depth
+    
+    ak = set(a.keys())
+    bk = set(b.keys())
+    
+    for key in ak.difference(bk):
+        # each key that appears in A but not in B was added
+        if is_branch(a[key]) and descend:
+            for record in iter_diff(a[key], {}, None, None, lists, depth, path + [key]):
+                yield record
+        elif a[key] is None:
+            yield DiffRecord(path + [key], CONFIG_REMOVED, None, None, None)
+        else:
+            yield DiffRecord(path + [key], CONFIG_ADDED, a[key], None,
+                             copy.deepcopy(a[key]))
+    for key in bk.difference(ak):
+        # each key that appears in B but not in A was removed
+        if is_branch(b[key]) and descend:
+            for record in iter_diff({}, b[key], None, None, lists, depth, path + [key]):
+                yield record
+        elif is_branch(b[key]):
+            yield DiffRecord(path + [key], CONFIG_REMOVED, None, b[key],
+                             compare_trees({}, b[key]))
+        else:
+            yield DiffRecord(path + [key], CONFIG_REMOVED, None, b[key], None)
+    for key in ak.intersection(bk):
+        # investigate each key that appears both in A and B
+        a_child = None
+        b_child = None
+        if a_digest is not None and b_digest is not None:
+            a_child = a_digest.child(key)
+            b_child = b_digest.child(key)
+            if a_child is not None and a_child == b_child:
+                # the fingerprints match, so skip this subtree
+                continue
+        
+        if is_branch(a[key]) and descend:
+            # descend into the branches (a removed branch counts as empty)
+            b_branch = b[key]
+            if not is_branch(b_branch):
+                b_branch = {}
+                b_child = None
+            for record in iter_diff(a[key], b_branch, a_child, b_child, lists, depth, path + [key]):
+                yield record
+            continue
+        
+        if is_branch(a[key]) and is_branch(b[key]):
+            diff = compare_trees(a[key], b[key], a_child, b_child, lists)
+        elif type(a[key]) is list and type(b[key]) is list and lists != LIST_REPLACE:
+            diff = list_diff(a[key], b[key], lists == LIST_ORDERED)
+        elif type(a[key]) is list and type(b[key]) is list:
+            if set(map(_hashable, a[key])).symmetric_difference(
+                            set(map(_hashable, b[key]))):
+                diff = copy.deepcopy(a[key])
+            else:
+                diff = None
+        elif type(a[key]) is not type(b[key]) or a[key] != b[key]:
+            if a[key] is None:
+                yield DiffRecord(path + [key], CONFIG_REMOVED, None, b[key], None)
+                continue
+            diff = copy.deepcopy(a[key])
+        else:
+            diff = None
+        
+        if diff is not None and not (type(diff) is dict and not diff):
+            yield DiffRecord(path + [key], CONFIG_CHANGED, a[key], b[key], diff)
+
 def diff_type(a, b, path):
     """
     This function reports which is the type of difference that was
@@ -0,0 +1,460 @@
+# SysPolicy
+# 
+# Copyright (c) 2010 Lenno Nagel
+# Author: Lenno Nagel <lenno-at-nagel.ee>
+# URL: <http://trac.syspolicy.org>
+# Released under the GNU General Public License version 3
+
+"""
+Concurrent execution of system commands
+"""
+
+from __future__ import with_statement
+
+import os
+import os.path
+import time
+import errno
+import fcntl
+import atexit
+import select
+import signal
+import threading
+import subprocess
+
+DEFAULT_LIMIT = 16 #: default maximum number of concurrent commands of a binary
+LIMITS = {
+    'useradd': 1, 'usermod': 1, 'userdel': 1, 'groupadd': 1, 'groupdel': 1,
+    'gpasswd': 1, 'chpasswd': 1, 'newusers': 1, 'setquota': 8,
+} #: maximum numbers of concurrent commands by the binary
+OUTPUT_LIMIT = 1024 * 1024 #: default maximum number of bytes kept of an output stream
+CHUNK_SIZE = 65536 #: number of bytes read from or written to a pipe at once
+REAP_INTERVAL = 10 #: milliseconds between the checks for exited commands
+
+class Command:
+    """
+    This class is a system command submitted to the Executor, which is
+    completed in the background.
+    """
+    
+    argv = None #: the command with all the arguments as a list
+    input = None #: data to be written to the standard input (optional)
+    timeout = None #: seconds after which the command is killed (optional)
+    binary = None #: name of the binary, for the concurrency limits
+    returncode = None #: exit status of the command
+    stdout = None #: standard output of the command (up to the output limit)
+    stderr = None #: error output of the command (up to the output limit)
+    timed_out = False #: whether the command was killed after the timeout
+    truncated = False #: whether some of the output was dropped
+    error = None #: exception raised when starting the command
+    done = None #: Event set when the command has completed
+    callback = None #: function called with the Command when it has completed (optional)
+    
+    def __init__(self, argv, input=None, timeout=None):
+        self.argv = argv
+        self.input = input
+        self.timeout = timeout
+        self.binary = os.path.basename(argv[0])
+        self.done = threading.Event()
+        self.process = None
+        self.deadline = None
+        self.offset = 0
+        self.output = {'stdout': [], 'stderr': []}
+        self.sizes = {'stdout': 0, 'stderr': 0}
+        self.pipes = 0
+    
+    def collect(self, stream, data, limit):
+        """
+        This function keeps the output of the command up to `limit` bytes
+        per stream, the rest is dropped.
+        """
+        room = limit - self.sizes[stream]
+        if len(data) > room:
+            data = data[:max(room, 0)]
+            self.truncated = True
+        if data:
+            self.output[stream].append(data)
+            self.sizes[stream] += len(data)
+    
+    def wait(self):
+        """
+        This function waits for the command to complete.
+        
+        @return: Tuple of the return value, standard output and error output
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return (self.returncode, self.stdout, self.stderr)
+
+
+class Executor(threading.Thread):
+    """
+    This class executes system commands concurrently from a single
+    background thread, which waits for the output of all the running
+    commands with poll().
+    
+    The number of concurrent commands is limited per binary, so that eg.
+    the tools which lock the account databases run one at a time while the
+    quota tools run in parallel. The commands over the limit wait in the
+    order they were submitted. The configured limits are merged into
+    LIMITS, eg.:
+    
+    general:
+      command-limits: {setquota: 4}
+      command-timeout: 300
+    """
+    
+    limits = None #: maximum numbers of concurrent commands by the binary
+    default_limit = DEFAULT_LIMIT #: limit for the binaries not in limits
+    timeout = None #: default timeout of the commands in seconds
+    output_limit = OUTPUT_LIMIT #: maximum number of bytes kept of an output stream
+    stopping = False #: whether the loop is to be stopped
+
+    def __init__(self, limits=None, default_limit=DEFAULT_LIMIT, timeout=None,
+                 output_limit=OUTPUT_LIMIT):
+        """
+        Initialize the Executor.
+        
+        @param limits: Maximum numbers of concurrent commands by the binary
+        @param default_limit: Limit for the other binaries
+        @param timeout: Default timeout of the commands in seconds
+        @param output_limit: Maximum number of bytes kept of an output stream
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.limits = dict(LIMITS)
+        if limits:
+            self.limits.update(limits)
+        self.default_limit = default_limit
+        self.timeout = timeout
+        self.output_limit = output_limit
+        
+        self.lock = threading.Lock()
+        self.waiting = []
+        self.running = {}
+        self.active = []
+        self.pipes = {}
+        
+        # the loop is woken up through a pipe when commands are submitted
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            set_flags(fd)
+        self.poller = select.poll()
+        self.poller.register(self.wakeup[0], select.POLLIN)
+    
+    def start(self):
+        """
+        Start the loop of the Executor, which is stopped when the
+        interpreter exits.
+        """
+        threading.Thread.start(self)
+        atexit.register(self.stop)
+    
+    def stop(self):
+        """
+        This function stops the loop of the Executor. The commands that
+        are still running are left alone.
+        """
+        self.stopping = True
+        self.wake()
+        self.join(1)
+    
+    def wake(self):
+        """
+        This function wakes up the loop of the Executor.
+        """
+        try:
+            os.write(self.wakeup[1], 'x')
+        except OSError, e:
+            # the loop is already due to wake up when the pipe is full
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def submit(self, argv, input=None, timeout=None, callback=None):
+        """
+        This function submits a command for execution.
+        
+        @param argv: The command with all the arguments as a list
+        @param input: Data to be written to the standard input of the command
+        @param timeout: Seconds after which the command is killed (default:
+            the timeout of the Executor)
+        @param callback: Function called with the Command from the loop of
+            the Executor when it has completed (optional)
+        @return: The Command, whose wait() returns the results
+        """
+        if timeout is None:
+            timeout = self.timeout
+        command = Command(argv, input, timeout)
+        command.callback = callback
+        with self.lock:
+            self.waiting.append(command)
+        self.wake()
+        return command
+    
+    def call(self, argv, input=None, timeout=None):
+        """
+        This function executes a command and waits for it to complete.
+        
+        @return: Tuple of the return value, standard output and error output
+        """
+        return self.submit(argv, input, timeout).wait()
+    
+    def call_many(self, commands, timeout=None):
+        """
+        This function executes several commands concurrently (within the
+        limits) and waits for all of them to complete.
+        
+        @param commands: List of (argv, input) tuples
+        @return: List of (return value, standard output, error output)
+            tuples in the same order
+        """
+        submitted = [self.submit(argv, input, timeout) for (argv, input) in commands]
+        return [command.wait() for command in submitted]
+    
+    def run(self):
+        """
+        This is the loop of the Executor, which starts the waiting commands,
+        moves the data through their pipes and reaps them when they exit.
+        """
+        while not self.stopping:
+            self.start_waiting()
+            try:
+                events = self.poller.poll(self.poll_timeout())
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            
+            for fd, event in events:
+                if fd == self.wakeup[0]:
+                    try:
+                        while os.read(fd, CHUNK_SIZE):
+                            pass
+                    except OSError:
+                        pass
+                elif fd in self.pipes:
+                    command = self.pipes[fd][0]
+                    try:
+                        self.transfer(fd, event)
+                    except Exception, inst:
+                        self.abort(command, inst)
+            
+            self.kill_expired()
+            self.reap()
+    
+    def start_waiting(self):
+        """
+        This function starts the waiting commands that are within the
+        concurrency limits of their binaries.
+        """
+        starting = []
+        with self.lock:
+            waiting = []
+            for command in self.waiting:
+                limit = self.limits.get(command.binary, self.default_limit)
+                if self.running.get(command.binary, 0) < limit:
+                    self.running[command.binary] = self.running.get(command.binary, 0) + 1
+                    starting.append(command)
+                else:
+                    waiting.append(command)
+            self.waiting = waiting
+        
+        for command in starting:
+            try:
+                self.spawn(command)
+            except Exception, inst:
+                self.abort(command, inst)
+    
+    def spawn(self, command):
+        """
+        This function starts a command and registers its pipes.
+        """
+        stdin = None
+        if command.input is not None:
+            stdin = subprocess.PIPE
+        try:
+            p = subprocess.Popen(command.argv, stdin=stdin, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, close_fds=True)
+        except (OSError, ValueError), e:
+            command.error = e
+            self.finish(command)
+            return
+        
+        command.process = p
+        if command.timeout:
+            command.deadline = time.time() + command.timeout
+        self.active.append(command)
+        
+        for stream, pipe, event in (('stdin', p.stdin, select.POLLOUT),
+                                    ('stdout', p.stdout, select.POLLIN),
+                                    ('stderr', p.stderr, select.POLLIN)):
+            if pipe is None:
+                continue
+            set_flags(pipe.fileno())
+            self.pipes[pipe.fileno()] = (command, stream, pipe)
+            command.pipes += 1
+            self.poller.register(pipe.fileno(), event)
+        
+        if command.input == '':
+            self.close(p.stdin.fileno())
+    
+    def transfer(self, fd, event):
+        """
+        This function writes the input to, or reads the output from a pipe
+        of a command that is ready.
+        """
+        if fd not in self.pipes:
+            return
+        command, stream, pipe = self.pipes[fd]
+        
+        if stream == 'stdin':
+            if event & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                self.close(fd)
+                return
+            try:
+                command.offset += os.write(fd, command.input[command.offset:command.offset + CHUNK_SIZE])
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return
+                # the command doesn't read its input (anymore)
+                self.close(fd)
+                return
+            if command.offset >= len(command.input):
+                self.close(fd)
+            return
+        
+        try:
+            data = os.read(fd, CHUNK_SIZE)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            data = ''
+        if data:
+            command.collect(stream, data, self.output_limit)
+        else:
+            self.close(fd)
+    
+    def close(self, fd):
+        """
+        This function closes a pipe of a command.
+        """
+        command, stream, pipe = self.pipes.pop(fd)
+        try:
+            self.poller.unregister(fd)
+        except KeyError:
+            # the pipe wasn't registered yet
+            pass
+        pipe.close()
+        command.pipes -= 1
+    
+    def abort(self, command, error):
+        """
+        This function completes a command that the loop failed to handle,
+        with the exception as its error. The command is killed and its
+        pipes are closed, so that the loop goes on with the other commands.
+        
+        @param command: The Command that failed
+        @param error: The exception raised while handling the command
+        """
+        print "Executor encountered an exception while running", ' '.join(command.argv), "\n", error
+        if command.process is not None:
+            try:
+                command.process.kill()
+                command.process.wait()
+            except OSError:
+                pass
+        for fd in [fd for fd, pipe in self.pipes.items() if pipe[0] is command]:
+            try:
+                self.close(fd)
+            except (IOError, OSError):
+                pass
+        if command.process is not None:
+            for pipe in (command.process.stdin, command.process.stdout, command.process.stderr):
+                if pipe is not None and not pipe.closed:
+                    pipe.close()
+        if command in self.active:
+            self.active.remove(command)
+        command.error = error
+        self.finish(command)
+    
+    def kill_expired(self):
+        """
+        This function kills the commands that have run past their timeout.
+        """
+        now = time.time()
+        for command in self.active:
+            if command.deadline is not None and now >= command.deadline and not command.timed_out:
+                command.timed_out = True
+                try:
+                    command.process.kill()
+                except OSError:
+                    pass
+                # the children of the command may still hold the pipes open
+                for fd in [fd for fd, pipe in self.pipes.items() if pipe[0] is command]:
+                    self.close(fd)
+    
+    def reap(self):
+        """
+        This function completes the commands that have closed their output
+        and exited.
+        """
+        active = []
+        for command in self.active:
+            if command.pipes == 0 and command.process.poll() is not None:
+                self.finish(command)
+            else:
+                active.append(command)
+        self.active = active
+    
+    def poll_timeout(self):
+        """
+        This function computes how long poll() may wait, in milliseconds,
+        until a command needs to be reaped or killed.
+        """
+        timeout = None
+        now = time.time()
+        for command in self.active:
+            if command.pipes == 0:
+                # the output is closed, but the command hasn't exited yet
+                return REAP_INTERVAL
+            if command.deadline is not None:
+                remaining = max(int((command.deadline - now) * 1000) + 1, 0)
+                if timeout is None or remaining < timeout:
+                    timeout = remaining
+        return timeout
+    
+    def finish(self, command):
+        """
+        This function stores the results of a command, releases its place
+        within the limits and wakes up the threads waiting for it.
+        """
+        if command.process is not None:
+            command.returncode = command.process.returncode
+        command.stdout = ''.join(command.output['stdout'])
+        command.stderr = ''.join(command.output['stderr'])
+        if command.timed_out:
+            # the command may have exited before it was killed, while its
+            # children kept the pipes open, but it still failed
+            if not command.returncode:
+                command.returncode = -signal.SIGKILL
+            command.stderr += "Killed after the timeout of %s seconds\n" % command.timeout
+        with self.lock:
+            self.running[command.binary] -= 1
+        command.done.set()
+        if command.callback is not None:
+            try:
+                command.callback(command)
+            except Exception, inst:
+                print "Executor encountered an exception in the callback of", ' '.join(command.argv), "\n", inst
+
+
+def set_flags(fd):
+    """
+    This function makes a pipe non-blocking and keeps it from being
+    inherited by the other commands.
+    """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
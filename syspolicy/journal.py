@@ -0,0 +1,164 @@
+# SysPolicy
+# 
+# Copyright (c) 2010 Lenno Nagel
+# Author: Lenno Nagel <lenno-at-nagel.ee>
+# URL: <http://trac.syspolicy.org>
+# Released under the GNU General Public License version 3
+
+"""
+Append-only write-ahead journal for the policy states
+"""
+
+from __future__ import with_statement
+
+import os
+import zlib
+import struct
+import cPickle
+import threading
+
+HEADER = struct.Struct('>II') #: record header: payload length and CRC32
+COMMIT_SIZE = 64 #: default number of records that are committed together
+
+class Journal:
+    """
+    This class implements an append-only journal of policy state updates.
+    
+    Each record stores the arguments of a single state update (policy,
+    path, value and diff type). The records are buffered and written to
+    the journal file in group commits, which end with an fsync. After a
+    crash, the committed records can be replayed on top of the last
+    saved state snapshot.
+    
+    Each record is prefixed with its length and checksum, so a record
+    that was only partially written is detected and discarded.
+    """
+    
+    filename = None #: the journal file name
+    commit_size = COMMIT_SIZE #: number of records in a group commit
+    records = 0 #: number of committed records in the journal file
+    pending = None #: list of encoded records waiting to be committed
+    lock = None #: lock for appending and committing records
+    
+    def __init__(self, filename, commit_size=COMMIT_SIZE):
+        """
+        Initialize the Journal.
+        
+        @param filename: The file name of the journal
+        @param commit_size: The number of records in a group commit
+        """
+        self.filename = filename
+        self.commit_size = commit_size
+        self.records = 0
+        self.pending = []
+        self.lock = threading.Lock()
+        self._file = None
+    
+    def append(self, policy, path, value, diff_type=None):
+        """
+        This function appends a state update record to the journal. The
+        record is committed once a full group of records has been
+        collected or when commit() is called.
+        
+        @param policy: The policy in which the state was set
+        @param path: The path to the changed value
+        @param value: The new value (None if it was removed)
+        @param diff_type: The type of the difference that was implemented
+        """
+        payload = cPickle.dumps((policy, list(path), value, diff_type),
+                                cPickle.HIGHEST_PROTOCOL)
+        record = HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+        
+        with self.lock:
+            self.pending.append(record)
+            if len(self.pending) >= self.commit_size:
+                self._commit()
+    
+    def commit(self):
+        """
+        This function writes all the pending records to the journal file
+        and forces them to the disk.
+        """
+        with self.lock:
+            self._commit()
+    
+    def _commit(self):
+        """
+        This function implements commit(), the lock must already be held.
+        """
+        if not self.pending:
+            return
+        if self._file is None:
+            self._file = open(self.filename, 'ab')
+        self._file.write(''.join(self.pending))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.records += len(self.pending)
+        self.pending = []
+    
+    def replay(self):
+        """
+        This function reads the committed records from the journal file.
+        
+        Reading stops at the first incomplete or damaged record, and the
+        journal file is truncated at that position, so that new records
+        are appended after the last intact one.
+        
+        @return: List of (policy, path, value, diff_type) tuples
+        """
+        results = []
+        with self.lock:
+            try:
+                jf = open(self.filename, 'rb')
+            except IOError:
+                return results
+            try:
+                data = jf.read()
+            finally:
+                jf.close()
+            
+            offset = 0
+            while offset + HEADER.size <= len(data):
+                (length, crc) = HEADER.unpack_from(data, offset)
+                payload = data[offset + HEADER.size:offset + HEADER.size + length]
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                    break
+                try:
+                    results.append(cPickle.loads(payload))
+                except Exception:
+                    break
+                offset += HEADER.size + length
+            
+            # discard the incomplete tail of the journal
+            if offset < len(data):
+                jf = open(self.filename, 'r+b')
+                jf.truncate(offset)
+                jf.close()
+            
+            self.records = len(results)
+        return results
+    
+    def truncate(self):
+        """
+        This function empties the journal file. It should be called after
+        the states have been saved to a snapshot that contains all the
+        committed records.
+        """
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            jf = open(self.filename, 'wb')
+            os.fsync(jf.fileno())
+            jf.close()
+            self.records = 0
+    
+    def close(self):
+        """
+        This function commits the pending records and closes the journal.
+        """
+        with self.lock:
+            self._commit()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,198 @@
+# SysPolicy
+# 
+# Copyright (c) 2010 Lenno Nagel
+# Author: Lenno Nagel <lenno-at-nagel.ee>
+# URL: <http://trac.syspolicy.org>
+# Released under the GNU General Public License version 3
+
+"""
+Timing and throughput metrics of the processing of ChangeSets
+"""
+
+from __future__ import with_statement
+
+import json
+import bisect
+import threading
+
+from syspolicy.modules.module import replace_file
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0) #: upper bounds of the histogram buckets in seconds
+HELP = {
+    'syspolicy_queue_wait_seconds': 'Time the ChangeSets waited in the Worker queue',
+    'syspolicy_change_seconds': 'Time spent implementing a Change',
+    'syspolicy_changeset_seconds': 'Time from enqueueing a ChangeSet until it was processed',
+    'syspolicy_changes_total': 'Number of processed Changes by the resulting state',
+    'syspolicy_changesets_total': 'Number of processed ChangeSets by the resulting state',
+} #: descriptions of the metrics
+
+class Histogram:
+    """
+    This class counts observed values into cumulative buckets, like the
+    histograms of Prometheus.
+    """
+    
+    buckets = BUCKETS #: upper bounds of the buckets
+    counts = None #: number of the values in each bucket (not cumulative)
+    count = 0 #: number of the observed values
+    sum = 0.0 #: sum of the observed values
+    
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+    
+    def observe(self, value):
+        """
+        This function adds a value to the histogram.
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+    
+    def cumulative(self):
+        """
+        This function returns the cumulative counts of the buckets.
+        
+        @return: List of (upper bound, count) tuples, the last bound being '+Inf'
+        """
+        result = []
+        total = 0
+        for bound, n in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += n
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    """
+    This class collects the histograms and counters of the Worker. Each
+    metric is kept per set of labels, eg. the latency of the Changes per
+    subsystem and operation. The metrics can be written to a file at the
+    end of a run, in the Prometheus text format (for the textfile collector
+    of the node exporter) or as JSON:
+    
+    general:
+      metrics-file: /var/lib/node_exporter/syspolicy.prom
+      metrics-format: prometheus (or json)
+    """
+    
+    histograms = None #: dictionary of the Histograms by (name, labels)
+    counters = None #: dictionary of the counter values by (name, labels)
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+    
+    def observe(self, name, value, labels=None):
+        """
+        This function adds a value to a histogram.
+        
+        @param name: Name of the histogram
+        @param value: The observed value (in seconds)
+        @param labels: Dictionary of the labels (optional)
+        """
+        key = (name, label_key(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+    
+    def count(self, name, labels=None, n=1):
+        """
+        This function increments a counter.
+        
+        @param name: Name of the counter
+        @param labels: Dictionary of the labels (optional)
+        @param n: The increment
+        """
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+    
+    def snapshot(self):
+        """
+        This function returns the current values of all the metrics.
+        
+        @return: Dictionary with the 'histograms' and 'counters', both
+            dictionaries of lists of the labelled values by the name
+        """
+        result = {'histograms': {}, 'counters': {}}
+        with self.lock:
+            for (name, labels), h in sorted(self.histograms.items()):
+                result['histograms'].setdefault(name, []).append({
+                    'labels': dict(labels),
+                    'buckets': [[bound, n] for bound, n in h.cumulative()],
+                    'count': h.count,
+                    'sum': h.sum,
+                })
+            for (name, labels), value in sorted(self.counters.items()):
+                result['counters'].setdefault(name, []).append({
+                    'labels': dict(labels),
+                    'value': value,
+                })
+        return result
+    
+    def prometheus(self):
+        """
+        This function formats the metrics in the Prometheus text format.
+        
+        @return: List of lines
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, values in sorted(snapshot['histograms'].items()):
+            lines.append('# HELP %s %s\n' % (name, HELP.get(name, name)))
+            lines.append('# TYPE %s histogram\n' % name)
+            for v in values:
+                for bound, n in v['buckets']:
+                    labels = dict(v['labels'])
+                    labels['le'] = str(bound)
+                    lines.append('%s_bucket%s %d\n' % (name, format_labels(labels), n))
+                lines.append('%s_sum%s %f\n' % (name, format_labels(v['labels']), v['sum']))
+                lines.append('%s_count%s %d\n' % (name, format_labels(v['labels']), v['count']))
+        for name, values in sorted(snapshot['counters'].items()):
+            lines.append('# HELP %s %s\n' % (name, HELP.get(name, name)))
+            lines.append('# TYPE %s counter\n' % name)
+            for v in values:
+                lines.append('%s%s %d\n' % (name, format_labels(v['labels']), v['value']))
+        return lines
+    
+    def write(self, path, format='prometheus'):
+        """
+        This function writes the metrics to a file atomically, so that
+        a collector never reads a partial file.
+        
+        @param path: Path to the file
+        @param format: 'prometheus' or 'json'
+        """
+        if format == 'json':
+            lines = [json.dumps(self.snapshot(), indent=2, sort_keys=True) + '\n']
+        else:
+            lines = self.prometheus()
+        replace_file(path, lines, mode=0644)
+
+
+def label_key(labels):
+    """
+    This function turns a dictionary of labels into a hashable key.
+    """
+    if not labels:
+        return ()
+    return tuple(sorted([(k, str(v)) for k, v in labels.items()]))
+
+def format_labels(labels):
+    """
+    This function formats the labels of a Prometheus sample, eg.
+    {subsystem="quota",operation="set_quota"}.
+    """
+    if not labels:
+        return ''
+    items = []
+    for k, v in sorted(labels.items()):
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        items.append('%s="%s"' % (k, v))
+    return '{' + ','.join(items) + '}'
@@ -0,0 +1,602 @@
+# SysPolicy
+# 
+# Copyright (c) 2010 Lenno Nagel
+# Author: Lenno Nagel <lenno-at-nagel.ee>
+# URL: <http://trac.syspolicy.org>
+# Released under the GNU General Public License version 3
+
+"""
+Native transactional backend for the passwd, group, shadow and gshadow
+databases
+"""
+
+import os
+import os.path
+import time
+import fcntl
+import shutil
+import tempfile
+import subprocess
+import syspolicy.change
+
+LOCK_FILE = 'etc/.pwd.lock' #: the lock file of the databases (see lckpwdf)
+LOGIN_DEFS = 'etc/login.defs' #: the shadow suite configuration
+NSCD = '/usr/sbin/nscd' #: the name service cache daemon
+
+#: defaults for the login.defs settings that are used here
+LOGIN_DEFAULTS = {'GID_MIN': 1000, 'GID_MAX': 60000, 'PASS_MIN_DAYS': 0,
+                  'PASS_MAX_DAYS': 99999, 'PASS_WARN_AGE': 7, 'UMASK': 022}
+
+class AccountError(Exception):
+    """
+    This exception is raised when an account Change cannot be applied.
+    """
+    pass
+
+
+class Table:
+    """
+    This class is a colon separated database file, such as /etc/passwd,
+    loaded into memory as a list of rows. Each row is a list of fields,
+    except for the comments and NIS compat entries, which are kept as
+    they are.
+    """
+    
+    filename = None #: the file name of the database
+    fields = 0 #: the number of fields in a row
+    rows = None #: list of the rows in the file order
+    index = None #: the rows by their names
+    ids = None #: the numeric ids in use (for passwd and group only)
+    modified = False #: whether the rows have been modified
+    
+    def __init__(self, filename, fields, id_field=None):
+        """
+        Load the database file.
+        
+        @param filename: The file name of the database
+        @param fields: The number of fields in a row
+        @param id_field: The number of the field with the numeric id
+        """
+        self.filename = filename
+        self.fields = fields
+        self.id_field = id_field
+        self.rows = []
+        self.index = {}
+        self.ids = set()
+        self.modified = False
+        
+        f = open(filename, 'rb')
+        try:
+            for line in f.read().splitlines():
+                if not line:
+                    continue
+                row = line.split(':')
+                if line[0] not in '#+-' and len(row) >= fields:
+                    self.index.setdefault(row[0], row)
+                    if id_field is not None and row[id_field].isdigit():
+                        self.ids.add(int(row[id_field]))
+                self.rows.append(row)
+        finally:
+            f.close()
+    
+    def get(self, name):
+        """
+        @return: The row named `name` or None if it doesn't exist
+        """
+        return self.index.get(name)
+    
+    def names(self):
+        """
+        @return: List of the names of all the rows
+        """
+        return self.index.keys()
+    
+    def add(self, row):
+        """
+        This function appends a new row to the database.
+        
+        @param row: The list of fields
+        """
+        self.rows.append(row)
+        self.index[row[0]] = row
+        if self.id_field is not None:
+            self.ids.add(int(row[self.id_field]))
+        self.modified = True
+    
+    def remove(self, name):
+        """
+        This function removes the row named `name` from the database.
+        """
+        row = self.index.pop(name)
+        self.rows.remove(row)
+        if self.id_field is not None and row[self.id_field].isdigit():
+            self.ids.discard(int(row[self.id_field]))
+        self.modified = True
+    
+    def touch(self):
+        """
+        This function marks the database modified after a row was edited.
+        """
+        self.modified = True
+    
+    def save(self):
+        """
+        This function writes the database to a temporary file, keeping a
+        backup of the old one (eg. /etc/passwd-) like the shadow utilities
+        do, and replaces the database with an atomic rename.
+        """
+        self.install(self.prepare())
+    
+    def prepare(self):
+        """
+        This function writes the database to a temporary file and makes the
+        backup of the old one, without replacing the database yet.
+        
+        @return: Name of the temporary file
+        """
+        st = os.stat(self.filename)
+        dirname = os.path.dirname(self.filename)
+        basename = os.path.basename(self.filename)
+        
+        temp_file = tempfile.NamedTemporaryFile(mode='wb', prefix='.' + basename + '.',
+                                                dir=dirname, delete=False)
+        try:
+            for row in self.rows:
+                temp_file.write(':'.join(row) + '\n')
+            temp_file.flush()
+            os.fchmod(temp_file.fileno(), st.st_mode & 07777)
+            os.fchown(temp_file.fileno(), st.st_uid, st.st_gid)
+            os.fsync(temp_file.fileno())
+            temp_file.close()
+            
+            shutil.copy2(self.filename, self.filename + '-')
+        except:
+            temp_file.close()
+            os.remove(temp_file.name)
+            raise
+        return temp_file.name
+    
+    def install(self, temp_name):
+        """
+        This function replaces the database with the temporary file written
+        by prepare().
+        """
+        os.rename(temp_name, self.filename)
+        self.modified = False
+    
+    def restore(self):
+        """
+        This function restores the database from the backup made by prepare().
+        """
+        shutil.copy2(self.filename + '-', self.filename)
+
+
+class AccountDatabase:
+    """
+    This class applies a batch of shadow account Changes (add_user, mod_user,
+    del_user, add_group and del_group) in a single transaction.
+    
+    The databases are locked and read once, all the Changes are applied in
+    memory and the modified databases are written back with atomic renames.
+    The name service cache is invalidated once at the end. A Change that
+    cannot be applied fails alone, without affecting the others.
+    """
+    
+    root = None #: the root directory of the databases
+    dry_run = False #: whether to leave the databases unmodified
+    passwd = None #: the passwd Table
+    group = None #: the group Table
+    shadow = None #: the shadow Table
+    gshadow = None #: the gshadow Table (None if there is none)
+    defs = None #: the login.defs settings
+    homes = None #: home directories to be created after the commit
+    next_ids = None #: the next ids to be allocated by the table and the id range
+    
+    def __init__(self, root='/', dry_run=False):
+        """
+        Initialize the AccountDatabase.
+        
+        @param root: The root directory of the databases
+        @param dry_run: Whether to leave the databases unmodified
+        """
+        self.root = root
+        self.dry_run = dry_run
+        self.operations = {'add_user': self.add_user, 'mod_user': self.mod_user,
+                           'del_user': self.del_user, 'add_group': self.add_group,
+                           'del_group': self.del_group}
+    
+    def path(self, filename):
+        """
+        @return: The location of `filename` under the root directory
+        """
+        return os.path.join(self.root, filename.lstrip('/'))
+    
+    def apply(self, changes):
+        """
+        This function applies a batch of Changes to the databases.
+        
+        @param changes: List of Changes
+        @return: List of the states of the Changes
+        """
+        states = []
+        lock = None
+        if not self.dry_run:
+            lock = self.lock()
+        try:
+            self.load()
+            for change in changes:
+                states.append(self.apply_change(change))
+            
+            if not self.dry_run and syspolicy.change.STATE_COMPLETED in states:
+                try:
+                    self.commit()
+                except Exception, inst:
+                    print "Committing the account databases failed:", inst
+                    return [syspolicy.change.STATE_FAILED] * len(changes)
+        finally:
+            if lock is not None:
+                self.unlock(lock)
+        
+        if not self.dry_run:
+            self.create_homes()
+            self.invalidate_cache()
+        return states
+    
+    def apply_change(self, change):
+        """
+        This function applies a single Change to the loaded databases.
+        
+        @return: STATE_COMPLETED, STATE_FAILED or STATE_NOT_HANDLED
+        """
+        if change.operation not in self.operations:
+            return syspolicy.change.STATE_NOT_HANDLED
+        try:
+            self.operations[change.operation](change.parameters)
+        except (AccountError, KeyError, ValueError), inst:
+            print "Account Change", change.operation, "failed:", inst
+            return syspolicy.change.STATE_FAILED
+        return syspolicy.change.STATE_COMPLETED
+    
+    def lock(self):
+        """
+        This function locks the databases the same way lckpwdf() does.
+        
+        @return: The locked file
+        """
+        lock = open(self.path(LOCK_FILE), 'a')
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        return lock
+    
+    def unlock(self, lock):
+        """
+        This function releases the lock of the databases.
+        """
+        fcntl.lockf(lock, fcntl.LOCK_UN)
+        lock.close()
+    
+    def load(self):
+        """
+        This function reads the databases and the login.defs settings.
+        """
+        self.passwd = Table(self.path('/etc/passwd'), 7, 2)
+        self.group = Table(self.path('/etc/group'), 4, 2)
+        self.shadow = Table(self.path('/etc/shadow'), 9)
+        self.gshadow = None
+        if os.path.exists(self.path('/etc/gshadow')):
+            self.gshadow = Table(self.path('/etc/gshadow'), 4)
+        self.defs = read_login_defs(self.path(LOGIN_DEFS))
+        self.homes = []
+        self.next_ids = {}
+    
+    def commit(self):
+        """
+        This function writes the modified databases. All the temporary files
+        and backups are written before any database is replaced, and the
+        databases replaced before a failure are restored from the backups,
+        so the databases are either all updated or left as they were. The
+        groups are replaced first, so that the new users never refer to
+        missing groups.
+        """
+        tables = [t for t in [self.group, self.gshadow, self.passwd, self.shadow]
+                  if t is not None and t.modified]
+        prepared = []
+        try:
+            for table in tables:
+                prepared.append((table, table.prepare()))
+        except:
+            for (table, temp_name) in prepared:
+                os.remove(temp_name)
+            raise
+        
+        installed = []
+        try:
+            for (table, temp_name) in prepared:
+                table.install(temp_name)
+                installed.append(table)
+        except:
+            for table in installed:
+                try:
+                    table.restore()
+                except (IOError, OSError), inst:
+                    print "Restoring", table.filename, "failed:", inst
+            for (table, temp_name) in prepared:
+                if table not in installed and os.path.exists(temp_name):
+                    os.remove(temp_name)
+            raise
+    
+    def invalidate_cache(self):
+        """
+        This function invalidates the nscd caches of the users and groups.
+        """
+        if self.root != '/' or not os.access(NSCD, os.X_OK):
+            return
+        for table in ['passwd', 'group']:
+            subprocess.call([NSCD, '-i', table], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    
+    def create_homes(self):
+        """
+        This function creates the home directories of the added users by
+        copying the skeleton directory.
+        """
+        for (homedir, skeleton, uid, gid) in self.homes:
+            home = self.path(homedir)
+            if os.path.exists(home):
+                continue
+            try:
+                if skeleton and os.path.isdir(self.path(skeleton)):
+                    shutil.copytree(self.path(skeleton), home, symlinks=True)
+                else:
+                    os.makedirs(home)
+                os.chmod(home, 0777 & ~self.defs['UMASK'])
+                for (dirpath, dirnames, filenames) in os.walk(home):
+                    os.lchown(dirpath, uid, gid)
+                    for name in dirnames + filenames:
+                        os.lchown(os.path.join(dirpath, name), uid, gid)
+            except OSError, inst:
+                print "Creating the home directory", home, "failed:", inst
+    
+    def get_gid(self, group):
+        """
+        This function finds the GID of a group by its name or number.
+        """
+        row = self.group.get(group)
+        if row is not None:
+            return int(row[2])
+        if str(group).isdigit():
+            return int(group)
+        raise AccountError("group '" + str(group) + "' does not exist")
+    
+    def free_id(self, table, minimum, maximum):
+        """
+        This function allocates an id of the table with allocate_id().
+        """
+        id = allocate_id(minimum, maximum, table.ids, self.next_ids.setdefault(table.filename, {}))
+        if id is None:
+            raise AccountError("no free ids between %d and %d" % (minimum, maximum))
+        return id
+    
+    def add_members(self, username, groups):
+        """
+        This function adds `username` to the supplementary members of the
+        given groups.
+        """
+        for name in groups:
+            if self.group.get(name) is None:
+                raise AccountError("group '" + name + "' does not exist")
+        
+        tables = [self.group]
+        if self.gshadow is not None:
+            tables.append(self.gshadow)
+        for table in tables:
+            for name in groups:
+                row = table.get(name)
+                if row is None:
+                    continue
+                members = [m for m in row[3].split(',') if m]
+                if username not in members:
+                    row[3] = ','.join(members + [username])
+                    table.touch()
+    
+    def set_members(self, username, groups):
+        """
+        This function makes `username` a supplementary member of exactly
+        the given groups.
+        """
+        groups = set(groups)
+        for name in groups:
+            if self.group.get(name) is None:
+                raise AccountError("group '" + name + "' does not exist")
+        
+        tables = [(self.group, 3)]
+        if self.gshadow is not None:
+            tables.append((self.gshadow, 3))
+        for (table, field) in tables:
+            for name in table.names():
+                row = table.get(name)
+                members = [m for m in row[field].split(',') if m]
+                if (name in groups) == (username in members):
+                    continue
+                if name in groups:
+                    members.append(username)
+                else:
+                    members.remove(username)
+                row[field] = ','.join(members)
+                table.touch()
+    
+    def add_user(self, p):
+        """
+        This function adds a user like useradd.
+        """
+        username = p['username']
+        if self.passwd.get(username) is not None:
+            raise AccountError("user '" + username + "' already exists")
+        gid = self.get_gid(p['group'])
+        extragroups = p.get('extragroups') or []
+        for name in extragroups:
+            if self.group.get(name) is None:
+                raise AccountError("group '" + name + "' does not exist")
+        uid = self.free_id(self.passwd, int(p['uid_min']), int(p['uid_max']))
+        
+        today = days_today()
+        expire = ''
+        if p.get('expire') > 0:
+            expire = str(today + p['expire'])
+        inactive = ''
+        if p.get('inactive') is not None and p['inactive'] >= 0:
+            inactive = str(p['inactive'])
+        password = p.get('password') or '!'
+        
+        self.passwd.add([username, 'x', str(uid), str(gid), p.get('name') or '',
+                         p['homedir'], p['shell']])
+        self.shadow.add([username, password, str(today),
+                         str(self.defs['PASS_MIN_DAYS']), str(self.defs['PASS_MAX_DAYS']),
+                         str(self.defs['PASS_WARN_AGE']), inactive, expire, ''])
+        if extragroups:
+            self.add_members(username, extragroups)
+        if p.get('create_homedir'):
+            self.homes.append((p['homedir'], p.get('skeleton'), uid, gid))
+    
+    def mod_user(self, p):
+        """
+        This function modifies a user like usermod.
+        """
+        username = p['username']
+        row = self.passwd.get(username)
+        if row is None:
+            raise AccountError("user '" + username + "' does not exist")
+        srow = self.shadow.get(username)
+        gid = None
+        if 'group' in p:
+            gid = self.get_gid(p['group'])
+        if p.get('extragroups'):
+            for name in p['extragroups']:
+                if self.group.get(name) is None:
+                    raise AccountError("group '" + name + "' does not exist")
+        
+        if 'name' in p:
+            row[4] = p['name'] or ''
+        if 'homedir' in p:
+            row[5] = p['homedir']
+        if gid is not None:
+            row[3] = str(gid)
+        if 'shell' in p:
+            row[6] = p['shell']
+        self.passwd.touch()
+        
+        if srow is not None:
+            if 'expire' in p and p['expire'] > 0:
+                srow[7] = str(days_today() + p['expire'])
+            if 'inactive' in p:
+                srow[6] = ''
+                if p['inactive'] is not None and p['inactive'] >= 0:
+                    srow[6] = str(p['inactive'])
+            if 'password' in p and p['password'] is not None:
+                srow[1] = p['password']
+                srow[2] = str(days_today())
+            self.shadow.touch()
+        
+        if p.get('extragroups'):
+            self.set_members(username, p['extragroups'])
+    
+    def del_user(self, p):
+        """
+        This function removes a user like userdel (keeping the home directory).
+        """
+        username = p['username']
+        if self.passwd.get(username) is None:
+            raise AccountError("user '" + username + "' does not exist")
+        self.passwd.remove(username)
+        if self.shadow.get(username) is not None:
+            self.shadow.remove(username)
+        self.set_members(username, [])
+    
+    def add_group(self, p):
+        """
+        This function adds a group like groupadd.
+        """
+        name = p['group']
+        if self.group.get(name) is not None:
+            raise AccountError("group '" + name + "' already exists")
+        gid = self.free_id(self.group, int(self.defs['GID_MIN']), int(self.defs['GID_MAX']))
+        self.group.add([name, 'x', str(gid), ''])
+        if self.gshadow is not None:
+            self.gshadow.add([name, '!', '', ''])
+    
+    def del_group(self, p):
+        """
+        This function removes a group like groupdel.
+        """
+        name = p['group']
+        row = self.group.get(name)
+        if row is None:
+            raise AccountError("group '" + name + "' does not exist")
+        for username in self.passwd.names():
+            if self.passwd.get(username)[3] == row[2]:
+                raise AccountError("cannot remove the primary group of user '" + username + "'")
+        self.group.remove(name)
+        if self.gshadow is not None and self.gshadow.get(name) is not None:
+            self.gshadow.remove(name)
+
+
+def allocate_id(minimum, maximum, used, cursors):
+    """
+    This function allocates an id after the highest one in use in the
+    range, or the first free one if the range is full at the top, like
+    useradd. So the ids of the removed accounts aren't reused while the
+    range has room.
+    
+    @param minimum: The lowest id of the range
+    @param maximum: The highest id of the range
+    @param used: Set of the ids in use
+    @param cursors: Dictionary of the next candidate ids by the ranges,
+        kept between the allocations
+    @return: The id or None if the range is full
+    """
+    id = cursors.get((minimum, maximum))
+    if id is None:
+        in_range = [i for i in used if minimum <= i <= maximum]
+        id = minimum
+        if in_range:
+            id = max(in_range) + 1
+    
+    if id > maximum or id in used:
+        # the range is full at the top, look for gaps
+        for id in xrange(minimum, maximum + 2):
+            if id not in used:
+                break
+        if id > maximum:
+            return None
+    
+    cursors[(minimum, maximum)] = id + 1
+    return id
+
+def days_today():
+    """
+    @return: The number of days since the epoch, as used in /etc/shadow
+    """
+    return int(time.time() // 86400)
+
+def read_login_defs(filename):
+    """
+    This function reads the numeric settings from login.defs.
+    
+    @param filename: The location of login.defs
+    @return: Dictionary of the settings, with the defaults for missing ones
+    """
+    defs = dict(LOGIN_DEFAULTS)
+    try:
+        f = open(filename)
+    except IOError:
+        return defs
+    try:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2 and fields[0] in defs:
+                try:
+                    defs[fields[0]] = int(fields[1], 0)
+                except ValueError:
+                    pass
+    finally:
+        f.close()
+    return defs
@@ -0,0 +1,306 @@
+# SysPolicy
+# 
+# Copyright (c) 2010 Lenno Nagel
+# Author: Lenno Nagel <lenno-at-nagel.ee>
+# URL: <http://trac.syspolicy.org>
+# Released under the GNU General Public License version 3
+
+"""
+Files backend for the account lookups, reading /etc/passwd, /etc/group
+and /etc/shadow directly
+"""
+
+import os
+import os.path
+import mmap
+import pwd, grp, spwd
+from array import array
+
+PASSWD = 'etc/passwd' #: location of the passwd database under the root
+GROUP = 'etc/group' #: location of the group database under the root
+SHADOW = 'etc/shadow' #: location of the shadow database under the root
+
+class FilesDatabase:
+    """
+    This class is a memory-mapped colon separated database file, such as
+    /etc/passwd, with an index of the record offsets.
+    
+    The file is scanned once to find the start of each record, its name
+    (the first field) and its numeric id. The records themselves are only
+    decoded when they are looked up.
+    """
+    
+    filename = None #: the file name of the database
+    data = None #: the memory-mapped contents of the file
+    offsets = None #: array of the record offsets, with the end of data last
+    names = None #: record numbers by the record name
+    ids = None #: record numbers by the numeric id (optional)
+    
+    def __init__(self, filename, id_field=None):
+        """
+        Map the database file and index its records.
+        
+        @param filename: The file name of the database
+        @param id_field: The number of the field with the numeric id
+        """
+        self.filename = filename
+        self.data = ''
+        self.offsets = array('L')
+        self.names = {}
+        self.ids = None
+        if id_field is not None:
+            self.ids = {}
+        
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            # a missing database has no records
+            self.offsets.append(0)
+            return
+        try:
+            if os.fstat(f.fileno()).st_size > 0:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        
+        self.scan(id_field)
+    
+    def scan(self, id_field):
+        """
+        This function scans the mapped file for the records, skipping the
+        empty lines, comments and NIS compat entries. The first record
+        wins when there are duplicate names or ids, like in NSS.
+        
+        @param id_field: The number of the field with the numeric id
+        """
+        data = self.data
+        size = len(data)
+        start = 0
+        while start < size:
+            end = data.find('\n', start)
+            if end < 0:
+                end = size
+            
+            line = data[start:end]
+            if line and line[0] not in '#+-':
+                fields = line.split(':', (id_field or 0) + 1)
+                if len(fields) > (id_field or 0):
+                    record = len(self.offsets)
+                    self.offsets.append(start)
+                    self.names.setdefault(fields[0], record)
+                    if id_field is not None:
+                        try:
+                            self.ids.setdefault(int(fields[id_field]), record)
+                        except ValueError:
+                            pass
+            start = end + 1
+        
+        # the end of the data terminates the last record
+        self.offsets.append(size)
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def fields(self, record):
+        """
+        This function decodes the fields of a record.
+        
+        @param record: The number of the record
+        @return: List of field values
+        """
+        start = self.offsets[record]
+        end = self.data.find('\n', start, self.offsets[record + 1])
+        if end < 0:
+            end = self.offsets[record + 1]
+        return self.data[start:end].split(':')
+    
+    def by_name(self, name):
+        """
+        This function returns the fields of the record named `name`.
+        
+        @return: List of field values or None if not found
+        """
+        record = self.names.get(name)
+        if record is None:
+            return None
+        return self.fields(record)
+    
+    def by_id(self, id):
+        """
+        This function returns the fields of the record with the id `id`.
+        
+        @return: List of field values or None if not found
+        """
+        record = self.ids.get(id)
+        if record is None:
+            return None
+        return self.fields(record)
+    
+    def records(self):
+        """
+        This function decodes all the records of the database.
+        
+        @return: Generator of the field value lists
+        """
+        for record in xrange(len(self)):
+            yield self.fields(record)
+
+
+class FilesIndex:
+    """
+    This class provides the same lookups as shadow.AccountIndex, but reads
+    the passwd, group and shadow databases directly from the files under
+    `root` instead of enumerating them through NSS.
+    
+    The lookups that miss the files are passed on to NSS when `fallback`
+    is enabled, so that accounts from other sources (eg. LDAP) can still be
+    found by their name or id.
+    """
+    
+    root = None #: the root directory of the databases
+    fallback = True #: whether to look up missing accounts through NSS
+    passwd = None #: the passwd FilesDatabase
+    group = None #: the group FilesDatabase
+    shadow = None #: the shadow FilesDatabase (read when first needed)
+    primary_members = None #: arrays of passwd record numbers by primary GID
+    
+    def __init__(self, root='/', fallback=True):
+        """
+        Map and index the databases.
+        
+        @param root: The root directory of the databases
+        @param fallback: Whether to look up missing accounts through NSS
+        """
+        self.root = root
+        self.fallback = fallback
+        self.passwd = FilesDatabase(os.path.join(root, PASSWD), 2)
+        self.group = FilesDatabase(os.path.join(root, GROUP), 2)
+        self.shadow = None
+        self.primary_members = None
+    
+    def users(self):
+        """
+        @return: List of all the users in the passwd file
+        """
+        return [make_passwd(fields) for fields in self.passwd.records()]
+    
+    def groups(self):
+        """
+        @return: List of all the groups in the group file
+        """
+        return [make_group(fields) for fields in self.group.records()]
+    
+    def user_by_name(self, name):
+        """
+        @return: The user named `name`
+        """
+        fields = self.passwd.by_name(name)
+        if fields is not None:
+            return make_passwd(fields)
+        if self.fallback:
+            return pwd.getpwnam(name)
+        raise KeyError('getpwnam(): name not found: ' + name)
+    
+    def user_by_uid(self, uid):
+        """
+        @return: The user with the UID `uid`
+        """
+        fields = self.passwd.by_id(uid)
+        if fields is not None:
+            return make_passwd(fields)
+        if self.fallback:
+            return pwd.getpwuid(uid)
+        raise KeyError('getpwuid(): uid not found: ' + str(uid))
+    
+    def group_by_name(self, name):
+        """
+        @return: The group named `name`
+        """
+        fields = self.group.by_name(name)
+        if fields is not None:
+            return make_group(fields)
+        if self.fallback:
+            return grp.getgrnam(name)
+        raise KeyError('getgrnam(): name not found: ' + name)
+    
+    def group_by_gid(self, gid):
+        """
+        @return: The group with the GID `gid`
+        """
+        fields = self.group.by_id(gid)
+        if fields is not None:
+            return make_group(fields)
+        if self.fallback:
+            return grp.getgrgid(gid)
+        raise KeyError('getgrgid(): gid not found: ' + str(gid))
+    
+    def shadow_by_name(self, name):
+        """
+        @return: The shadow password entry of the user named `name`
+        """
+        if self.shadow is None:
+            self.shadow = FilesDatabase(os.path.join(self.root, SHADOW))
+        fields = self.shadow.by_name(name)
+        if fields is not None:
+            return make_spwd(fields)
+        if self.fallback:
+            return spwd.getspnam(name)
+        raise KeyError('getspnam(): name not found')
+    
+    def users_with_gid(self, gid):
+        """
+        @return: List of the users in the passwd file with the primary GID `gid`
+        """
+        if self.primary_members is None:
+            # index the primary groups when they are first needed
+            members = {}
+            for record in xrange(len(self.passwd)):
+                fields = self.passwd.fields(record)
+                try:
+                    members.setdefault(int(fields[3]), array('L')).append(record)
+                except (ValueError, IndexError):
+                    pass
+            self.primary_members = members
+        return [make_passwd(self.passwd.fields(record))
+                for record in self.primary_members.get(gid, [])]
+    
+    def group_members(self, name):
+        """
+        @return: List of the supplementary members of the group `name`
+        """
+        try:
+            return list(self.group_by_name(name).gr_mem)
+        except KeyError:
+            return []
+
+
+def number(value):
+    """
+    This function converts a numeric field, an empty field is -1.
+    """
+    if value == '':
+        return -1
+    return int(value)
+
+def make_passwd(fields):
+    """
+    This function makes a pwd.struct_passwd of the passwd file fields.
+    """
+    fields = (fields + [''] * 7)[:7]
+    return pwd.struct_passwd((fields[0], fields[1], int(fields[2]), int(fields[3]),
+                              fields[4], fields[5], fields[6]))
+
+def make_group(fields):
+    """
+    This function makes a grp.struct_group of the group file fields.
+    """
+    fields = (fields + [''] * 4)[:4]
+    members = [m for m in fields[3].split(',') if m]
+    return grp.struct_group((fields[0], fields[1], int(fields[2]), members))
+
+def make_spwd(fields):
+    """
+    This function makes a spwd.struct_spwd of the shadow file fields.
+    """
+    fields = (fields + [''] * 9)[:9]
+    return spwd.struct_spwd([fields[0], fields[1]] + map(number, fields[2:]))
@@ -9,16 +9,25 @@
 Common module functions and base class Module
 """
 
+from __future__ import with_statement
+
 import re
 import os
 import os.path
 import tempfile
-import subprocess
+import threading
 import syspolicy.config
 import syspolicy.change
 from syspolicy.change import Change, ChangeSet
 from syspolicy.policy import merge_into
 
+BLOCK_BEGIN = re.compile('^### BEGIN') #: the start marker of any inserted block
+BLOCK_END = re.compile('^### END') #: the end marker of any inserted block
+
+configfiles = {} #: parsed configuration files by path, with their mtime
+configfiles_lock = threading.Lock() #: lock for the configfiles cache
+patterns = {} #: compiled before/after expressions by their source
+
 class Module:
     """
     This is the base Module class that all other modules must extend.
@@ -31,13 +40,18 @@ class Module:
     name = None #: the name of the module
     pt = None #: the PolicyTool instance that has loaded this module
     handled_attributes = None #: the attributes that this module handles
+    list_diff_attributes = None #: the handled attributes that accept ListDiffs
+    normalizers = None #: functions normalizing the attribute values on load
     diff_operations = None #: handlers for the various diff operations
     change_operations = None #: handlers for the various change operations
     event_hooks = None #: various event hooks that this module registers
+    reentrant = False #: whether the diff handlers may be called concurrently
     
     def __init__(self):
         self.name = "generic"
         self.handled_attributes = {}
+        self.list_diff_attributes = {}
+        self.normalizers = {}
         self.diff_operations = {
                             syspolicy.config.CONFIG_ADDED: self.cs_new_attribute,
                             syspolicy.config.CONFIG_CHANGED: self.cs_set_attribute,
@@ -67,7 +81,8 @@ class Module:
         @param operation: type of the difference
         @param path: Location of the difference in the tree
         @param value: The new value that was set (None when it was removed)
-        @param diff: The difference from the old value
+        @param diff: The difference from the old value, changed lists are
+            given as ListDiffs for the attributes in list_diff_attributes
         @return: This function always returns a ChangeSet
         """
         if self.pt.debug:
@@ -98,6 +113,22 @@ class Module:
         
         return cs
 
+    def setup(self):
+        """
+        This function is called once the module has been added to a
+        PolicyTool, when the main configuration is available. Modules can
+        override it to configure themselves.
+        """
+        pass
+    
+    def begin_plan(self):
+        """
+        This function is called by the PolicyTool at the beginning of each
+        planning pass, before any of the diff handlers are called. Modules
+        can override it to reset their planning-time caches.
+        """
+        pass
+    
     def cs_set_default(self, attribute, value, diff):
         """
         Null handler for setting a new default value in the policy.
@@ -164,6 +195,96 @@ class Module:
         else:
             return syspolicy.change.STATE_NOT_HANDLED
     
+    def change_resources(self, change):
+        """
+        This function names the resources that a Change needs exclusively
+        while it is implemented, eg. a configuration file. The Worker
+        doesn't run the ChangeSets that share a resource concurrently.
+        
+        @param change: The Change that is to be implemented
+        @return: List of resource names, or None if the Change needs the
+            whole module
+        """
+        if change.operation == 'edit_configfile':
+            return ['file:' + change.parameters['configfile']]
+        return None
+    
+    def perform_batch(self, changes):
+        """
+        This function implements a batch of Changes of this module and
+        returns their states in the same order. The Changes belong to
+        different ChangeSets, so a failure must not affect the others.
+        
+        By default the Changes are implemented one by one, except for the
+        edit_configfile Changes, which are applied to each configuration
+        file in one pass. Modules can override this to implement other
+        Changes more efficiently together. The Worker passes the Changes of
+        a batch of ChangeSets (general: worker-batch) and the consecutive
+        Changes of a ChangeSet with the same operation here together.
+        
+        @param changes: List of Changes that are to be implemented
+        @return: List of state indication codes
+        """
+        states = [None] * len(changes)
+        
+        # group the configuration file edits by the file
+        edits = {}
+        if self.change_operations.get('edit_configfile') == self.edit_configfile:
+            for i, change in enumerate(changes):
+                if change.operation == 'edit_configfile':
+                    edits.setdefault(change.parameters['configfile'], []).append(i)
+        for configfile, indexes in edits.items():
+            if len(indexes) > 1:
+                self.batch_edit_configfile(configfile, [changes[i] for i in indexes],
+                                           indexes, states)
+        
+        for i, change in enumerate(changes):
+            if states[i] is not None:
+                continue
+            try:
+                states[i] = self.perform_change(change)
+            except Exception, inst:
+                print "Module", self.name, "encountered an exception while processing Change", change, "\n", inst
+                states[i] = syspolicy.change.STATE_FAILED
+        return states
+    
+    def batch_edit_configfile(self, configfile, changes, indexes, states):
+        """
+        This function applies several edit_configfile Changes to the same
+        configuration file in memory and writes the file only once. The
+        Changes that can't be applied fail individually, but when the file
+        can't be read or written, all of them fail.
+        
+        @param configfile: Path to the configuration file
+        @param changes: List of the edit_configfile Changes of the file
+        @param indexes: Positions of the Changes in `states`
+        @param states: List where the states of the Changes are stored
+        """
+        try:
+            cf = open_configfile(configfile)
+        except (IOError, OSError):
+            for i in indexes:
+                states[i] = syspolicy.change.STATE_FAILED
+            return
+        
+        applied = []
+        for i, change in zip(indexes, changes):
+            p = change.parameters
+            try:
+                cf.edit(self.name, p['id'], p['before'], p['after'], p['lines'])
+                applied.append(i)
+            except Exception, inst:
+                print "Module", self.name, "encountered an exception while processing Change", change, "\n", inst
+                states[i] = syspolicy.change.STATE_FAILED
+        
+        state = syspolicy.change.STATE_COMPLETED
+        try:
+            cf.save(self.pt.debug)
+        except (IOError, OSError):
+            state = syspolicy.change.STATE_FAILED
+        for i in applied:
+            states[i] = state
+    
     def edit_configfile(self, change):
         """
         This function implements the edit_configfile Change operation.
@@ -201,101 +322,322 @@ class Module:
         @param lines: List of strings to be inserted to the file
         @return: Returns True on success
         """
-        orig_file = open(configfile, "r")
-        orig_src = orig_file.readlines()
-        src = []
-        dst = []
-        orig_file.close()
-        inserted = False
+        cf = open_configfile(configfile)
+        cf.edit(self.name, id, before, after, lines)
+        cf.save(self.pt.debug)
+        return True
+    
+    def execute(self, cmd=[], input=None):
+        """
+        This function executes a system command.
+        
+        If the debug mode has been enabled, then the command is echoed
+        back to the shell instead of executing it.
+        
+        @param cmd: The command to be executed with all the arguments as a list
+        @param input: Data to be written to the standard input of the command
+        @return: STATE_COMPLETED when the return value is 0, otherwise STATE_FAILED
+        """
+        (returncode, stdout, stderr) = self.run_command(cmd, input)
+        
+        if returncode == 0:
+            return syspolicy.change.STATE_COMPLETED
+        elif stderr:
+            raise Exception('Executing: ' + ' '.join(cmd) + '\n' + stderr)
+        else:
+            return syspolicy.change.STATE_FAILED
+    
+    def execute_many(self, commands):
+        """
+        This function executes several independent system commands
+        concurrently, like execute() does for one. The failures are reported
+        instead of raised, so that they don't affect the other commands.
+        
+        @param commands: List of (cmd, input) tuples
+        @return: List of STATE_COMPLETED or STATE_FAILED in the same order
+        """
+        results = self.run_commands(commands)
+        return [self.command_state(cmd, result) for ((cmd, input), result) in zip(commands, results)]
+    
+    def command_state(self, cmd, result):
+        """
+        This function interprets the result of a command like execute()
+        does, but reports the failures instead of raising them.
+        
+        @param cmd: The command with all the arguments as a list
+        @param result: The result from run_commands()
+        @return: STATE_COMPLETED when the return value is 0, otherwise STATE_FAILED
+        """
+        if isinstance(result, Exception):
+            print "Module", self.name, "failed executing", ' '.join(cmd), "\n", result
+            return syspolicy.change.STATE_FAILED
+        if result[0] == 0:
+            return syspolicy.change.STATE_COMPLETED
+        if result[2]:
+            print "Module", self.name, "failed executing", ' '.join(cmd), "\n", result[2]
+        return syspolicy.change.STATE_FAILED
+    
+    def run_command(self, cmd=[], input=None):
+        """
+        This function executes a system command like execute() does, but
+        returns its exit status and output for the caller to interpret.
+        
+        The command is run by the Executor of the PolicyTool, within the
+        concurrency limit of its binary and the command timeout.
+        
+        @param cmd: The command to be executed with all the arguments as a list
+        @param input: Data to be written to the standard input of the command
+        @return: Tuple of the return value, standard output and error output
+        """
+        (cmd, input) = self.prepare_command(cmd, input)
+        (returncode, stdout, stderr) = self.pt.executor.call(cmd, input)
+        
+        if self.pt.debug:
+            print '>>>', stdout,
+        
+        return (returncode, stdout, stderr)
+    
+    def run_commands(self, commands):
+        """
+        This function executes several system commands concurrently (within
+        the limits of the Executor) and waits for all of them.
+        
+        @param commands: List of (cmd, input) tuples
+        @return: List of (return value, standard output, error output)
+            tuples in the same order, or the exceptions raised when a
+            command couldn't be started
+        """
+        submitted = []
+        for (cmd, input) in commands:
+            (cmd, input) = self.prepare_command(cmd, input)
+            submitted.append(self.pt.executor.submit(cmd, input))
+        
+        results = []
+        for command in submitted:
+            try:
+                results.append(command.wait())
+            except Exception, inst:
+                results.append(inst)
+                continue
+            if self.pt.debug:
+                print '>>>', command.stdout,
+        return results
+    
+    def prepare_command(self, cmd, input):
+        """
+        This function replaces the command with an echo of it in the debug mode.
+        
+        @return: Tuple of the command and input to be executed
+        """
+        if self.pt.debug:
+            cmd = ['/bin/echo'] + cmd
+            if input is not None:
+                print '<<<', input,
+                input = None
+        return (cmd, input)
+
+
+class ConfigFile:
+    """
+    This class is a configuration file parsed into lines, which the
+    SysPolicy blocks are inserted to and removed from in memory.
+    
+    The parsed files are cached by their path and reused as long as the
+    modification time of the file doesn't change, so that the successive
+    edits of the same file don't need to read it again. All the edits are
+    written out together by save(), with an atomic rename.
+    
+    The edits of the ChangeSets that the Worker processes in the same batch
+    are applied to each file in one pass (see Module.perform_batch), eg.
+    the edits of several attributes of a PAM service. Only when batching
+    is disabled (general: worker-batch: 1), the edits of separate
+    ChangeSets write the file once each.
+    """
+    
+    path = None #: path to the configuration file
+    mtime = None #: modification time of the file when it was read
+    lines = None #: the lines of the file, including the line ends
+    changed = False #: whether the lines have been edited since reading
+    
+    def __init__(self, path, mtime=None, lines=None):
+        """
+        Read the configuration file, unless its lines are given.
         
-        tag = "SysPolicy module " + self.name + " -- " + id
+        @param path: Path to the configuration file
+        @param mtime: Modification time of the file when the lines were read
+        @param lines: The lines of the file
+        """
+        self.path = path
+        if lines is None:
+            f = open(path, "r")
+            try:
+                mtime = os.fstat(f.fileno()).st_mtime
+                lines = f.readlines()
+            finally:
+                f.close()
+        self.mtime = mtime
+        self.lines = lines
+        self.changed = False
+    
+    def edit(self, module, id, before, after, lines):
+        """
+        This function replaces the block identified by `module` and `id`
+        with the given lines, like Module.append_lines_to_file().
+        
+        @param module: The name of the module that owns the block
+        @param id: A simple identifier text to uniquely identify the block
+        @param before: Regular expression to find before which line to add the new lines
+        @param after: Regular expression to find after which line to add the new lines
+        @param lines: List of strings to be inserted to the file
+        """
+        tag = "SysPolicy module " + module + " -- " + id
         start_tag = "### BEGIN " + tag + " ###\n"
         end_tag = "### END " + tag + " ### \n"
         
         elines = []
-        for line in lines:
-            elines.append(line + '\n')
-        
-        if len(elines) > 0:
-            elines.insert(0, start_tag)
+        if len(lines) > 0:
+            elines.append(start_tag)
+            for line in lines:
+                elines.append(line + '\n')
             elines.append(end_tag)
         
+        # remove the previous block with the same identifier tags
+        src = []
         filter = False
-        for line in orig_src:
-            if re.search('^' + start_tag, line):
+        for line in self.lines:
+            if line == start_tag:
                 filter = True
             if not filter:
                 src.append(line)
-            if filter and re.search('^' + end_tag, line):
-                filter = False                
+            if filter and line == end_tag:
+                filter = False
         
+        before = compile_pattern(before)
+        after = compile_pattern(after)
+        dst = []
+        inserted = False
         seek_for_end = False
-        if before is not None or after is not None:
-            for line in src:
-                if not seek_for_end and re.search('^### BEGIN', line.rstrip("\r\n")):
-                    seek_for_end = True
-                elif seek_for_end and re.search('^### END', line.rstrip("\r\n")):
-                    seek_for_end = False
-                
-                if before is not None and not seek_for_end and not inserted and re.search(before, line.rstrip("\r\n")):
-                    dst.extend(elines)
-                    inserted = True
-                
+        for line in src:
+            if before is None and after is None or inserted:
                 dst.append(line)
-                
-                if after is not None and not seek_for_end and not inserted and re.search(after, line.rstrip("\r\n")):
-                    dst.extend(elines)
-                    inserted = True
-        else:
-            dst.extend(src)
+                continue
+            
+            stripped = line.rstrip("\r\n")
+            # the lines inside the other blocks are never matched
+            if not seek_for_end and BLOCK_BEGIN.search(stripped):
+                seek_for_end = True
+            elif seek_for_end and BLOCK_END.search(stripped):
+                seek_for_end = False
+            
+            if before is not None and not seek_for_end and before.search(stripped):
+                dst.extend(elines)
+                inserted = True
+            
+            dst.append(line)
+            
+            if after is not None and not seek_for_end and not inserted and after.search(stripped):
+                dst.extend(elines)
+                inserted = True
         
         if not inserted:
             dst.extend(elines)
         
-        if self.pt.debug:
-            print
-            print 40 * "-"
-            for d in dst:
-                print d, 
-            print 40 * "-"
-
-        basename = os.path.basename(configfile)
-        basedir = os.path.dirname(configfile)
-        
-        temp_file = tempfile.NamedTemporaryFile(prefix='.'+basename+'.', suffix='.syspolicy', dir=basedir, delete=False)
-        temp_file.writelines(dst)
-        temp_file.close()
-        
-        if self.pt.debug:
-            os.remove(temp_file.name)
-        else:
-            os.rename(temp_file.name, configfile)
-        
-        return True
+        # the file is not rewritten when the block is already in place
+        if dst != self.lines:
+            self.lines = dst
+            self.changed = True
     
-    def execute(self, cmd=[]):
+    def save(self, debug=False):
         """
-        This function executes a system command.
-        
-        If the debug mode has been enabled, then the command is echoed
-        back to the shell instead of executing it.
+        This function writes the edited lines to a temporary file next
+        to the configuration file and renames it over the file. In debug
+        mode, the lines are printed and the file is left untouched.
         
-        @param cmd: The command to be executed with all the arguments as a list
-        @return: STATE_COMPLETED when the return value is 0, otherwise STATE_FAILED
+        @param debug: Whether the debug mode is enabled
         """
-        if self.pt.debug:
-            cmd = ['/bin/echo'] + cmd
+        if not self.changed:
+            return
         
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        (stdout, stderr) = p.communicate()
-        p.wait()
+        if debug:
+            print
+            print 40 * "-"
+            for d in self.lines:
+                print d,
+            print 40 * "-"
         
-        if self.pt.debug:
-            print '>>>', stdout, 
+        replace_file(self.path, self.lines, dry_run=debug)
+        if debug:
+            return
         
-        if p.returncode == 0:
-            return syspolicy.change.STATE_COMPLETED
-        elif stderr:
-            raise Exception('Executing: ' + ' '.join(cmd) + '\n' + stderr)
-        else:
-            return syspolicy.change.STATE_FAILED
+        self.mtime = os.path.getmtime(self.path)
+        self.changed = False
+        with configfiles_lock:
+            configfiles[self.path] = (self.mtime, self.lines)
+
+
+def open_configfile(path):
+    """
+    This function returns the parsed configuration file at `path`,
+    reading it only if it has been modified since it was last parsed.
+    
+    @param path: Path to the configuration file
+    @return: A ConfigFile
+    """
+    mtime = os.path.getmtime(path)
+    with configfiles_lock:
+        cached = configfiles.get(path)
+    if cached is not None and cached[0] == mtime:
+        return ConfigFile(path, mtime, list(cached[1]))
+    
+    cf = ConfigFile(path)
+    with configfiles_lock:
+        configfiles[path] = (cf.mtime, cf.lines)
+    cf.lines = list(cf.lines)
+    return cf
+
+def compile_pattern(expression):
+    """
+    This function compiles a regular expression once and caches it.
+    
+    @param expression: The regular expression or None
+    @return: The compiled expression or None
+    """
+    if expression is None:
+        return None
+    try:
+        return patterns[expression]
+    except KeyError:
+        pattern = patterns[expression] = re.compile(expression)
+        return pattern
+
+def replace_file(path, lines, mode=None, dry_run=False):
+    """
+    This function replaces the contents of a file atomically, by writing
+    the lines to a temporary file in the same directory and renaming it
+    over the file.
+    
+    @param path: Path to the file
+    @param lines: List of lines to be written, including the line ends
+    @param mode: Permissions of the file (default: those of the old file)
+    @param dry_run: Whether to remove the temporary file instead of renaming it
+    """
+    basename = os.path.basename(path)
+    basedir = os.path.dirname(path)
+    
+    temp_file = tempfile.NamedTemporaryFile(prefix='.'+basename+'.', suffix='.syspolicy', dir=basedir, delete=False)
+    try:
+        temp_file.writelines(lines)
+        # keep the permissions of the original file
+        if mode is None:
+            mode = os.stat(path).st_mode & 07777
+        os.fchmod(temp_file.fileno(), mode)
+        temp_file.close()
+    except:
+        temp_file.close()
+        os.remove(temp_file.name)
+        raise
+    
+    if dry_run:
+        os.remove(temp_file.name)
+    else:
+        os.rename(temp_file.name, path)
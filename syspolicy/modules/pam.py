@@ -10,20 +10,54 @@ PAM configuration support
 """
 
 import os
+import os.path
 import syspolicy.change
 from syspolicy.change import Change, ChangeSet
-from syspolicy.modules.module import Module
+from syspolicy.config import ListDiff
+from syspolicy.modules.module import Module, replace_file
+
+LIST_DIR = 'syspolicy' #: default directory of the list files under the PAM directory
+LIST_ITEMS = {
+    'users_allow': ('user', 'allow', 'fail'),
+    'users_deny': ('user', 'deny', 'succeed'),
+    'groups_allow': ('group', 'allow', 'fail'),
+    'groups_deny': ('group', 'deny', 'succeed'),
+} #: pam_listfile.so item, sense and onerr arguments by attribute
 
 class PAM(Module):
     """
     This module provides PAM configuration support for SysPolicy.
+    
+    By default the user and group lists are written inline to the rules
+    of pam_succeed_if.so. For large lists, they can be written to sorted
+    list files instead, which are checked with pam_listfile.so:
+    
+    module-pam:
+      list-mode: listfile
+      list-dir: /etc/pam.d/syspolicy
     """
     
+    list_mode = 'inline' #: how the user and group lists are written ('inline' or 'listfile')
+    list_dir = None #: directory of the list files
+    
     def __init__(self):
         Module.__init__(self)
         self.name = "pam"
+        self.reentrant = True
         self.handled_attributes['services'] = ['groups_allow', 'groups_deny',
                 'users_allow', 'users_deny', 'password']
+        self.list_diff_attributes['services'] = ['groups_allow', 'groups_deny',
+                'users_allow', 'users_deny']
+        self.change_operations['edit_listfile'] = self.edit_listfile
+    
+    def setup(self):
+        """
+        This function sets up the list mode according to the main configuration.
+        """
+        self.list_mode = self.pt.conf.get(['module-pam', 'list-mode']) or 'inline'
+        self.list_dir = self.pt.conf.get(['module-pam', 'list-dir'])
+        if self.list_dir is None and self.pt.conf.get(['module-pam', 'pam-dir']) is not None:
+            self.list_dir = os.path.join(self.pt.conf.get(['module-pam', 'pam-dir']), LIST_DIR)
     
     def cs_rem_attribute(self, group, attribute, value, diff):
         """
@@ -41,6 +75,11 @@ class PAM(Module):
         It will always return a ChangeSet which contains the exact lines
         that needed to be changed in a specific PAM configuration file.
         """
+        # the order of the users and groups doesn't matter to PAM, so there
+        # is nothing to change when the list was only reordered
+        if isinstance(diff, ListDiff) and not diff.added and not diff.removed:
+            return None
+        
         configfile = self.pt.conf.get(['module-pam', 'pam-dir']) + '/' + group
         lines = []
         
@@ -48,7 +87,11 @@ class PAM(Module):
         if not os.access(configfile, os.F_OK):
             raise Exception("PAM service config file '" + configfile + "' does not exist")
         
+        if self.list_mode == 'listfile' and attribute in LIST_ITEMS:
+            return self.cs_set_listfile(group, configfile, attribute, value, diff)
+        
         # TODO: Make this function work with more than one group per attribute
+        # (the listfile mode supports any number of groups)
         if attribute in ['groups_allow'] and len(value) > 1:
             raise Exception("Cannot handle more than 1 group in the attribute " + attribute + " yet")
         
@@ -103,3 +146,94 @@ class PAM(Module):
         params['lines'] = lines
 
         return ChangeSet(Change(self.name, "edit_configfile", params))
+    
+    def cs_set_listfile(self, service, configfile, attribute, value, diff):
+        """
+        This function produces a ChangeSet for setting a user or group list
+        in the listfile mode. The list is written to a list file of the
+        service and the attribute, which is referenced by a pam_listfile.so
+        rule in the PAM configuration file.
+        
+        The list file is written before the rule is added and removed after
+        the rule is removed, so that PAM never refers to a missing file.
+        
+        @param service: The name of the PAM service
+        @param configfile: Path to the PAM configuration file of the service
+        @param attribute: The attribute in the policy that is being set
+        @param value: The new list of users or groups
+        @param diff: The difference from the old value
+        @return: A ChangeSet
+        """
+        listfile = os.path.join(self.list_dir, service + '.' + attribute)
+        item, sense, onerr = LIST_ITEMS[attribute]
+        
+        lines = []
+        if len(value) > 0:
+            lines.append('account required pam_listfile.so item=%s sense=%s onerr=%s file=%s' %
+                         (item, sense, onerr, listfile))
+        
+        params = {}
+        params['configfile'] = configfile
+        params['before'] = '^account'
+        params['after'] = None
+        params['id'] = attribute
+        params['lines'] = lines
+        configchange = Change(self.name, "edit_configfile", params)
+        
+        params = {}
+        params['listfile'] = listfile
+        params['value'] = list(value)
+        listchange = Change(self.name, "edit_listfile", params)
+        
+        if len(value) > 0:
+            return ChangeSet([listchange, configchange])
+        return ChangeSet([configchange, listchange])
+    
+    def change_resources(self, change):
+        """
+        The list files are resources of their own, like the PAM
+        configuration files.
+        """
+        if change.operation == 'edit_listfile':
+            return ['file:' + change.parameters['listfile']]
+        return Module.change_resources(self, change)
+    
+    def edit_listfile(self, change):
+        """
+        This function implements the edit_listfile Change operation.
+        
+        The list file is written sorted from the whole list, unless it
+        already has exactly those entries. The file is replaced atomically
+        and removed when the list is empty.
+        
+        @param change: Change element to be implemented
+        @return: STATE_COMPLETED on success, STATE_FAILED otherwise
+        """
+        p = change.parameters
+        listfile = p['listfile']
+        try:
+            if len(p['value']) == 0:
+                if os.path.exists(listfile) and not self.pt.debug:
+                    os.remove(listfile)
+                return syspolicy.change.STATE_COMPLETED
+            
+            entries = sorted(set(p['value']))
+            if os.path.exists(listfile):
+                f = open(listfile, "r")
+                try:
+                    current = [line.rstrip("\n") for line in f]
+                finally:
+                    f.close()
+                if current == entries:
+                    return syspolicy.change.STATE_COMPLETED
+
+            if self.pt.debug:
+                print "Writing", len(entries), "entries to", listfile
+                return syspolicy.change.STATE_COMPLETED
+            if not os.path.isdir(self.list_dir):
+                os.makedirs(self.list_dir, 0755)
+            replace_file(listfile, [entry + '\n' for entry in entries], 0644)
+        except (IOError, OSError):
+            return syspolicy.change.STATE_FAILED
+        
+        return syspolicy.change.STATE_COMPLETED
@@ -9,32 +9,99 @@
 Quota configuration support
 """
 
+from __future__ import with_statement
+
 import re
 import copy
+import threading
+import subprocess
+from array import array
 import syspolicy.change
 import syspolicy.event
 import syspolicy.modules.shadow as shadow
 from syspolicy.change import Change, ChangeSet
 from syspolicy.modules.module import Module
-from syspolicy.config import compare_trees
+from syspolicy.config import compare_trees, is_branch
 
 SETQUOTA = "/usr/sbin/setquota"
+REPQUOTA = "/usr/sbin/repquota"
+PROTOTYPE_MIN = 16 #: default number of objects with identical limits for setquota -p
+PROTOTYPE_CHUNK = 256 #: maximum number of objects in a setquota -p invocation
+LIMITS = ['block-softlimit', 'block-hardlimit', 'inode-softlimit', 'inode-hardlimit']
+SIZE_PATTERN = re.compile('^([0-9]*)([kmgt]?)$') #: size specification with an optional unit
+UNITS = {'k': 1, 'm': 1024, 'g': 1024*1024, 't': 1024*1024*1024} #: size units in kilobytes
+
+specs = {} #: cache of the extracted limits by the quota definition
 
 class Quota(Module):
     """
     This module provides Linux quota configuration support for SysPolicy.
+    
+    Batches of set_quota Changes are implemented with one setquota -b
+    invocation per filesystem and quota type. Optionally, the objects
+    that get identical limits are set with setquota -p from a prototype:
+    
+    module-quota:
+      prototype: true
+      prototype-min: 16
+    
+    With 'drift-check: true', the current limits are read with repquota
+    during planning, and no set_quota Changes are proposed for the limits
+    that are already in place.
     """
     
+    prototype_min = 0 #: minimum number of objects for setquota -p (0: disabled)
+    drift_check = False #: whether to skip the limits that are already set
+    tables = None #: QuotaTables of the current limits by (filesystem, type)
+    skipped = 0 #: number of set_quota Changes skipped in this planning pass
+    
     def __init__(self):
         Module.__init__(self)
         self.name = "quota"
+        self.reentrant = True
         self.handled_attributes['groups'] = ['userquota', 'groupquota']
+        self.normalizers['groups'] = {'userquota': normalize_quota,
+                                      'groupquota': normalize_quota}
         self.change_operations['set_quota'] = self.set_quota
         self.event_hooks[syspolicy.event.USER_ADDED] = self.event_user_modified
         self.event_hooks[syspolicy.event.USER_MODIFIED] = self.event_user_modified
         self.event_hooks[syspolicy.event.USER_REMOVED] = self.event_user_removed
         self.event_hooks[syspolicy.event.GROUP_ADDED] = self.event_group_added
         self.event_hooks[syspolicy.event.GROUP_REMOVED] = self.event_group_removed
+        self.tables = {}
+        self.tables_lock = threading.Lock()
+    
+    def setup(self):
+        """
+        This function enables the prototype mode and the drift check
+        according to the main configuration.
+        """
+        if self.pt.conf.get(['module-quota', 'prototype']) == True:
+            self.prototype_min = self.pt.conf.get(['module-quota', 'prototype-min']) or PROTOTYPE_MIN
+        self.drift_check = self.pt.conf.get(['module-quota', 'drift-check']) == True
+    
+    def begin_plan(self):
+        """
+        This function drops the limits that were read in the previous
+        planning pass and resets the count of the skipped Changes.
+        """
+        with self.tables_lock:
+            self.tables = {}
+            self.skipped = 0
+    
+    def current_limits(self, filesystem, type):
+        """
+        This function returns the current limits on a filesystem, reading
+        them with repquota once per planning pass.
+        
+        @param filesystem: The filesystem (mount point)
+        @param type: Type of the quota ('user' or 'group')
+        @return: A QuotaTable or None if the limits can't be read
+        """
+        with self.tables_lock:
+            if (filesystem, type) not in self.tables:
+                self.tables[(filesystem, type)] = read_repquota(filesystem, type)
+            return self.tables[(filesystem, type)]
     
     def cs_rem_attribute(self, group, attribute, value, diff):
         if attribute in self.handled_attributes['groups']:
@@ -46,15 +113,28 @@ class Quota(Module):
         based on the policy. In case user quotas are being changed for the 
         group, it queries for all the members of the group and returns a Change
         element for setting the quota for each of them.
+        
+        The limits are normalized on load, so `diff` only lists the
+        filesystems whose limits really changed. Their limits are set in
+        full from `value`, the filesystems missing from it are cleared.
         """
         cs = ChangeSet()
+        if is_branch(diff):
+            quota = {}
+            for fs in diff:
+                if is_branch(value) and fs in value:
+                    quota[fs] = value[fs]
+                else:
+                    quota[fs] = None
+        else:
+            quota = diff
         if attribute == 'groupquota':
-            cs.extend(self.c_set_quota(diff, 'group', group))
+            cs.extend(self.c_set_quota(quota, 'group', group))
         elif attribute == 'userquota':
             try:
                 gid = shadow.get_group_by_name(group).gr_gid
                 for user in shadow.list_users_with_gid(gid):
-                    cs.extend(self.c_set_quota(diff, 'user', user.pw_name))
+                    cs.extend(self.c_set_quota(quota, 'user', user.pw_name))
             except:
                 pass
         return cs
@@ -73,6 +153,16 @@ class Quota(Module):
         changes = []
         for fs, limits in quota.items():
             params = extract_quota(limits)
+            
+            # skip the limits that are already in place
+            if self.drift_check:
+                table = self.current_limits(fs, type)
+                if table is not None and table.get(object) == \
+                        tuple([params.get(l, 0) for l in LIMITS]):
+                    with self.tables_lock:
+                        self.skipped += 1
+                    continue
+            
             params['type'] = type
             params['object'] = object
             params['filesystem'] = fs            
@@ -173,27 +263,344 @@ class Quota(Module):
         @param change: The set_quota Change element
         @return: The return value from self.execute(cmd)
         """
-        # /usr/sbin/setquota [-u|-g] [-F quotaformat] <user|group>
-        # <block-softlimit> <block-hardlimit> <inode-softlimit> <inode-hardlimit> -a|<filesystem>
-        p = change.parameters
+        return self.execute(set_quota_command(change.parameters))
+    
+    def change_resources(self, change):
+        """
+        The quotas of each filesystem and quota type are separate resources,
+        so the limits on different filesystems can be set concurrently.
+        """
+        if change.operation == 'set_quota':
+            p = change.parameters
+            return ['quota:%s:%s' % (p['type'], p['filesystem'])]
+        return Module.change_resources(self, change)
+    
+    def perform_batch(self, changes):
+        """
+        This function implements a batch of Changes. The set_quota Changes
+        are grouped by the filesystem and quota type, and each group is
+        implemented with a single setquota -b invocation. The groups are
+        independent, so their invocations are run concurrently.
+        
+        @param changes: List of Changes that are to be implemented
+        @return: List of state indication codes
+        """
+        states = [None] * len(changes)
+        groups = {}
+        order = []
+        for i, c in enumerate(changes):
+            if c.operation != 'set_quota':
+                states[i] = Module.perform_batch(self, [c])[0]
+                continue
+            key = (c.parameters['filesystem'], c.parameters['type'])
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(i)
+        
+        batches = []
+        prototypes = []
+        for (filesystem, type) in order:
+            indexes = groups[(filesystem, type)]
+            
+            # find the objects that can be set from a prototype
+            prototyped = {}
+            if self.prototype_min and len(indexes) > 1:
+                prototyped = self.find_prototypes(changes, indexes)
+            followers = set()
+            for members in prototyped.values():
+                followers.update(members[1:])
+                prototypes.append((filesystem, type, members))
+            
+            batches.append((filesystem, type, [i for i in indexes if i not in followers]))
+        
+        self.batch_set_quota(changes, batches, states)
+        if prototypes:
+            self.prototype_set_quota(changes, prototypes, states)
+        
+        return states
+    
+    def find_prototypes(self, changes, indexes):
+        """
+        This function groups the set_quota Changes by identical limits, for
+        the groups that are large enough for the prototype mode.
+        
+        @param changes: List of all the Changes
+        @param indexes: Indexes of the set_quota Changes of a filesystem and type
+        @return: Dictionary of the lists of Change indexes by the limits,
+            the first Change in each list being the prototype
+        """
+        # the order matters when an object is set more than once
+        objects = [changes[i].parameters['object'] for i in indexes]
+        if len(set(objects)) != len(objects):
+            return {}
+        
+        same = {}
+        for i in indexes:
+            p = changes[i].parameters
+            same.setdefault(tuple([p.get(l, 0) for l in LIMITS]), []).append(i)
+        return dict([(k, v) for k, v in same.items() if len(v) >= self.prototype_min])
+    
+    def batch_set_quota(self, changes, batches, states):
+        """
+        This function sets the quota of the groups of Changes with setquota
+        -b, which reads the objects and their limits from the standard input.
+        Only a clean exit completes the whole group. Otherwise the objects
+        on the lines reported in the errors fail, and the rest of the group
+        is implemented one by one, as not all the errors name a line (eg.
+        "Cannot set quota for ..."). A group of one Change is set with a
+        plain setquota.
+        
+        @param changes: List of all the Changes
+        @param batches: List of (filesystem, type, indexes) of the groups
+        @param states: List of the states of the Changes
+        """
+        types = {'user': '-u', 'group': '-g'}
+        commands = []
+        for (filesystem, type, indexes) in batches:
+            if len(indexes) == 1:
+                commands.append((set_quota_command(changes[indexes[0]].parameters), None))
+                continue
+            lines = []
+            for i in indexes:
+                p = changes[i].parameters
+                lines.append(' '.join([str(p['object'])] + [str(p.get(l, 0)) for l in LIMITS]) + '\n')
+            commands.append(([SETQUOTA, types[type], '-b', filesystem], ''.join(lines)))
+        
+        retry = []
+        results = self.run_commands(commands)
+        for (filesystem, type, indexes), command, result in zip(batches, commands, results):
+            if len(indexes) == 1:
+                states[indexes[0]] = self.command_state(command[0], result)
+                continue
+            
+            failed = set()
+            if not isinstance(result, Exception):
+                (returncode, stdout, stderr) = result
+                if returncode == 0:
+                    for i in indexes:
+                        states[i] = syspolicy.change.STATE_COMPLETED
+                    continue
+                failed = set([int(n) for n in re.findall(r'line (\d+)', stderr)])
+            
+            # the objects on the other lines may have failed as well, with
+            # errors that don't name the line, so they are tried one by one
+            for line, i in enumerate(indexes):
+                if line + 1 in failed:
+                    print "Setting the quota of", changes[i].parameters['object'], "failed"
+                    states[i] = syspolicy.change.STATE_FAILED
+                else:
+                    retry.append(i)
+        
+        self.retry_set_quota(changes, retry, states)
+    
+    def prototype_set_quota(self, changes, prototypes, states):
+        """
+        This function copies the quota of the first Change in each list
+        (which has already been set) to the other objects with setquota -p.
+        When an invocation fails, its objects are set one by one instead.
+        
+        @param changes: List of all the Changes
+        @param prototypes: List of (filesystem, type, indexes) of the Changes
+            with identical limits
+        @param states: List of the states of the Changes
+        """
         types = {'user': '-u', 'group': '-g'}
-        cmd = [SETQUOTA]
+        retry = []
+        chunks = []
+        commands = []
+        for (filesystem, type, indexes) in prototypes:
+            prototype = indexes[0]
+            followers = indexes[1:]
+            if states[prototype] != syspolicy.change.STATE_COMPLETED:
+                retry.extend(followers)
+                continue
+            
+            for n in range(0, len(followers), PROTOTYPE_CHUNK):
+                chunk = followers[n:n + PROTOTYPE_CHUNK]
+                cmd = [SETQUOTA, types[type], '-p', str(changes[prototype].parameters['object'])]
+                cmd.extend([str(changes[i].parameters['object']) for i in chunk])
+                cmd.append(filesystem)
+                chunks.append(chunk)
+                commands.append((cmd, None))
+        
+        results = self.run_commands(commands)
+        for chunk, result in zip(chunks, results):
+            if not isinstance(result, Exception) and result[0] == 0:
+                for i in chunk:
+                    states[i] = syspolicy.change.STATE_COMPLETED
+            else:
+                retry.extend(chunk)
         
-        cmd.append(types[p['type']])            
-        cmd.append(p['object'])
-        cmd.append(str(p.get('block-softlimit', 0)))
-        cmd.append(str(p.get('block-hardlimit', 0)))
-        cmd.append(str(p.get('inode-softlimit', 0)))
-        cmd.append(str(p.get('inode-hardlimit', 0)))
-        cmd.append(p['filesystem'])
+        self.retry_set_quota(changes, retry, states)
+    
+    def retry_set_quota(self, changes, indexes, states):
+        """
+        This function sets the quota of the Changes one by one, with
+        concurrent setquota invocations.
         
-        return self.execute(cmd)
+        @param changes: List of all the Changes
+        @param indexes: Indexes of the set_quota Changes
+        @param states: List of the states of the Changes
+        """
+        commands = [(set_quota_command(changes[i].parameters), None) for i in indexes]
+        for i, state in zip(indexes, self.execute_many(commands)):
+            states[i] = state
+
+class QuotaTable:
+    """
+    This class holds the quota limits of the users or groups on a
+    filesystem, as reported by repquota. The limits are stored in a single
+    array, four values (block soft and hard limit, inode soft and hard
+    limit) per object.
+    """
+    
+    rows = None #: row numbers by the object names
+    limits = None #: array of the limits of all the rows
+    
+    def __init__(self):
+        self.rows = {}
+        self.limits = array('l')
+    
+    def add(self, name, limits):
+        """
+        This function adds the limits of an object.
+        
+        @param name: The name of the user or group
+        @param limits: The block soft, block hard, inode soft and inode
+            hard limits
+        """
+        if name in self.rows:
+            row = self.rows[name]
+            self.limits[row * 4:row * 4 + 4] = array('l', limits)
+        else:
+            self.rows[name] = len(self.rows)
+            self.limits.extend(limits)
+    
+    def get(self, name):
+        """
+        This function returns the limits of an object, the objects without
+        a quota record have no limits.
+        
+        @param name: The name of the user or group
+        @return: Tuple of the block soft, block hard, inode soft and inode
+            hard limits
+        """
+        row = self.rows.get(name)
+        if row is None:
+            return (0, 0, 0, 0)
+        return tuple(self.limits[row * 4:row * 4 + 4])
+    
+    def __len__(self):
+        return len(self.rows)
+
+
+def parse_repquota(text):
+    """
+    This function parses the output of repquota into a QuotaTable. Each
+    report line has the object name, the limit flags, the used blocks,
+    the block limits, the used inodes and the inode limits, with the grace
+    times when they are shown (always with repquota -p).
+    
+    @param text: The output of repquota for one filesystem
+    @return: A QuotaTable
+    """
+    table = QuotaTable()
+    report = False
+    for line in text.splitlines():
+        if line.startswith('---'):
+            report = True
+            continue
+        fields = line.split()
+        if not report or len(fields) < 8:
+            # the header lines and the end of a report
+            if report and not fields:
+                report = False
+            continue
+        if len(fields) == 8:
+            # no grace times are shown
+            numbers = fields[2:8]
+        elif len(fields) == 9 and fields[1][0] == '+':
+            # only the block grace time is shown
+            numbers = fields[2:5] + fields[6:9]
+        elif len(fields) == 9:
+            # only the inode grace time is shown
+            numbers = fields[2:8]
+        else:
+            numbers = fields[2:5] + fields[6:9]
+        try:
+            table.add(fields[0], [int(numbers[1]), int(numbers[2]),
+                                  int(numbers[4]), int(numbers[5])])
+        except ValueError:
+            continue
+    return table
+
+def read_repquota(filesystem, type):
+    """
+    This function reads the current limits on a filesystem with repquota.
+    
+    @param filesystem: The filesystem (mount point)
+    @param type: Type of the quota ('user' or 'group')
+    @return: A QuotaTable or None if repquota fails
+    """
+    types = {'user': '-u', 'group': '-g'}
+    try:
+        p = subprocess.Popen([REPQUOTA, '-p', '-v', types[type], filesystem],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (stdout, stderr) = p.communicate()
+    except OSError:
+        return None
+    if p.returncode != 0:
+        return None
+    return parse_repquota(stdout)
+
+def normalize_quota(quota):
+    """
+    This function normalizes the value of a userquota or groupquota
+    attribute, so that the equivalent quota definitions (eg. 1G and 1024M)
+    compare equal in the policy and its state. The limits of each
+    filesystem are converted to a dictionary of all the LIMITS in
+    kilobytes and inodes.
+    
+    @param quota: Dictionary of mountpoints and their quota definitions
+    @return: Dictionary of mountpoints and their normalized limits
+    """
+    if not is_branch(quota):
+        return quota
+    normalized = {}
+    for fs, limits in quota.items():
+        params = extract_quota(limits)
+        normalized[fs] = dict([(l, params.get(l, 0)) for l in LIMITS])
+    return normalized
+
+def set_quota_command(p):
+    """
+    This function returns the setquota command for the parameters of a
+    set_quota Change.
+    
+    @param p: The parameters of the Change
+    @return: The command with all the arguments as a list
+    """
+    # /usr/sbin/setquota [-u|-g] [-F quotaformat] <user|group>
+    # <block-softlimit> <block-hardlimit> <inode-softlimit> <inode-hardlimit> -a|<filesystem>
+    types = {'user': '-u', 'group': '-g'}
+    cmd = [SETQUOTA]
+    
+    cmd.append(types[p['type']])
+    cmd.append(p['object'])
+    cmd.append(str(p.get('block-softlimit', 0)))
+    cmd.append(str(p.get('block-hardlimit', 0)))
+    cmd.append(str(p.get('inode-softlimit', 0)))
+    cmd.append(str(p.get('inode-hardlimit', 0)))
+    cmd.append(p['filesystem'])
+    return cmd
 
 def extract_quota(limits):
     """
     This function extracts the quota definition from either a string or a list
     and returns a dictionary of detected values, which are directly suitable
-    for passing on to the set_quota operation.
+    for passing on to the set_quota operation. Normalized limits (a
+    dictionary) are returned as they are.
     
     Detected quita formats (given in YAML syntax):
         1. 256M - hard block size limit is set to 256M
@@ -205,6 +612,18 @@ def extract_quota(limits):
     @param limits: The limits' definition (string or list of strings)
     @return: Dictionary of detected values
     """
+    if is_branch(limits):
+        return dict([(l, limits[l]) for l in LIMITS if l in limits])
+    
+    # the same definitions are used by many groups, parse each only once
+    key = limits
+    if type(limits) is list:
+        key = tuple(limits)
+    try:
+        return dict(specs[key])
+    except (KeyError, TypeError):
+        pass
+    
     quota = {}
     if isinstance(limits, str):
         quota['block-hardlimit'] = kilobytes(limits)
@@ -219,7 +638,11 @@ def extract_quota(limits):
             quota['block-hardlimit'] = kilobytes(limits[1])
             quota['inode-softlimit'] = int(limits[2])
             quota['inode-hardlimit'] = int(limits[3])
-    return quota
+    try:
+        specs[key] = quota
+    except TypeError:
+        return quota
+    return dict(quota)
 
 def kilobytes(sizestr):
     """
@@ -230,8 +653,7 @@ def kilobytes(sizestr):
     @return: Integer value in kilobytes
     """
     if isinstance(sizestr, str):
-        units = {'k': 1, 'm': 1024, 'g': 1024*1024, 't': 1024*1024*1024}
-        m = re.match('^([0-9]*)([kmgt]?)$', sizestr.lower())
-        if m and m.group(2) in units:
-            return int(m.group(1)) * units[m.group(2)]
+        m = SIZE_PATTERN.match(sizestr.lower())
+        if m and m.group(2) in UNITS:
+            return int(m.group(1)) * UNITS[m.group(2)]
     return 0
@@ -9,21 +9,34 @@
 Shadow users/passwords configuration support
 """
 
-import pwd, grp
-import copy
+from __future__ import with_statement
+
+import os
+import os.path
+import shutil
+import pwd, grp, spwd
 import datetime
+import threading
 import syspolicy.change
 import syspolicy.event
 from syspolicy.change import Change, ChangeSet
 from syspolicy.config import compare_trees
 from syspolicy.policy import merge_into
 from syspolicy.modules.module import Module
+from syspolicy.modules.filesdb import FilesIndex
+from syspolicy.modules.accountdb import AccountDatabase, allocate_id
 
 USERADD = '/usr/sbin/useradd'
 USERMOD = '/usr/sbin/usermod'
 USERDEL = '/usr/sbin/userdel'
 GROUPADD = '/usr/sbin/groupadd'
 GROUPDEL = '/usr/sbin/groupdel'
+NEWUSERS = '/usr/sbin/newusers'
+CHPASSWD = '/usr/sbin/chpasswd'
+GPASSWD = '/usr/bin/gpasswd'
+
+#: the usermod parameters of mod_user, other than the password and groups
+USERMOD_PARAMETERS = ['name', 'homedir', 'expire', 'inactive', 'group', 'shell']
 
 class Shadow(Module):
     """
@@ -35,10 +48,19 @@ class Shadow(Module):
     real name of the user, account expiration and inactivity periods, groups,
     custom skeleton directories, assigning specific shells and password
     auto-generation combined with strength checking.
+    
+    The Changes are implemented with the shadow utilities (useradd etc.) by
+    default, or natively in batches with an AccountDatabase when the
+    'module-shadow: executor' is set to 'native'.
     """
+    
+    executor = 'tools' #: how the account Changes are implemented
+    root = '/' #: the root directory of the account databases
+    
     def __init__(self):
         Module.__init__(self)
         self.name = "shadow"
+        self.reentrant = True
         self.handled_attributes['groups'] = ['shell', 'inactive']
         self.change_operations['add_user'] = self.add_user
         self.change_operations['mod_user'] = self.mod_user
@@ -66,6 +88,296 @@ class Shadow(Module):
                 cs.merge(self.cs_mod_user(user.pw_name, policy=p))
         return cs
     
+    def setup(self):
+        """
+        This function selects the account lookup backend and the executor
+        according to the main configuration:
+        
+        module-shadow:
+          backend: files (or nss, the default)
+          root: / (the root directory of the account databases)
+          nss-fallback: whether the files backend falls back to NSS
+              for the missing accounts (default: when root is /)
+          executor: native (or tools, the default)
+        """
+        conf = self.pt.conf
+        root = conf.get(['module-shadow', 'root']) or '/'
+        self.root = root
+        if conf.get(['module-shadow', 'executor']) == 'native':
+            self.executor = 'native'
+        
+        if conf.get(['module-shadow', 'backend']) == 'files':
+            nss_fallback = conf.get(['module-shadow', 'nss-fallback'])
+            if nss_fallback is None:
+                nss_fallback = os.path.abspath(root) == '/'
+            set_backend(root, nss_fallback)
+        else:
+            set_backend(None)
+    
+    def begin_plan(self):
+        """
+        This function drops the account index at the beginning of each
+        planning pass, so that the accounts are looked up afresh.
+        """
+        invalidate_index()
+    
+    def change_resources(self, change):
+        """
+        All the account Changes modify the same account databases.
+        """
+        return ['accounts:' + self.root]
+    
+    def perform_change(self, change):
+        """
+        This function implements a Change and drops the account index,
+        as the users and groups may have been modified.
+        
+        @param change: The Change that is to be implemented
+        @return: Returns a state indicatation code or STATE_NOT_HANDLED
+        """
+        if self.executor == 'native':
+            return self.perform_batch([change])[0]
+        try:
+            return Module.perform_change(self, change)
+        finally:
+            invalidate_index()
+    
+    def perform_batch(self, changes):
+        """
+        This function implements a batch of Changes. With the native
+        executor, they are applied in a single transaction to the account
+        databases, otherwise the compatible Changes are coalesced into
+        batch invocations of the shadow utilities.
+        
+        @param changes: List of Changes that are to be implemented
+        @return: List of state indication codes
+        """
+        if self.executor != 'native' and len(changes) < 2:
+            return Module.perform_batch(self, changes)
+        try:
+            if self.executor == 'native':
+                return AccountDatabase(self.root, self.pt.debug).apply(changes)
+            return self.perform_coalesced(changes)
+        finally:
+            invalidate_index()
+    
+    def perform_coalesced(self, changes):
+        """
+        This function implements a batch of Changes with the shadow
+        utilities, coalescing the compatible Changes:
+        
+        - new users are created with a single newusers invocation
+        - passwords are set with a single chpasswd -e invocation
+        - group memberships are set with one gpasswd -M per group
+        
+        The other Changes (and the other parameters of mod_user) are
+        implemented one by one, before the batch invocations. When a batch
+        invocation fails, its Changes are implemented one by one instead.
+        
+        @param changes: List of Changes that are to be implemented
+        @return: List of state indication codes
+        """
+        # the Changes can only be reordered when each account appears once
+        accounts = set()
+        for c in changes:
+            if c.operation in ['add_user', 'mod_user', 'del_user']:
+                account = c.parameters['username']
+            else:
+                account = ':' + str(c.parameters.get('group'))
+            if account in accounts:
+                return Module.perform_batch(self, changes)
+            accounts.add(account)
+        
+        states = [None] * len(changes)
+        adds = [] #: indexes of the add_user Changes for newusers
+        passwords = [] #: (index, username, password) for chpasswd
+        members = [] #: (index, username, groups, replace) for gpasswd
+        
+        for i, c in enumerate(changes):
+            p = c.parameters
+            if c.operation == 'add_user' and can_coalesce_user(p):
+                adds.append(i)
+            elif c.operation == 'mod_user':
+                # implement the other parameters with usermod first
+                rest = dict([(k, v) for k, v in p.items()
+                             if k not in ['password', 'extragroups']])
+                if [k for k in USERMOD_PARAMETERS if k in rest]:
+                    states[i] = self.perform_single(Change(self.name, 'mod_user', rest))
+                    if states[i] == syspolicy.change.STATE_FAILED:
+                        continue
+                if 'password' in p and p['password'] is not None:
+                    passwords.append((i, p['username'], p['password']))
+                if 'extragroups' in p and p['extragroups']:
+                    members.append((i, p['username'], p['extragroups'], True))
+                states[i] = syspolicy.change.STATE_COMPLETED
+            else:
+                states[i] = self.perform_single(c)
+        
+        if adds:
+            invalidate_index()
+            self.batch_add_users(changes, adds, states, members)
+        if passwords:
+            self.batch_passwords(changes, passwords, states)
+        if members:
+            invalidate_index()
+            self.batch_members(members, states)
+        return states
+    
+    def perform_single(self, change):
+        """
+        This function implements a single Change with the per-command path.
+        
+        @return: A state indication code
+        """
+        try:
+            return Module.perform_change(self, change)
+        except Exception, inst:
+            print "Module", self.name, "encountered an exception while processing Change", change, "\n", inst
+            return syspolicy.change.STATE_FAILED
+    
+    def batch_add_users(self, changes, adds, states, members):
+        """
+        This function creates the users of the add_user Changes with
+        newusers. The UIDs are allocated here from the range of the group
+        policy, and the skeleton directory is copied here, as newusers
+        doesn't do that. The supplementary groups are added to `members`.
+        
+        @param changes: List of all the Changes
+        @param adds: Indexes of the add_user Changes
+        @param states: List of the states of the Changes
+        @param members: List of the group membership edits
+        """
+        lines = []
+        batch = [] #: (index, uid, new home) of the Changes in newusers
+        used = set([u.pw_uid for u in list_users()])
+        cursors = {}
+        for i in adds:
+            p = changes[i].parameters
+            # the invalid Changes fail with the per-command path
+            if not group_exists(p['group']) or user_exists(p['username']):
+                states[i] = self.perform_single(changes[i])
+                continue
+            uid = allocate_id(int(p['uid_min']), int(p['uid_max']), used, cursors)
+            if uid is None:
+                states[i] = self.perform_single(changes[i])
+                continue
+            used.add(uid)
+            
+            fields = [p['username'], p.get('password') or '!', str(uid), p['group'],
+                      p.get('name') or '', p['homedir'], p['shell']]
+            if [f for f in fields if ':' in f or '\n' in f]:
+                states[i] = self.perform_single(changes[i])
+                continue
+            lines.append(':'.join(fields) + '\n')
+            batch.append((i, uid, not os.path.exists(p['homedir'])))
+        
+        if not batch:
+            return
+        
+        # the passwords are already encrypted, so they are stored as they are
+        try:
+            state = self.execute([NEWUSERS, '--crypt-method', 'NONE'], ''.join(lines))
+        except Exception, inst:
+            print "Creating users with newusers failed:", inst
+            state = syspolicy.change.STATE_FAILED
+        invalidate_index()
+        
+        for (i, uid, new_home) in batch:
+            p = changes[i].parameters
+            if state != syspolicy.change.STATE_COMPLETED:
+                # fall back to useradd
+                states[i] = self.perform_single(changes[i])
+                continue
+            if not self.pt.debug:
+                # verify that the user was created
+                if not user_exists(p['username']):
+                    states[i] = syspolicy.change.STATE_FAILED
+                    continue
+                if new_home and p.get('skeleton'):
+                    copy_skeleton(p['skeleton'], p['homedir'], uid,
+                                  get_group_by_name(p['group']).gr_gid)
+            states[i] = syspolicy.change.STATE_COMPLETED
+            if p.get('extragroups'):
+                members.append((i, p['username'], p['extragroups'], False))
+    
+    def batch_passwords(self, changes, passwords, states):
+        """
+        This function sets the encrypted passwords with chpasswd -e.
+        
+        @param changes: List of all the Changes
+        @param passwords: List of (index, username, password)
+        @param states: List of the states of the Changes
+        """
+        lines = ''.join(['%s:%s\n' % (username, password)
+                         for (i, username, password) in passwords])
+        try:
+            state = self.execute([CHPASSWD, '-e'], lines)
+        except Exception, inst:
+            print "Setting passwords with chpasswd failed:", inst
+            state = syspolicy.change.STATE_FAILED
+        
+        if state != syspolicy.change.STATE_COMPLETED:
+            # fall back to usermod
+            for (i, username, password) in passwords:
+                states[i] = self.perform_single(Change(self.name, 'mod_user',
+                                    {'username': username, 'password': password}))
+    
+    def batch_members(self, members, states):
+        """
+        This function sets the supplementary group memberships with one
+        gpasswd -M invocation for each modified group.
+        
+        @param members: List of (index, username, groups, replace), where
+            `replace` means that the user is removed from the other groups
+        @param states: List of the states of the Changes
+        """
+        current = {} #: original member lists of the groups
+        final = {} #: new member lists of the groups
+        depends = {} #: the groups each Change depends on
+        memberships = None #: supplementary groups by user name
+        
+        for (i, username, groups, replace) in members:
+            missing = [g for g in groups if not group_exists(g)]
+            if missing:
+                print "Group", missing[0], "does not exist"
+                states[i] = syspolicy.change.STATE_FAILED
+                continue
+            
+            touched = set(groups)
+            if replace:
+                if memberships is None:
+                    memberships = {}
+                    for g in list_groups():
+                        for m in g.gr_mem:
+                            memberships.setdefault(m, []).append(g.gr_name)
+                touched.update(memberships.get(username, []))
+            
+            for g in touched:
+                if g not in final:
+                    current[g] = list_group_members(g)
+                    final[g] = list(current[g])
+                if g in groups and username not in final[g]:
+                    final[g].append(username)
+                elif g not in groups and username in final[g]:
+                    final[g].remove(username)
+            depends[i] = touched
+        
+        failed = set()
+        for g in sorted(final):
+            if final[g] == current[g]:
+                continue
+            try:
+                state = self.execute([GPASSWD, '-M', ','.join(final[g]), g])
+            except Exception, inst:
+                print "Setting the members of", g, "with gpasswd failed:", inst
+                state = syspolicy.change.STATE_FAILED
+            if state != syspolicy.change.STATE_COMPLETED:
+                failed.add(g)
+        
+        for i, touched in depends.items():
+            if touched & failed:
+                states[i] = syspolicy.change.STATE_FAILED
+    
     def cs_add_user(self, username, group, password, extragroups=[],
                     name=None, homedir=None, policy={}):
         """
@@ -83,8 +395,8 @@ class Shadow(Module):
         @param policy: Additional parameters that override the group policy
         @return: A ChangeSet
         """
-        # create a copy of the group policy so it can be safely edited
-        upolicy = copy.deepcopy(self.pt.policy['groups'].get([group]))
+        # create a shallow copy of the group policy so it can be safely edited
+        upolicy = dict(self.pt.policy['groups'].get([group]))
         # place the given arguments into a policy dictionary
         args = {'username': username, 'group': group, 'name': name,
                 'extragroups': extragroups, 'homedir': homedir, 'password': password}
@@ -173,7 +485,7 @@ class Shadow(Module):
         # retrieve information about the users current group
         gid = get_user_by_name(username).pw_gid
         group = get_group_by_id(gid).gr_name
-        gpolicy = copy.deepcopy(self.pt.policy['groups'].get([group]))
+        gpolicy = dict(self.pt.policy['groups'].get([group]))
         
         # prepare the arguments
         args = {'username': username, 'group': group}
@@ -192,7 +504,7 @@ class Shadow(Module):
         @param group: The name of the new group
         @return: A ChangeSet
         """
-        gpolicy = copy.deepcopy(self.pt.policy['groups'].get([group]))
+        gpolicy = dict(self.pt.policy['groups'].get([group]))
         args = merge_into(gpolicy, {'group': group})
         
         cs = ChangeSet(Change(self.name, "add_group", args))
@@ -207,7 +519,7 @@ class Shadow(Module):
         @param group: The name of the group to be removed
         @return: A ChangeSet
         """
-        gpolicy = copy.deepcopy(self.pt.policy['groups'].get([group]))
+        gpolicy = dict(self.pt.policy['groups'].get([group]))
         args = merge_into(gpolicy, {'group': group})
         
         cs = ChangeSet(Change(self.name, "del_group", args))
@@ -356,13 +668,165 @@ class Shadow(Module):
         return policy
 
 
+class AccountIndex:
+    """
+    This class is an in-memory snapshot of the system users and groups.
+    
+    The users and groups are enumerated once through NSS when the index
+    is built and are then looked up by name or id without further NSS
+    calls. The files backend (filesdb.FilesIndex) provides the same lookups.
+    """
+    
+    all_users = None #: list of all the users
+    all_groups = None #: list of all the groups
+    users_by_name = None #: users by the user name
+    users_by_uid = None #: users by the UID
+    groups_by_name = None #: groups by the group name
+    groups_by_gid = None #: groups by the GID
+    primary_members = None #: users by their primary GID
+    members = None #: user names by their supplementary group names
+    
+    def __init__(self):
+        """
+        Build the index from the system user and group databases.
+        """
+        self.all_users = pwd.getpwall()
+        self.all_groups = grp.getgrall()
+        self.users_by_name = {}
+        self.users_by_uid = {}
+        self.groups_by_name = {}
+        self.groups_by_gid = {}
+        self.primary_members = {}
+        self.members = {}
+        
+        # the first entry wins for duplicate names and ids, like in NSS
+        for u in self.all_users:
+            self.users_by_name.setdefault(u.pw_name, u)
+            self.users_by_uid.setdefault(u.pw_uid, u)
+            self.primary_members.setdefault(u.pw_gid, []).append(u)
+        for g in self.all_groups:
+            self.groups_by_name.setdefault(g.gr_name, g)
+            self.groups_by_gid.setdefault(g.gr_gid, g)
+            self.members.setdefault(g.gr_name, []).extend(g.gr_mem)
+    
+    def users(self):
+        """
+        @return: List of all the users
+        """
+        return self.all_users
+    
+    def groups(self):
+        """
+        @return: List of all the groups
+        """
+        return self.all_groups
+    
+    def user_by_name(self, name):
+        """
+        @return: The user named `name`
+        """
+        try:
+            return self.users_by_name[name]
+        except KeyError:
+            raise KeyError('getpwnam(): name not found: ' + name)
+    
+    def user_by_uid(self, uid):
+        """
+        @return: The user with the UID `uid`
+        """
+        try:
+            return self.users_by_uid[uid]
+        except KeyError:
+            raise KeyError('getpwuid(): uid not found: ' + str(uid))
+    
+    def group_by_name(self, name):
+        """
+        @return: The group named `name`
+        """
+        try:
+            return self.groups_by_name[name]
+        except KeyError:
+            raise KeyError('getgrnam(): name not found: ' + name)
+    
+    def group_by_gid(self, gid):
+        """
+        @return: The group with the GID `gid`
+        """
+        try:
+            return self.groups_by_gid[gid]
+        except KeyError:
+            raise KeyError('getgrgid(): gid not found: ' + str(gid))
+    
+    def shadow_by_name(self, name):
+        """
+        @return: The shadow password entry of the user named `name`
+        """
+        return spwd.getspnam(name)
+    
+    def users_with_gid(self, gid):
+        """
+        @return: List of the users with the primary GID `gid`
+        """
+        return list(self.primary_members.get(gid, []))
+    
+    def group_members(self, name):
+        """
+        @return: List of the supplementary members of the group `name`
+        """
+        return list(self.members.get(name, []))
+
+
+index = None #: the current account index, built when it is first needed
+index_lock = threading.Lock() #: lock for building the account index
+backend = None #: the files backend root directory, or None for NSS
+fallback = True #: whether the files backend falls back to NSS
+
+def set_backend(root=None, nss_fallback=True):
+    """
+    This function selects the source of the account index. By default, the
+    accounts are enumerated through NSS. When `root` is given, the passwd,
+    group and shadow files under `root` are read directly instead.
+    
+    @param root: The root directory of the account databases (optional)
+    @param nss_fallback: Whether to look up missing accounts through NSS
+    """
+    global backend, fallback
+    backend = root
+    fallback = nss_fallback
+    invalidate_index()
+
+def get_index():
+    """
+    This function returns the current account index, building it if
+    it doesn't exist yet.
+    
+    @return: An AccountIndex or a FilesIndex
+    """
+    global index
+    with index_lock:
+        if index is None:
+            if backend is None:
+                index = AccountIndex()
+            else:
+                index = FilesIndex(backend, fallback)
+        return index
+
+def invalidate_index():
+    """
+    This function drops the current account index, so that it will be
+    rebuilt on the next lookup.
+    """
+    global index
+    with index_lock:
+        index = None
+
 def list_groups():
     """
     This function lists all the groups in the system.
     
     @return: List of existing groups
     """
-    return grp.getgrall()
+    return get_index().groups()
 
 def list_users():
     """
@@ -370,7 +834,7 @@ def list_users():
     
     @return: List of existing users
     """
-    return pwd.getpwall()
+    return get_index().users()
 
 def get_group_by_id(id):
     """
@@ -378,7 +842,7 @@ def get_group_by_id(id):
     
     @return: Shadow group with the GID `id`
     """
-    return grp.getgrgid(id)
+    return get_index().group_by_gid(id)
 
 def get_group_by_name(name):
     """
@@ -386,7 +850,7 @@ def get_group_by_name(name):
     
     @return: Shadow group with the name `name`
     """
-    return grp.getgrnam(name)
+    return get_index().group_by_name(name)
 
 def group_exists(name):
     """
@@ -394,7 +858,11 @@ def group_exists(name):
     
     @return: True if the grup exists, False otherwise
     """
-    return grp.getgrnam(name) is not None
+    try:
+        get_index().group_by_name(name)
+    except KeyError:
+        return False
+    return True
 
 def get_user_by_name(name):
     """
@@ -402,7 +870,35 @@ def get_user_by_name(name):
     
     @return: Shadow user with the name `name`
     """
-    return pwd.getpwnam(name)
+    return get_index().user_by_name(name)
+
+def get_user_by_id(id):
+    """
+    This function gets a user by it's UID.
+    
+    @return: Shadow user with the UID `id`
+    """
+    return get_index().user_by_uid(id)
+
+def get_shadow_by_name(name):
+    """
+    This function gets the shadow password entry of a user by it's name.
+    
+    @return: Shadow password entry of the user `name`
+    """
+    return get_index().shadow_by_name(name)
+
+def user_exists(name):
+    """
+    This function checks if a user with the name `name` exists.
+    
+    @return: True if the user exists, False otherwise
+    """
+    try:
+        get_index().user_by_name(name)
+    except KeyError:
+        return False
+    return True
 
 def list_users_with_gid(gid):
     """
@@ -410,8 +906,55 @@ def list_users_with_gid(gid):
     
     @return: List of shadow users
     """
-    users = []
-    for u in list_users():
-        if u.pw_gid == gid:
-            users.append(u)
-    return users
+    return get_index().users_with_gid(gid)
+
+def list_group_members(name):
+    """
+    This function lists the users that are supplementary members of the
+    group `name`.
+    
+    @return: List of user names
+    """
+    return get_index().group_members(name)
+
+def can_coalesce_user(p):
+    """
+    This function checks whether an add_user Change can be implemented
+    with newusers. This is not the case when the account expiration or
+    inactivity period is set, or the home directory must not be created.
+    
+    @param p: The parameters of the add_user Change
+    @return: True if the Change can be coalesced
+    """
+    if not p.get('create_homedir'):
+        return False
+    if p.get('expire') is not None and p['expire'] > 0:
+        return False
+    if p.get('inactive') is not None and p['inactive'] >= 0:
+        return False
+    return True
+
+def copy_skeleton(skeleton, homedir, uid, gid):
+    """
+    This function copies the contents of the skeleton directory to a new
+    home directory and gives them to the user.
+    
+    @param skeleton: The skeleton directory
+    @param homedir: The home directory
+    @param uid: The UID of the owner
+    @param gid: The GID of the owner
+    """
+    if not os.path.isdir(skeleton) or not os.path.isdir(homedir):
+        return
+    for name in os.listdir(skeleton):
+        src = os.path.join(skeleton, name)
+        dst = os.path.join(homedir, name)
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dst)
+        elif os.path.isdir(src):
+            shutil.copytree(src, dst, symlinks=True)
+        else:
+            shutil.copy2(src, dst)
+    for (dirpath, dirnames, filenames) in os.walk(homedir):
+        for name in dirnames + filenames:
+            os.lchown(os.path.join(dirpath, name), uid, gid)
@@ -22,6 +22,7 @@ class State(Module):
     def __init__(self):
         Module.__init__(self)
         self.name = "state"
+        self.reentrant = True
         self.change_operations['set_state'] = self.set_state
     
     def cs_check_diff(self, policy, operation, path, value, diff):
@@ -50,10 +51,10 @@ class State(Module):
         value = p['value']
         
         if diff_type in [syspolicy.config.CONFIG_ADDED, syspolicy.config.CONFIG_CHANGED]:
-            self.pt.set_state(policy, path, value)
+            self.pt.set_state(policy, path, value, diff_type)
             return syspolicy.change.STATE_COMPLETED
         elif diff_type in [syspolicy.config.CONFIG_REMOVED]:
-            self.pt.set_state(policy, path, None)
+            self.pt.set_state(policy, path, None, diff_type)
             return syspolicy.change.STATE_COMPLETED
         
         return syspolicy.change.STATE_FAILED
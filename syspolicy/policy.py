@@ -9,24 +9,72 @@
 Policy class for handling policies
 """
 
+from __future__ import with_statement
+
+import os
+import os.path
 import copy
-from syspolicy.config import Config, DEFAULT
+import yaml
+import threading
+import multiprocessing
+from collections import Mapping
+import syspolicy.config
+from syspolicy.config import Config, DEFAULT, is_branch, set_branch, refresh_digest
+from syspolicy.config import load_yaml, compare_trees, iter_diff, LIST_REPLACE
+
+SHARD_SUFFIX = '.yaml' #: suffix of the policy files in a sharded policy directory
+SHARD_POOL_MIN = 32 #: minimum number of shards to be parsed with a process pool
 
 class Policy(Config):
     """
     This class extends the Config class to provide the policy functionality and
     meaning over a regular constant configuration object. This means that
     all the subsections are always expanded with the values from the default
-    section recursively upon loading the policy.
+    section recursively upon loading the policy. The expansion is done with
+    read-only PolicyView layers, so the default values are not copied into
+    each subsection.
     
     Secondly, the get() function has been overridden so that the default value
     is returned if the specified subsection or attribute doesn't exist. The 
     purpose of this behaviour is to always provide new groups with the default
     policy.
+    
+    The policy can also be loaded from a directory, where each subsection
+    is kept in a separate file named <section>.yaml (a shard). The shards
+    are indexed when the policy is loaded, but parsed only when they are
+    first accessed. When a manifest file is given, the modification times
+    of the shards that have been applied to the state are recorded there,
+    so that the unmodified shards can be skipped by compare_to().
     """
     
-    def __init__(self, name, source=None, load=True, merge_default=False):
-        Config.__init__(self, name, source, load=False)
+    merge_default = False #: whether the default values are merged on load
+    resolved = None #: cache of the values returned by get() by path
+    cache_hits = 0 #: number of get() calls answered from the cache
+    cache_misses = 0 #: number of get() calls that had to resolve the value
+    
+    shards = None #: shard file names by section (sharded policies only)
+    shard_mtimes = None #: modification times of the shards by section
+    unloaded = None #: sections whose shards have not been parsed yet
+    workers = None #: number of processes for parsing shards (default: CPUs)
+    manifest = None #: Config with the shard mtimes of the applied state
+    shard_lock = None #: lock for loading the shards from concurrent threads
+    normalizers = None #: functions normalizing the attribute values by attribute
+    
+    def __init__(self, name, source=None, load=True, merge_default=False,
+                 cache=False, manifest=None, workers=None):
+        self.resolved = {}
+        self.normalizers = {}
+        self.shards = {}
+        self.shard_mtimes = {}
+        self.unloaded = set()
+        self.workers = workers
+        self.shard_lock = threading.RLock()
+        if manifest is not None:
+            try:
+                self.manifest = Config(name + "_manifest", manifest, cache=cache)
+            except IOError:
+                self.manifest = Config(name + "_manifest", manifest, load=False)
+        Config.__init__(self, name, source, load=False, cache=cache)
         if load and source:
             self.load(source, merge_default)
     
@@ -36,24 +84,374 @@ class Policy(Config):
         `merge_default` is set to True, merges the default values
         into all the subsections as well.
         
+        If `configfile` is a directory, the shards in it are indexed and
+        the default section is loaded.
+        
         @param merge_default: Whether or not to merge the default values
         """
-        Config.load(self, configfile)
+        self.merge_default = merge_default
+        if configfile is None:
+            configfile = self.source
+        self.shards = {}
+        self.shard_mtimes = {}
+        self.unloaded = set()
+        if configfile is None or not os.path.isdir(configfile):
+            return Config.load(self, configfile)
+        
+        # index the shards in the directory
+        for filename in os.listdir(configfile):
+            if filename.endswith(SHARD_SUFFIX) and not filename.startswith('.'):
+                section = filename[:-len(SHARD_SUFFIX)]
+                path = os.path.join(configfile, filename)
+                self.shards[section] = path
+                self.shard_mtimes[section] = os.path.getmtime(path)
+        
+        # load the default section right away, others will be loaded lazily
+        self.data = {}
+        if DEFAULT in self.shards:
+            default = load_yaml(self.shards[DEFAULT], self.cache)
+            if type(default) is dict:
+                self.data[DEFAULT] = default
+        self.unloaded = set(self.shards.keys()) - set([DEFAULT])
+        self.loaded()
+        return True
+    
+    def load_shards(self, sections):
+        """
+        This function parses the shards of the given sections, if they have
+        not been loaded yet. When there are many shards to be parsed, they
+        are parsed in parallel using a pool of processes, but only while
+        this is the only thread of the process: forking a process while
+        other threads may hold locks can deadlock the pool, so then the
+        shards are parsed one by one.
+        
+        @param sections: List of section names
+        """
+        with self.shard_lock:
+            self._load_shards(sections)
+    
+    def _load_shards(self, sections):
+        """
+        This function implements load_shards(), the lock must already be held.
+        """
+        sections = [s for s in sections if s in self.unloaded]
+        if not sections:
+            return
+        
+        args = [(self.shards[s], self.cache) for s in sections]
+        workers = self.workers or multiprocessing.cpu_count()
+        if len(sections) >= SHARD_POOL_MIN and workers > 1 and threading.active_count() == 1:
+            pool = multiprocessing.Pool(workers)
+            try:
+                results = pool.map(load_shard, args, chunksize=16)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(load_shard, args)
+        
+        for section, data in zip(sections, results):
+            # the section is only marked loaded when its data is in place
+            if data is not None:
+                self.data[section] = data
+                self.normalize([section])
+                if self.merge_default:
+                    self.layer_section(section)
+                self.digest = refresh_digest(self.digest, self.data, [section])
+            self.unloaded.discard(section)
+        self.resolved.clear()
+    
+    def load_all(self, skip=()):
+        """
+        This function parses all the shards that have not been loaded yet.
+        
+        @param skip: Sections which are not to be loaded
+        """
+        self.load_shards([s for s in self.unloaded if s not in skip])
+    
+    def sections(self):
+        """
+        This function returns a list of sections present in the policy,
+        including the ones that have not been loaded yet.
+        """
+        return list(set(self.data.keys()) | self.unloaded)
+    
+    def attributes(self, section=DEFAULT):
+        """
+        This function returns a list of attributes in section `section`.
+        """
+        self.load_shards([section])
+        return Config.attributes(self, section)
+    
+    def get_branch(self, path=[]):
+        """
+        This function returns a policy tree branch at `path`, loading the
+        shard of the section first, if needed.
+        """
+        if type(path) is list and path and path[0] in self.unloaded:
+            self.load_shards([path[0]])
+        return Config.get_branch(self, path)
+    
+    def unchanged_shards(self, other_config):
+        """
+        This function returns the sections whose shards have not been
+        modified since they were last applied to `other_config` (the state),
+        according to the manifest.
+        
+        @param other_config: The state of this policy
+        @return: A set of section names
+        """
+        if self.manifest is None or not self.shards:
+            return set()
+        applied = self.manifest.data
+        
+        # any change in the defaults affects all the sections
+        if applied.get(DEFAULT) != self.shard_mtimes.get(DEFAULT):
+            return set()
+        
+        unchanged = set()
+        for section in self.unloaded:
+            if section in applied and applied[section] == self.shard_mtimes[section] \
+                    and section in other_config.data:
+                unchanged.add(section)
+        return unchanged
+    
+    def record_applied(self, other_config):
+        """
+        This function records the modification times of the loaded shards
+        whose contents match `other_config` (the state) in the manifest and
+        saves it. The shards that were skipped keep their earlier records.
+        
+        @param other_config: The state of this policy
+        """
+        if self.manifest is None or not self.shards:
+            return
+        applied = {}
+        for section, mtime in self.manifest.data.items():
+            if section in self.unloaded:
+                applied[section] = mtime
+        
+        for section in self.shards:
+            if section in self.unloaded:
+                continue
+            if section == DEFAULT:
+                a = self.data.get(DEFAULT, {})
+                b = other_config.data.get(DEFAULT, {})
+            elif section in self.data and section in other_config.data:
+                a = self.data[section]
+                b = other_config.data[section]
+            else:
+                continue
+            if is_branch(a) and is_branch(b):
+                a_digest = self.digest.child(section)
+                b_digest = other_config.digest.child(section)
+                if not compare_trees(a, b, a_digest, b_digest):
+                    applied[section] = self.shard_mtimes[section]
+        
+        self.manifest.data = applied
+        self.manifest.save()
+    
+    def compare_to(self, other_config, lists=LIST_REPLACE):
+        """
+        This function compares this Policy to another Config, loading all
+        the shards that have been modified since they were last applied.
+        Sections with unmodified shards are left out of the comparison.
+        
+        @param other_config: An other Config (or it's subclass) element
+        @param lists: How the changed lists are reported
+        @return: A dictionary tree of differences
+        """
+        if not isinstance(other_config, Config):
+            return None
+        return compare_trees(self.data, self.diff_base(other_config),
+                             self.digest, other_config.digest, lists)
+    
+    def iter_diff(self, other_config, lists=LIST_REPLACE, depth=None):
+        """
+        This function compares this Policy to another Config and yields
+        the differences one by one, skipping the unmodified shards just
+        like compare_to() does.
+        
+        @param other_config: An other Config (or it's subclass) element
+        @param lists: How the changed lists are reported
+        @param depth: The depth at which the differences are reported
+        @return: A generator of DiffRecords
+        """
+        return iter_diff(self.data, self.diff_base(other_config),
+                         self.digest, other_config.digest, lists, depth)
+    
+    def diff_base(self, other_config):
+        """
+        This function prepares the policy for a comparison with `other_config`
+        by loading the modified shards, and returns the data of `other_config`
+        without the sections whose shards were not modified.
+        
+        @param other_config: An other Config (or it's subclass) element
+        @return: The dictionary tree to compare this policy with
+        """
+        if not self.shards:
+            return other_config.data
+        
+        skip = self.unchanged_shards(other_config)
+        self.load_all(skip)
+        if skip:
+            return dict([(k, v) for k, v in other_config.data.items() if k not in skip])
+        return other_config.data
+    
+    def loaded(self):
+        """
+        This function post-processes freshly loaded policy data, merging
+        the default values into the subsections when requested, and then
+        computes the digest tree of the result.
+        """
+        self.normalize(self.data.keys())
+        # If merge_default is True, layer the subsections on top of
+        # the default section
+        if self.merge_default:
+            self.layer_default()
+        self.rehash()
+        self.resolved.clear()
+    
+    def add_normalizer(self, attribute, function):
+        """
+        This function registers a function that converts the values of
+        `attribute` into a canonical form, so that equivalent values
+        compare equal. The sections that are already loaded are normalized
+        right away, the others when they are loaded.
+        
+        @param attribute: The name of the attribute
+        @param function: Function taking the value and returning the
+            normalized value
+        """
+        self.normalizers[attribute] = function
+        if self.normalize(self.data.keys(), [attribute]):
+            self.rehash()
+            self.resolved.clear()
+    
+    def normalize(self, sections, attributes=None):
+        """
+        This function normalizes the values of the attributes with a
+        registered normalizer in the given sections.
+        
+        @param sections: List of section names
+        @param attributes: List of attribute names (default: all registered)
+        @return: True if any value was normalized
+        """
+        if not self.normalizers:
+            return False
+        if attributes is None:
+            attributes = self.normalizers.keys()
+        
+        changed = False
+        for section in sections:
+            branch = self.data.get(section)
+            # only the section's own values are normalized, not the defaults
+            if isinstance(branch, PolicyView):
+                branch = branch.overlay
+            if type(branch) is not dict:
+                continue
+            for attribute in attributes:
+                if attribute in branch:
+                    branch[attribute] = self.normalizers[attribute](branch[attribute])
+                    changed = True
+        return changed
+    
+    def clear(self):
+        """
+        This function clears the data of this Policy
+        """
+        Config.clear(self)
+        self.resolved.clear()
+    
+    def layer_default(self):
+        """
+        This function layers all the subsections of the policy on top of
+        the current default section using PolicyViews.
+        """
+        for section in self.data.keys():
+            self.layer_section(section)
+    
+    def layer_section(self, section):
+        """
+        This function layers a subsection of the policy on top of the
+        current default section using a PolicyView.
+        
+        @param section: The name of the subsection
+        """
+        if section == DEFAULT:
+            return
+        default = self.data.get(DEFAULT)
+        if type(default) is not dict:
+            default = {}
         
-        # If merge_default is True and we have a default section,
-        # merge it's contents into other sections as well
-        if merge_default and DEFAULT in self.data.keys():
-            for section in set(self.data.keys()) - set([DEFAULT]):
-                if type(self.data[section]) is dict:
-                    self.data[section] = merge_into(
-                                       copy.deepcopy(self.data[DEFAULT]),
-                                       self.data[section])
+        branch = self.data[section]
+        if isinstance(branch, PolicyView):
+            branch.base = default
+        elif type(branch) is dict:
+            self.data[section] = PolicyView(default, branch)
+    
+    def set(self, path, value):
+        """
+        This function sets a policy attribute at `path` to `value`.
+        
+        When the default values have been merged, the value is set in the
+        overriding layer of the subsection, and removing an attribute
+        from a subsection makes the default value visible again.
+        
+        @param path: The path to the attribute that is to be set to `value`
+        @param value: The new value for the attribute at `path`
+        @return: True if the operation was successful
+        """
+        self.resolved.clear()
+        if not self.merge_default or type(path) is not list or not path:
+            return Config.set(self, path, value)
+        
+        section = path[0]
+        self.load_shards([section])
+        if section == DEFAULT:
+            # the default values are visible in all the subsections
+            Config.set(self, path, value)
+            self.layer_default()
+            self.rehash()
+        elif len(path) > 1 and isinstance(self.data.get(section), PolicyView):
+            # set the value in the overriding layer of the subsection
+            set_branch(self.data[section].overlay, path[1:], value)
+            self.digest = refresh_digest(self.digest, self.data, list(path))
+        else:
+            Config.set(self, path, value)
+            if type(self.data.get(section)) is dict:
+                self.layer_section(section)
+                self.digest = refresh_digest(self.digest, self.data, [section])
+        return True
     
     def get(self, path=[]):
         """
         This returns the policy data branch at `path` or if it doesn't exist,
         it returns the default value. If the value is a dictionary, it also
         merges in the default values for that attribute.
+        
+        The resolved values are cached until the policy is modified.
+        Dictionaries are returned as read-only PolicyViews, which the callers
+        don't need to copy, and lists as copies (see detach), so that the
+        callers can't modify the cache or the policy.
+        """
+        if type(path) is not list:
+            return detach(self.resolve(path))
+        
+        key = tuple(path)
+        if key in self.resolved:
+            self.cache_hits += 1
+            return detach(self.resolved[key])
+        
+        self.cache_misses += 1
+        val = self.resolve(path)
+        self.resolved[key] = val
+        return detach(val)
+    
+    def resolve(self, path=[]):
+        """
+        This function resolves the effective value at `path` for get(),
+        bypassing the cache.
         """
         val = self.get_branch(path)
         
@@ -63,12 +461,112 @@ class Policy(Config):
             
             if val is None and defval is not None:
                 val = defval
-            elif type(val) is dict and type(defval) is dict:
-                val = merge_into(copy.deepcopy(defval), val)
+            elif is_branch(val) and is_branch(defval) and val is not defval \
+                    and not isinstance(val, PolicyView):
+                val = PolicyView(defval, val)
         
+        # dictionaries are only returned as read-only views
+        if type(val) is dict:
+            val = PolicyView({}, val)
         return val
 
 
+class PolicyView(Mapping):
+    """
+    This class is a read-only, layered view of two dictionary trees. The
+    keys of the `overlay` tree override the ones in the `base` tree, and
+    where both trees contain a dictionary, they are layered recursively,
+    just like merge_into() would merge them.
+    
+    Nothing is copied when a view is created. The lists in the view are
+    returned as copies (see detach). A deep copy of a view is a plain
+    dictionary tree that can be modified freely.
+    """
+    __slots__ = ('base', 'overlay')
+    
+    def __init__(self, base, overlay):
+        self.base = base #: the underlying dictionary
+        self.overlay = overlay #: the dictionary with the overriding values
+    
+    def __getitem__(self, key):
+        if key in self.overlay:
+            item = self.overlay[key]
+            if is_branch(item):
+                base = self.base.get(key)
+                if not is_branch(base):
+                    base = {}
+                return PolicyView(base, item)
+            return detach(item)
+        
+        item = self.base[key]
+        if is_branch(item):
+            return PolicyView(item, {})
+        return detach(item)
+    
+    def __contains__(self, key):
+        return key in self.overlay or key in self.base
+    
+    def __iter__(self):
+        for key in self.overlay:
+            yield key
+        for key in self.base:
+            if key not in self.overlay:
+                yield key
+    
+    def __len__(self):
+        return len(self.overlay) + len([k for k in self.base if k not in self.overlay])
+    
+    def __repr__(self):
+        return repr(dict(self.items()))
+    
+    def __copy__(self):
+        return dict(self.items())
+    
+    def __deepcopy__(self, memo):
+        result = {}
+        for key, item in self.items():
+            result[key] = copy.deepcopy(item, memo)
+        return result
+
+
+def detach(value):
+    """
+    This function returns a copy of a list value of a policy, so that the
+    caller can modify it without affecting the policy data. The other
+    values are returned as they are, the dictionaries being read-only
+    PolicyViews and the scalars immutable.
+    
+    @param value: A value of the policy
+    @return: The value or a deep copy of the list
+    """
+    if type(value) is list:
+        # only the nested lists and dictionaries need to be copied deeply
+        return [copy.deepcopy(v) if type(v) is list or is_branch(v) else v for v in value]
+    return value
+
+def load_shard(args):
+    """
+    This function parses a policy shard file. It is defined at the module
+    level, so that it can be called in the worker processes of a pool.
+    
+    @param args: Tuple of the shard file name and the cache flag
+    @return: The section data or None if the shard doesn't contain a dictionary
+    """
+    data = load_yaml(*args)
+    if type(data) is dict:
+        return data
+    return None
+
+def represent_view(dumper, view):
+    """
+    This function represents PolicyViews as regular mappings in YAML.
+    """
+    return dumper.represent_dict(copy.deepcopy(view))
+
+yaml.add_representer(PolicyView, represent_view)
+yaml.add_representer(PolicyView, represent_view, Dumper=syspolicy.config.Dumper)
+
+
 def merge_into(base, overlay):
     """
     This function overlays the base dictionary with another one.
@@ -78,8 +576,12 @@ def merge_into(base, overlay):
     @return: The merged result
     """
     for key, item in overlay.items():
-        if type(item) is dict and key in base and type(base[key]) is dict:
-            merge_into(base[key], item)
+        if is_branch(item) and key in base and is_branch(base[key]):
+            if type(base[key]) is dict:
+                merge_into(base[key], item)
+            else:
+                # read-only branches are layered instead of modified
+                base[key] = PolicyView(base[key], item)
         else:
             base[key] = item
         
@@ -11,12 +11,20 @@ SysPolicy's back-end module for user interfaces
 
 from __future__ import with_statement
 
+import os.path
 import threading
+from itertools import groupby
+from collections import deque
+from multiprocessing.pool import ThreadPool
 import syspolicy.change
 import syspolicy.config
-from syspolicy.config import Config
+from syspolicy.config import Config, plain
 from syspolicy.policy import Policy
-from syspolicy.worker import Worker
+from syspolicy.journal import Journal, COMMIT_SIZE
+from syspolicy.worker import Worker, BATCH_SIZE
+from syspolicy.executor import Executor
+from syspolicy.spawner import SpawnHelper
+from syspolicy.trace import span
 from syspolicy.modules.module import Module
 from syspolicy.modules.autoloader import autoload_modules
 
@@ -34,17 +42,25 @@ class PolicyTool:
     debug = False #: whether or not SysPolicy is running in debug mode
     policy = None #: dictionary of all the policies defined in the main conf
     state = None #: respective state objects for the policies
+    journal = None #: write-ahead Journal of the state updates (optional)
+    journal_compact = 10000 #: journal size after which the states are saved
+    state_lock = None #: lock of the state updates
+    deferred_states = None #: state updates held back while planning, or None
     handler = None #: attribute handlers for all the policies
     events = None #: event hooks by event type
     
     module = None #: loaded extension modules
     module_locks = None #: locks for the loaded modules
+    plan_locks = None #: locks for planning with the non-reentrant modules
+    planning_workers = 1 #: number of threads for planning the ChangeSets
     
     changesets = None #: ChangeSets that have been proposed or worked on
     cs_mlock = None #: master lock for the changesets
     cs_locks = None #: dictionary of individial locks for all ChangeSets
+    enqueued = None #: set of ChangeSets that have been given to the Worker
     
     worker = None #: Worker instance for background processing of ChangeSets
+    executor = None #: Executor of the system commands of the modules
     
     def __init__(self, configfile, debug=False):
         """
@@ -58,47 +74,213 @@ class PolicyTool:
         self.state = {}
         self.handler = {}
         self.events = {}
+        self.state_lock = threading.Lock()
+
+        # set up the Executor for the system commands, with the concurrency
+        # limits and the timeout of the commands (if set). With the spawn
+        # helper the commands are run from a process forked here, before
+        # the policies make this process large.
+        limits = self.conf.get(['general', 'command-limits'])
+        timeout = self.conf.get(['general', 'command-timeout'])
+        if self.conf.get(['general', 'spawn-helper']) == True:
+            self.executor = SpawnHelper(limits, timeout=timeout)
+            self.executor.fork()
+        else:
+            self.executor = Executor(limits, timeout=timeout)
+        
+        # whether to use the YAML load cache
+        cache = self.conf.get(['general', 'yaml-cache']) == True
         
         # load all the policy and state files
         for type, file in self.conf.get(['policy']).items():
-            self.policy[type] = Policy(type, self.conf.get(['general', 'policy-path'])+'/'+file, merge_default=True)
-            try:
-                self.state[type] = Policy(type, self.conf.get(['general', 'state-path'])+'/'+file)
-            except IOError:
-                self.state[type] = Policy(type, self.conf.get(['general', 'state-path'])+'/'+file, load=False)
-                self.state[type].save()
+            source = self.conf.get(['general', 'policy-path'])+'/'+file
+            statefile = self.conf.get(['general', 'state-path'])+'/'+file
+            manifest = None
+            if os.path.isdir(source):
+                # a sharded policy directory (eg. groups.d) has a single
+                # state file (groups.conf) and a manifest of applied shards
+                name = file.rstrip('/')
+                if name.endswith('.d'):
+                    name = name[:-2]
+                statefile = self.conf.get(['general', 'state-path'])+'/'+name+'.conf'
+                manifest = statefile + '.shards'
+            with span('load_policy', policy=type):
+                self.policy[type] = Policy(type, source, merge_default=True, cache=cache,
+                                           manifest=manifest,
+                                           workers=self.conf.get(['general', 'shard-workers']))
+            with span('load_state', policy=type):
+                try:
+                    self.state[type] = Policy(type, statefile, cache=cache)
+                except IOError:
+                    self.state[type] = Policy(type, statefile, load=False, cache=cache)
+                    self.state[type].save()
+        
+        # set up the state journal and recover any updates from it
+        if self.conf.get(['general', 'state-journal']) == True:
+            self.journal = Journal(self.conf.get(['general', 'state-path'])+'/state.journal',
+                                   self.conf.get(['general', 'journal-commit']) or COMMIT_SIZE)
+            if self.conf.get(['general', 'journal-compact']) is not None:
+                self.journal_compact = self.conf.get(['general', 'journal-compact'])
+            self.recover_state()
+        
+        # load the modified policy shards while this is the only thread,
+        # so that they can be parsed with a pool of processes
+        for type, policy in self.policy.items():
+            with span('load_shards', policy=type):
+                policy.load_all(policy.unchanged_shards(self.state[type]))
         
+        # the threads are only started now
+        self.executor.start()
+
         # initialize the modules and locks
         self.module = {}
         self.module_locks = {}
+        self.plan_locks = {}
         self.changesets = []
         self.cs_mlock = threading.Lock()
         self.cs_locks = {}
+        self.enqueued = set()
+        
+        # the number of threads for planning (general: planning-workers)
+        if self.conf.get(['general', 'planning-workers']) is not None:
+            self.planning_workers = self.conf.get(['general', 'planning-workers'])
         
-        # initialize the background Worker
-        self.worker = Worker(self)
+        # initialize the background Worker with a bounded queue, the size
+        # of the batches of ChangeSets and a pool of threads (if set)
+        batch_size = BATCH_SIZE
+        if self.conf.get(['general', 'worker-batch']) is not None:
+            batch_size = max(self.conf.get(['general', 'worker-batch']), 1)
+        self.worker = Worker(self, self.conf.get(['general', 'queue-size']) or 0,
+                             batch_size, self.conf.get(['general', 'worker-threads']) or 1)
         self.worker.start()
         
         # autoload the extension modules
-        autoload_modules(self)
+        with span('autoload_modules'):
+            autoload_modules(self)
     
-    def set_state(self, type, path, value):
+    def set_state(self, type, path, value, diff_type=None):
         """
         This function updates the state of one of the policies.
         
+        When the state journal is enabled, the update is recorded in the
+        journal as well. While the policy updates are being planned, the
+        states are being diffed, so the update is held back until the
+        planning has ended (see get_policy_updates).
+        
         @param type: The policy in which the state is set
         @param path: The path to the changed value
         @param value: the new value
+        @param diff_type: The type of the difference that was implemented
         """
         if type in self.state:
-            self.state[type].set(path, value)
+            value = plain(value)
+            with self.state_lock:
+                if self.deferred_states is not None:
+                    self.deferred_states.append((type, path, value))
+                else:
+                    self.state[type].set(path, value)
+                if self.journal is not None:
+                    self.journal.append(type, path, value, diff_type)
+    
+    def defer_states(self):
+        """
+        This function holds back the state updates from the state trees,
+        eg. while they are being diffed. The updates are still recorded in
+        the state journal right away.
+        """
+        with self.state_lock:
+            if self.deferred_states is None:
+                self.deferred_states = []
+    
+    def apply_deferred_states(self):
+        """
+        This function applies the state updates held back since
+        defer_states(), in their order, and lets the updates through again.
+        """
+        with self.state_lock:
+            updates = self.deferred_states or []
+            self.deferred_states = None
+            for (type, path, value) in updates:
+                self.state[type].set(path, value)
+    
+    def metrics(self):
+        """
+        This function returns the metrics of the ChangeSets processed by the
+        Worker: the queue wait time, the latency of the Changes by the
+        subsystem and operation, the ChangeSet end-to-end time (histograms)
+        and the numbers of the processed Changes and ChangeSets by their
+        state (counters).
+        
+        @return: Dictionary with the 'histograms' and 'counters' (see
+            Metrics.snapshot)
+        """
+        return self.worker.metrics.snapshot()
+    
+    def write_metrics(self):
+        """
+        This function writes the metrics to the file set in 'general:
+        metrics-file' (if any), in the format of 'general: metrics-format'
+        (prometheus or json).
+        """
+        path = self.conf.get(['general', 'metrics-file'])
+        if path:
+            self.worker.metrics.write(path, self.conf.get(['general', 'metrics-format']) or 'prometheus')
+    
+    def commit_state(self):
+        """
+        This function makes sure that all the state updates so far are
+        stored in the state journal on the disk.
+        """
+        if self.journal is not None:
+            self.journal.commit()
+    
+    def recover_state(self):
+        """
+        This function replays the state updates from the state journal
+        on top of the saved states and compacts the journal afterwards.
+        """
+        records = self.journal.replay()
+        for (type, path, value, diff_type) in records:
+            if type not in self.state:
+                continue
+            if path:
+                self.state[type].set(path, value)
+            else:
+                self.state[type].clear()
+        if self.debug:
+            print "Recovered", len(records), "state updates from the journal"
+        if records:
+            self.compact_state()
     
     def save_state(self):
         """
         This function saves the internal state for each policy.
+        
+        When the state journal is enabled, the updates are only committed to
+        the journal, until it grows beyond `journal_compact` records and the
+        states are saved in full.
+        """
+        with span('save_state'):
+            if self.journal is None:
+                self.compact_state()
+            else:
+                self.journal.commit()
+                if self.journal.records >= self.journal_compact:
+                    self.compact_state()
+            
+            # record which policy shards have been applied to the states
+            for type, policy in self.policy.items():
+                policy.record_applied(self.state[type])
+    
+    def compact_state(self):
+        """
+        This function saves the internal state for each policy in full and
+        empties the state journal.
         """
         for type, state in self.state.items():
             state.save()
+        if self.journal is not None:
+            self.journal.truncate()
     
     def clear_state(self):
         """
@@ -106,6 +288,9 @@ class PolicyTool:
         """
         for type, state in self.state.items():
             state.clear()
+            if self.journal is not None:
+                # an empty path in the journal stands for clearing the state
+                self.journal.append(type, [], None)
     
     def add_module(self, module):
         """
@@ -123,6 +308,7 @@ class PolicyTool:
                 module.pt = self
                 self.module[module.name] = module
                 self.module_locks[module.name] = threading.Lock()
+                self.plan_locks[module.name] = threading.Lock()
                 
                 # scan for handled attributes in the module and learn them
                 for policy_type, attributes in module.handled_attributes.items():
@@ -132,6 +318,19 @@ class PolicyTool:
                 # scan for event hooks and learn them
                 for event, handler in module.event_hooks.items():
                     self.register_event_handler(event, handler)
+                
+                # normalize the attribute values in both the policy and the
+                # state, so that equivalent values compare equal
+                for policy_type, normalizers in module.normalizers.items():
+                    for attribute, function in normalizers.items():
+                        if policy_type in self.policy:
+                            self.policy[policy_type].add_normalizer(attribute, function)
+                        if policy_type in self.state:
+                            self.state[policy_type].add_normalizer(attribute, function)
+                
+                # let the module configure itself
+                with span('module_setup', module=module.name):
+                    module.setup()
             else:
                 print module, "has already been registered with", module.pt
     
@@ -183,21 +382,38 @@ class PolicyTool:
         """
         if event in self.events:
             for handler in self.events[event]:
-                handler(event, changeset)
+                with span('event', event=event, handler=getattr(handler, '__name__', handler)):
+                    handler(event, changeset)
     
-    def get_policy_diff(self):
+    def get_policy_diff(self, lists=syspolicy.config.LIST_REPLACE):
         """
         This function returns the difference between the policies and
         their previously known states, finding changed values.
         
+        @param lists: How the changed lists are reported (see compare_trees)
         @return: Difference between all policies and their saved states
         """
         diff = {}
         for type in self.policy:
-            diff[type] = self.policy[type].compare_to(self.state[type])
+            with span('get_policy_diff', policy=type):
+                diff[type] = self.policy[type].compare_to(self.state[type], lists)
         return diff
     
-    def get_policy_updates(self):
+    def list_diff_mode(self):
+        """
+        This function returns the mode for reporting changed lists to the
+        attribute handlers, which is set in the main configuration with
+        'general: list-diff' (replace, elements or ordered).
+        
+        @return: LIST_REPLACE, LIST_ELEMENTS (default) or LIST_ORDERED
+        """
+        modes = {'replace': syspolicy.config.LIST_REPLACE,
+                 'elements': syspolicy.config.LIST_ELEMENTS,
+                 'ordered': syspolicy.config.LIST_ORDERED}
+        return modes.get(self.conf.get(['general', 'list-diff']),
+                         syspolicy.config.LIST_ELEMENTS)
+    
+    def get_policy_updates(self, accept=None):
         """
         This function returns a list of ChangeSets that must be implemented to
         accommodate the changes the user has made to the policy files.
@@ -206,52 +422,130 @@ class PolicyTool:
         each difference with the registered attribute handler module. Each
         handler call may return a ChangeSet which is then recorded.
         
+        When the `accept` predicate is given, the planning is pipelined
+        with the Worker: each ChangeSet for which accept(cs) is True is
+        accepted and enqueued as soon as it is produced. When the Worker's
+        queue is bounded (general: queue-size), planning blocks until there
+        is room in the queue.
+        
+        Such ChangeSets may be implemented while the planning is still in
+        progress. Their state updates are held back from the state trees
+        being diffed until the planning has ended (see set_state).
+        
+        @param accept: A predicate for auto-accepting ChangeSets (optional)
         @return: A list of ChangeSet elements
         """
-        # get the full policy difference from the last known state
-        diff = self.get_policy_diff()
+        # let the modules prepare for a new planning pass
+        for module in self.module.values():
+            module.begin_plan()
+        
         # set up a fallback module when the attribute doesn't have a handler
         fallback = self.module['state']
+        lists = self.list_diff_mode()
         
-        if self.debug:
-            print "Diff:", diff
-        
-        # iterate all the policies in the diff
-        for type, policy in diff.items():
-            # iterate all the groups in the policy
-            for group_name, group in policy.items():
-                # iterate each changed attribute in the group
-                for attribute, valuediff in group.items():
-                    # find the handler for this attribute, or use the fallback
-                    if type in self.handler:
-                        h = self.handler[type].get(attribute, fallback)
-                    else:
-                        h = fallback
-                    
-                    # record the attribute path
-                    path = [group_name, attribute]
-                    if self.debug:
-                        print "Handler for", type, "->", path, ":", h
+        # plan the groups in parallel when there are several planning workers
+        pool = None
+        if self.planning_workers > 1:
+            pool = ThreadPool(self.planning_workers)
+        
+        # keep the Worker from updating the states while they are diffed
+        self.defer_states()
+        try:
+            # iterate all the policies
+            for type in self.policy:
+                with span('get_policy_updates', policy=type):
+                    # the changed attributes of each group are handled together
+                    records = self.policy[type].iter_diff(self.state[type], lists, depth=2)
+                    tasks = ((type, list(group_records), fallback)
+                             for group, group_records in groupby(records, lambda r: r.path[0]))
                     
-                    # check if the whole group was removed
-                    if group_name not in self.policy[type].data:
-                        value = None
-                        operation = syspolicy.config.CONFIG_REMOVED
+                    # the results are merged in the same order as the groups,
+                    # with a few groups per thread in progress at a time
+                    if pool is not None:
+                        results = ordered_map(pool, self.check_group, tasks,
+                                              self.planning_workers * 2)
                     else:
-                        value = self.policy[type].get(path)
-                        operation = syspolicy.config.diff_type(policy, self.state[type], path)
-                    
-                    # call the difference handler for this attribute
-                    cs = h.cs_check_diff(self.policy[type].name, operation, path, value, valuediff)
+                        results = (self.check_group(task) for task in tasks)
                     
-                    # record the ChangeSet, if there is any
-                    if cs is not None:
-                        self.add_changeset(cs)
-                    if self.debug:
-                        print "-" * 40
+                    for changesets in results:
+                        for cs in changesets:
+                            # record the ChangeSet
+                            self.add_changeset(cs)
+                            
+                            # feed the auto-accepted ChangeSet to the Worker
+                            if accept is not None and accept(cs):
+                                self.accept_changeset(cs, True)
+                                self.enqueue_changesets([cs])
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            self.apply_deferred_states()
+        
+        if self.debug:
+            for type, policy in self.policy.items():
+                print "Policy", type, "cache hits:", policy.cache_hits, "misses:", policy.cache_misses
         
         return self.changesets
     
+    def check_group(self, task):
+        """
+        This function handles the changed attributes of a single group of a
+        policy. It is the unit of work for parallel planning, and it can be
+        called concurrently for different groups.
+        
+        @param task: A tuple of the policy type, the DiffRecords of the
+            group and the fallback module
+        @return: A list of ChangeSets
+        """
+        (type, records, fallback) = task
+        changesets = []
+        for record in records:
+            cs = self.check_diff(type, record, fallback)
+            if cs is not None:
+                changesets.append(cs)
+            if self.debug:
+                print "-" * 40
+        return changesets
+    
+    def check_diff(self, type, record, fallback):
+        """
+        This function handles a single difference between a policy and its
+        state with the registered attribute handler module.
+        
+        @param type: The type (name) of the policy
+        @param record: The DiffRecord of an attribute of a group
+        @param fallback: The module to be used when there is no handler
+        @return: A ChangeSet or None
+        """
+        path = record.path
+        attribute = path[-1]
+        
+        # find the handler for this attribute, or use the fallback
+        if type in self.handler:
+            h = self.handler[type].get(attribute, fallback)
+        else:
+            h = fallback
+        
+        if self.debug:
+            print "Handler for", type, "->", path, ":", h
+            print "Diff:", record.diff
+        
+        # report whole lists to the handlers without ListDiff support
+        valuediff = record.diff
+        if attribute not in h.list_diff_attributes.get(type, []):
+            valuediff = syspolicy.config.expand_list_diffs(valuediff)
+        
+        # call the difference handler for this attribute, one call at a time
+        # for the modules which are not reentrant
+        with span('cs_check_diff', policy=type, group=path[0], attribute=attribute, module=h.name):
+            if h.reentrant:
+                return h.cs_check_diff(self.policy[type].name, record.operation, path,
+                                       record.new_value, valuediff)
+            with self.plan_locks[h.name]:
+                return h.cs_check_diff(self.policy[type].name, record.operation, path,
+                                       record.new_value, valuediff)
+    
     def get_cs_lock(self, changeset):
         """
         This function returns the Lock object for a known ChangeSet.
@@ -309,19 +603,30 @@ class PolicyTool:
         """
         with self.cs_mlock:
             for cs in self.changesets:
-                statechange = False
                 with self.cs_locks[cs]:
-                    # iterate the changes and see if they are only state changes
-                    for c in cs.changes:
-                        if c.subsystem == 'state' and c.operation == 'set_state':
-                            statechange = True
-                        else:
-                            statechange = False
-                            break
+                    statechange = self.is_state_change(cs)
                 # in case there are only state changes, accept this ChangeSet
                 if statechange:
                     self.accept_changeset(cs, True)
     
+    def is_state_change(self, changeset):
+        """
+        This function checks whether a ChangeSet contains only 'set_state'
+        operations in the 'state' subsystem. It can be used as the `accept`
+        predicate of get_policy_updates().
+        
+        @param changeset: The ChangeSet to be checked
+        @return: True if the ChangeSet only updates the states
+        """
+        # iterate the changes and see if they are only state changes
+        statechange = False
+        for c in changeset.changes:
+            if c.subsystem == 'state' and c.operation == 'set_state':
+                statechange = True
+            else:
+                return False
+        return statechange
+    
     def changesets_with_state(self, state):
         """
         This function queries the stored list of ChangeSet for the ones
@@ -346,10 +651,39 @@ class PolicyTool:
     def enqueue_changesets(self, changesets):
         """
         This function enqueue's the provided ChangeSets with the Worker.
+        ChangeSets that have already been enqueued are skipped. When the
+        Worker's queue is full, this function blocks until there is room.
         
         @param changesets: A list of ChangeSets for processing
         """
         for cs in changesets:
-            self.worker.queue.put(cs)
+            with self.cs_mlock:
+                if cs in self.enqueued:
+                    continue
+                self.enqueued.add(cs)
+            self.worker.put(cs)
             if self.debug:
                 print "Adding ChangeSet", cs, "to the Worker's queue"
+
+
+def ordered_map(pool, function, tasks, window):
+    """
+    This function calls `function` for the tasks in a pool of threads and
+    yields the results in the order of the tasks. Unlike pool.imap(), which
+    takes all the tasks from the iterator at once and keeps all the results
+    that haven't been consumed, at most `window` tasks are in progress at a
+    time, so that the tasks are only produced as the results are consumed.
+    
+    @param pool: The ThreadPool
+    @param function: The function taking a task
+    @param tasks: Iterator of the tasks
+    @param window: Maximum number of tasks submitted to the pool at a time
+    @return: A generator of the results
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(function, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
@@ -0,0 +1,306 @@
+# SysPolicy
+# 
+# Copyright (c) 2010 Lenno Nagel
+# Author: Lenno Nagel <lenno-at-nagel.ee>
+# URL: <http://trac.syspolicy.org>
+# Released under the GNU General Public License version 3
+
+"""
+Spawning of system commands from a small helper process
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import errno
+import fcntl
+import struct
+import atexit
+import cPickle
+import threading
+
+from syspolicy.executor import Executor, Command, DEFAULT_LIMIT, OUTPUT_LIMIT
+
+HEADER = struct.Struct('!I') #: length prefix of the messages between the processes
+
+class SpawnHelper:
+    """
+    This class runs the system commands in a helper process, which is
+    forked when the PolicyTool is started and the process is still small.
+    Forking the main process after it has loaded large policies has to copy
+    its page tables for every command, while the helper stays small for its
+    lifetime.
+    
+    The commands are sent to the helper as pickled (id, argv, input,
+    timeout) messages over a pipe. The helper runs them with an Executor
+    (within the same concurrency limits and timeout) and sends back the
+    exit status and output of each command as it completes, so the
+    SpawnHelper can be used in place of an Executor, eg.:
+    
+    general:
+      spawn-helper: true
+    """
+    
+    pid = None #: process id of the helper process
+    requests = None #: file descriptor of the pipe to the helper
+    responses = None #: file descriptor of the pipe from the helper
+    commands = None #: dictionary of the Commands waiting for the results by their id
+    exited = False #: whether the helper process has exited
+    
+    def __init__(self, limits=None, default_limit=DEFAULT_LIMIT, timeout=None,
+                 output_limit=OUTPUT_LIMIT):
+        """
+        Initialize the SpawnHelper, the parameters are passed on to the
+        Executor of the helper process.
+        
+        @param limits: Maximum numbers of concurrent commands by the binary
+        @param default_limit: Limit for the other binaries
+        @param timeout: Default timeout of the commands in seconds
+        @param output_limit: Maximum number of bytes kept of an output stream
+        """
+        self.limits = limits
+        self.default_limit = default_limit
+        self.timeout = timeout
+        self.output_limit = output_limit
+        self.commands = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.reader = None
+    
+    def fork(self):
+        """
+        Fork the helper process. The commands can be submitted right away,
+        but their results are only received after start().
+        """
+        (request_read, request_write) = os.pipe()
+        (response_read, response_write) = os.pipe()
+        
+        self.pid = os.fork()
+        if self.pid == 0:
+            # the helper process never returns to the caller
+            status = 0
+            try:
+                try:
+                    os.close(request_write)
+                    os.close(response_read)
+                    serve(request_read, response_write, Executor(self.limits, self.default_limit,
+                                                                 self.timeout, self.output_limit))
+                except:
+                    status = 1
+            finally:
+                os._exit(status)
+        
+        os.close(request_read)
+        os.close(response_write)
+        self.requests = request_write
+        self.responses = response_read
+        set_cloexec(self.requests)
+        set_cloexec(self.responses)
+    
+    def start(self):
+        """
+        Start the thread receiving the results of the helper process,
+        forking it first if fork() hasn't been called. The helper exits when
+        the pipe to it is closed, at the latest when the interpreter exits.
+        """
+        if self.pid is None:
+            self.fork()
+        self.reader = threading.Thread(target=self.receive)
+        self.reader.daemon = True
+        self.reader.start()
+        atexit.register(self.stop)
+    
+    def stop(self):
+        """
+        This function closes the pipe to the helper process, which makes it
+        exit after the running commands have completed.
+        """
+        with self.write_lock:
+            if self.requests is not None:
+                os.close(self.requests)
+                self.requests = None
+        self.reader.join(1)
+    
+    def submit(self, argv, input=None, timeout=None):
+        """
+        This function sends a command to the helper process for execution.
+        
+        @param argv: The command with all the arguments as a list
+        @param input: Data to be written to the standard input of the command
+        @param timeout: Seconds after which the command is killed (default:
+            the timeout of the helper)
+        @return: The Command, whose wait() returns the results
+        """
+        command = Command(argv, input, timeout)
+        with self.lock:
+            id = self.next_id
+            self.next_id += 1
+            self.commands[id] = command
+        
+        try:
+            with self.write_lock:
+                if self.exited or self.requests is None:
+                    raise OSError(errno.EPIPE, 'The spawn helper has exited')
+                send_message(self.requests, (id, argv, input, timeout))
+        except OSError, e:
+            with self.lock:
+                self.commands.pop(id, None)
+            command.error = e
+            command.done.set()
+        return command
+    
+    def call(self, argv, input=None, timeout=None):
+        """
+        This function executes a command and waits for it to complete.
+        
+        @return: Tuple of the return value, standard output and error output
+        """
+        return self.submit(argv, input, timeout).wait()
+    
+    def call_many(self, commands, timeout=None):
+        """
+        This function executes several commands concurrently (within the
+        limits) and waits for all of them to complete.
+        
+        @param commands: List of (argv, input) tuples
+        @return: List of (return value, standard output, error output)
+            tuples in the same order
+        """
+        submitted = [self.submit(argv, input, timeout) for (argv, input) in commands]
+        return [command.wait() for command in submitted]
+    
+    def receive(self):
+        """
+        This is the loop of the thread which receives the results from the
+        helper process and completes the Commands. When the helper exits,
+        the Commands still waiting fail.
+        """
+        while True:
+            message = read_message(self.responses)
+            if message is None:
+                break
+            (id, returncode, stdout, stderr, timed_out, error) = message
+            with self.lock:
+                command = self.commands.pop(id)
+            command.returncode = returncode
+            command.stdout = stdout
+            command.stderr = stderr
+            command.timed_out = timed_out
+            command.error = error
+            command.done.set()
+        
+        os.close(self.responses)
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        with self.write_lock:
+            self.exited = True
+        with self.lock:
+            commands = self.commands.values()
+            self.commands = {}
+        for command in commands:
+            command.error = OSError(errno.EPIPE, 'The spawn helper has exited')
+            command.done.set()
+
+
+def serve(requests, responses, executor):
+    """
+    This is the main loop of the helper process. It submits the commands
+    read from `requests` to the Executor, which writes the results to
+    `responses` as the commands complete.
+    
+    @param requests: File descriptor of the pipe from the main process
+    @param responses: File descriptor of the pipe to the main process
+    @param executor: The Executor running the commands
+    """
+    # keep the commands away from the terminal of the main process, the
+    # interrupts are handled there
+    os.setpgid(0, 0)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, sys.stdin.fileno())
+    os.close(devnull)
+    
+    running = threading.Condition()
+    pending = [0]
+    def reply(id, command):
+        with running:
+            try:
+                send_message(responses, (id, command.returncode, command.stdout,
+                                         command.stderr, command.timed_out, command.error))
+            finally:
+                # the main process may be gone, the command is done anyway
+                pending[0] -= 1
+                running.notify()
+    
+    executor.start()
+    while True:
+        message = read_message(requests)
+        if message is None:
+            break
+        (id, argv, input, timeout) = message
+        with running:
+            pending[0] += 1
+        executor.submit(argv, input, timeout, lambda command, id=id: reply(id, command))
+    
+    # let the running commands complete
+    with running:
+        while pending[0]:
+            running.wait()
+
+
+def send_message(fd, message):
+    """
+    This function writes a pickled message with its length to a pipe.
+    """
+    data = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+    data = HEADER.pack(len(data)) + data
+    while data:
+        try:
+            data = data[os.write(fd, data):]
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+
+def read_message(fd):
+    """
+    This function reads a message written by send_message() from a pipe.
+    
+    @return: The message, or None when the pipe has been closed
+    """
+    header = read_exactly(fd, HEADER.size)
+    if header is None:
+        return None
+    data = read_exactly(fd, HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return cPickle.loads(data)
+
+def read_exactly(fd, size):
+    """
+    This function reads `size` bytes from a pipe.
+    
+    @return: The data, or None when the pipe was closed before that
+    """
+    chunks = []
+    while size > 0:
+        try:
+            data = os.read(fd, size)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if not data:
+            return None
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+def set_cloexec(fd):
+    """
+    This function keeps a file descriptor from being inherited by the commands.
+    """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
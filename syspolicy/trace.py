@@ -0,0 +1,153 @@
+# SysPolicy
+# 
+# Copyright (c) 2010 Lenno Nagel
+# Author: Lenno Nagel <lenno-at-nagel.ee>
+# URL: <http://trac.syspolicy.org>
+# Released under the GNU General Public License version 3
+
+"""
+Tracing of the phases of a run in the Chrome trace event format
+"""
+
+from __future__ import with_statement
+
+import os
+import os.path
+import json
+import atexit
+import time
+import resource
+import threading
+
+tracer = None #: the active Tracer, or None when tracing is disabled
+
+class Span:
+    """
+    This class is a traced phase of the run, used as a context manager.
+    The nested spans of a thread are shown inside each other by the
+    trace viewers.
+    """
+    
+    name = None #: name of the phase
+    args = None #: dictionary of the attributes of the phase
+    
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+    
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        self.tracer.complete(self, time.time())
+        return False
+
+
+class NullSpan:
+    """
+    This class is the span used when tracing is disabled, it does nothing.
+    """
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        return False
+
+NULL_SPAN = NullSpan() #: the span returned when tracing is disabled
+
+class Tracer:
+    """
+    This class collects the completed spans as trace events, which are
+    written as JSON that chrome://tracing and Perfetto can open.
+    
+    With `memory` set, the peak resident set size of the process is
+    recorded as a counter at the end of every span, which shows the phases
+    where the memory use grows.
+    """
+    
+    path = None #: path of the trace file
+    memory = False #: whether to record the peak RSS at the end of the spans
+    events = None #: list of the trace events
+    
+    def __init__(self, path, memory=False):
+        self.path = path
+        self.memory = memory
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.time()
+        self.pid = os.getpid()
+    
+    def complete(self, span, end):
+        """
+        This function records a completed span as a trace event.
+        """
+        event = {'name': span.name, 'cat': 'syspolicy', 'ph': 'X',
+                 'ts': self.timestamp(span.start), 'dur': int((end - span.start) * 1000000),
+                 'pid': self.pid, 'tid': threading.current_thread().ident,
+                 'args': span.args}
+        with self.lock:
+            self.events.append(event)
+            if self.memory:
+                # ru_maxrss is in kilobytes on Linux
+                maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                self.events.append({'name': 'maxrss', 'ph': 'C', 'ts': self.timestamp(end),
+                                    'pid': self.pid, 'args': {'kB': maxrss}})
+    
+    def timestamp(self, t):
+        """
+        This function converts a time to microseconds from the start of the trace.
+        """
+        return int((t - self.origin) * 1000000)
+    
+    def write(self):
+        """
+        This function writes the trace events to the trace file.
+        """
+        # imported here, the modules import the configuration, which is traced
+        from syspolicy.modules.module import replace_file
+        
+        with self.lock:
+            data = json.dumps({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, default=str)
+        replace_file(os.path.abspath(self.path), [data + '\n'], 0644)
+
+
+def start(path, memory=False):
+    """
+    This function enables tracing, the trace is written to `path` by
+    finish(), at the latest when the interpreter exits, so that a run
+    aborted by an error is traced as well.
+    
+    @param path: Path of the trace file
+    @param memory: Whether to record the peak RSS at the end of the spans
+    """
+    global tracer
+    tracer = Tracer(path, memory)
+    atexit.register(finish)
+
+def finish():
+    """
+    This function writes the trace file and disables tracing.
+    """
+    global tracer
+    if tracer is not None:
+        tracer.write()
+        tracer = None
+
+def span(name, **args):
+    """
+    This function returns a span for tracing a phase of the run, eg.:
+    
+    with span('cs_check_diff', group=group, module=module.name):
+        ...
+    
+    @param name: Name of the phase
+    @param args: Attributes of the phase, shown with the span
+    @return: A Span, or a span that does nothing when tracing is disabled
+    """
+    if tracer is None:
+        return NULL_SPAN
+    return Span(tracer, name, args)
@@ -11,9 +11,14 @@ Worker that implements ChangeSets in the background
 
 from __future__ import with_statement
 
+import time
 import threading
-from Queue import Queue
+from Queue import Queue, Empty
 import syspolicy.change
+from syspolicy.metrics import Metrics
+from syspolicy.trace import span
+
+BATCH_SIZE = 64 #: default maximum number of ChangeSets processed together
 
 class Worker(threading.Thread):
     """
@@ -21,70 +26,419 @@ class Worker(threading.Thread):
     
     It will implement all the ChangeSets that are enqueued and update
     their status according to the success or failure.
+    
+    With several threads (general: worker-threads), the ChangeSets are
+    processed concurrently by a pool of threads running the same loop.
+    Each ChangeSet claims the resources that its Changes need (see
+    Module.change_resources) before it is processed, so the ChangeSets
+    that share a resource are never processed by different threads at the
+    same time, and they are processed in the order they were enqueued,
+    while the independent ones may overlap.
+    
+    The ChangeSets are processed in batches of up to BATCH_SIZE ChangeSets
+    (general: worker-batch, 1 disables batching). The ChangeSets that
+    share a resource may be taken into the same batch, as the modules
+    implement such Changes faster together (eg. the new users of shadow
+    with newusers). The batch still implements the Changes of each
+    resource in the order of the ChangeSets (see process_batch).
     """
     
     queue = None #: the queue of ChangeSets that need processing
     pt = None #: reference to the PolicyTool of this Worker
+    batch_size = BATCH_SIZE #: maximum number of ChangeSets processed together
+    threads = 1 #: number of threads processing the ChangeSets
+    pending = None #: (ChangeSet, resources) taken from the queue, in order
+    busy = None #: resources claimed by the ChangeSets being processed
+    running = 0 #: number of batches being processed
+    schedule_lock = None #: condition guarding pending, busy and running
+    metrics = None #: Metrics of the queue wait, the Changes and the ChangeSets
+    enqueue_times = None #: times when the queued ChangeSets were enqueued
     
-    def __init__(self, policytool):
+    def __init__(self, policytool, queue_size=0, batch_size=BATCH_SIZE, threads=1):
         """
         Initialize the Worker and it's Queues.
         
         @param policytool: The PolicyTool instance in which the Worker belongs
+        @param queue_size: The maximum number of queued ChangeSets (0 for
+            an unbounded queue), putting more ChangeSets blocks the caller
+        @param batch_size: The maximum number of ChangeSets that are
+            processed together (see process_batch)
+        @param threads: The number of threads processing the ChangeSets
         """
         threading.Thread.__init__(self)
         self.daemon = True
-        self.queue = Queue()
+        self.queue = Queue(queue_size)
         self.log = Queue()
         self.pt = policytool
+        self.batch_size = batch_size
+        self.threads = max(threads, 1)
+        self.pending = []
+        self.busy = set()
+        self.running = 0
+        self.schedule_lock = threading.Condition()
+        self.metrics = Metrics()
+        self.enqueue_times = {}
+    
+    def start(self):
+        """
+        Start the Worker thread and the other threads of the pool.
+        """
+        threading.Thread.start(self)
+        for i in range(1, self.threads):
+            thread = threading.Thread(target=self.run, name="%s-%d" % (self.getName(), i))
+            thread.daemon = True
+            thread.start()
+    
+    def put(self, cs):
+        """
+        This function enqueues a ChangeSet and wakes up the threads that
+        are waiting for the resources of earlier ChangeSets, so that they
+        can look at it too. When the queue is full, the caller blocks.
+        
+        @param cs: The ChangeSet for processing
+        """
+        self.enqueue_times[cs] = time.time()
+        self.queue.put(cs)
+        with self.schedule_lock:
+            self.schedule_lock.notify_all()
     
     def run(self):
         """
         This is the main function of the Worker class in which any queued
         ChangeSets are processed. This function runs in a separate daemon
         thread in the background.
+        
+        The Worker takes up to batch_size ChangeSets from the queue at once
+        and lets each module implement their Changes together (see
+        process_batch).
         """
         
         # run forever
         while True:
-            # get a ChangeSet from the queue
-            cs = self.queue.get()
+            # get the next ChangeSets whose resources are free
+            batch, claimed = self.schedule()
+            now = time.time()
+            for cs in batch:
+                self.metrics.observe('syspolicy_queue_wait_seconds',
+                                     now - self.enqueue_times.get(cs, now))
             
-            # lock the ChangeSet during processing
-            with self.pt.get_cs_lock(cs):
-                if self.pt.debug:
-                    print "Worker processing ChangeSet", cs
+            try:
+                with span('worker_process', changesets=len(batch)):
+                    if len(batch) == 1:
+                        self.process(batch[0])
+                    else:
+                        self.process_batch(batch)
+            finally:
+                idle = self.release(claimed)
+            
+            # commit the state journal when there is no more work queued
+            if idle:
+                self.pt.commit_state()
+            
+            # report the ChangeSets as processed
+            for cs in batch:
+                self.queue.task_done()
+    
+    def schedule(self):
+        """
+        This function takes the next batch of ChangeSets to be processed,
+        blocking until there is one. The ChangeSets are taken from the
+        queue into the pending list, which is looked at in order: a
+        ChangeSet is skipped while any of its resources is claimed by a
+        running batch or by a skipped ChangeSet before it. The ChangeSets
+        of the batch itself may share resources, process_batch keeps
+        their order.
+        
+        @return: The list of ChangeSets and the set of resources claimed for them
+        """
+        while True:
+            with self.schedule_lock:
+                # look ahead in the queue as far as the threads can use
+                while len(self.pending) < self.threads * self.batch_size:
+                    try:
+                        cs = self.queue.get_nowait()
+                    except Empty:
+                        break
+                    self.pending.append((cs, self.resources(cs)))
+                
+                batch = []
+                claimed = set()
+                blocked = set()
+                for cs, resources in self.pending:
+                    if len(batch) >= self.batch_size:
+                        break
+                    if resources & self.busy or resources & blocked:
+                        # keep the order of the ChangeSets sharing a resource
+                        blocked |= resources
+                        continue
+                    # the ChangeSets of the batch may share resources, the
+                    # Changes are kept in order by process_batch
+                    batch.append(cs)
+                    claimed |= resources
                 
-                # iterate the Changes in the ChangeSet
-                for c in cs.changes:
-                    # lock the module that this Change requires
-                    with self.pt.get_module_lock(c.subsystem):
-                        module = self.pt.module[c.subsystem]
-                        if self.pt.debug:
-                            print "Worker processing Change", c, "with module", module.name,
-                        
-                        # try to implement the Change
-                        try:
+                if batch:
+                    self.pending = [p for p in self.pending if p[0] not in batch]
+                    self.busy |= claimed
+                    self.running += 1
+                    return batch, claimed
+                
+                # wait for the running ChangeSets to release their resources
+                if self.pending:
+                    self.schedule_lock.wait()
+                    continue
+            
+            # nothing is pending, wait for the queue
+            cs = self.queue.get()
+            with self.schedule_lock:
+                self.pending.append((cs, self.resources(cs)))
+    
+    def release(self, claimed):
+        """
+        This function releases the resources of a processed batch.
+        
+        @param claimed: The set of resources claimed for the batch
+        @return: True if no more ChangeSets are running or waiting
+        """
+        with self.schedule_lock:
+            self.busy -= claimed
+            self.running -= 1
+            self.schedule_lock.notify_all()
+            return self.running == 0 and not self.pending and self.queue.empty()
+    
+    def resources(self, cs):
+        """
+        This function collects the resources that the Changes of a ChangeSet
+        need exclusively. The Changes of the modules that don't name their
+        resources claim the whole module.
+        
+        @param cs: The ChangeSet
+        @return: Set of resource names
+        """
+        resources = set()
+        for c in cs.changes:
+            resources |= self.change_resources(c)
+        return resources
+    
+    def change_resources(self, change):
+        """
+        This function returns the resources that a Change needs exclusively.
+        
+        @param change: The Change
+        @return: Set of resource names
+        """
+        names = None
+        if change.subsystem in self.pt.module:
+            names = self.pt.module[change.subsystem].change_resources(change)
+        if names is None:
+            names = ['module:' + change.subsystem]
+        return set(names)
+    
+    def process(self, cs):
+        """
+        This function implements the Changes of a single ChangeSet in
+        order, halting at the first failure. The consecutive Changes of the
+        same module and operation (see change_runs) are implemented together
+        with Module.perform_batch().
+        
+        @param cs: The ChangeSet to be processed
+        """
+        # lock the ChangeSet during processing
+        with self.pt.get_cs_lock(cs):
+            if self.pt.debug:
+                print "Worker processing ChangeSet", cs
+            
+            # iterate the Changes in the ChangeSet, the resources they
+            # require have been claimed by schedule()
+            for run in self.change_runs(cs):
+                module = self.pt.module[run[0].subsystem]
+                if len(run) > 1:
+                    self.perform_run(module, run)
+                else:
+                    c = run[0]
+                    if self.pt.debug:
+                        print "Worker processing Change", c, "with module", module.name,
+                    
+                    # try to implement the Change
+                    start = time.time()
+                    try:
+                        with span('perform_change', module=module.name, operation=c.operation):
                             c.state = module.perform_change(c)
-                        except Exception, inst:
-                            # in case it fails, print the error message
-                            print "Worker encountered an exception while processing ChangeSet", cs, "\n", inst
-                            # set the state as STATE_FAILED
-                            c.state = syspolicy.change.STATE_FAILED
-                        
-                        if self.pt.debug:
-                            print "=>", syspolicy.change.state_string(c.state)
-                        
-                        # halt processing of the ChangeSet if there's a failure
-                        if c.state == syspolicy.change.STATE_FAILED:
-                            break
+                    except Exception, inst:
+                        # in case it fails, print the error message
+                        print "Worker encountered an exception while processing ChangeSet", cs, "\n", inst
+                        # set the state as STATE_FAILED
+                        c.state = syspolicy.change.STATE_FAILED
+                    self.record_change(c, time.time() - start)
+                    
+                    if self.pt.debug:
+                        print "=>", syspolicy.change.state_string(c.state)
                 
-                # let the ChangeSet update it's status:
-                cs.check_state()
+                # halt processing of the ChangeSet if there's a failure
+                if [c for c in run if c.state == syspolicy.change.STATE_FAILED]:
+                    break
+            
+            # let the ChangeSet update it's status:
+            cs.check_state()
+            self.record_changeset(cs)
+            
+            if self.pt.debug:
+                print "This ChangeSet =>", syspolicy.change.state_string(cs.get_state())
+                print
+    
+    def process_batch(self, batch):
+        """
+        This function implements a batch of ChangeSets in rounds. In each
+        round, the next run of Changes (see change_runs) of every ChangeSet
+        that hasn't failed yet is implemented, and the Changes of the same
+        module are passed to it together with Module.perform_batch(), in the
+        order of the ChangeSets. So the runs of a ChangeSet are still
+        implemented in order and a failure halts the ChangeSet.
+        
+        The Changes that need the same resource are implemented in the order
+        the ChangeSets were enqueued: a ChangeSet waits while an earlier one
+        still has Changes for the resources of its next run, other than
+        the one implemented in the same round (and module call).
+        
+        @param batch: List of ChangeSets to be processed
+        """
+        # lock all the ChangeSets of the batch during processing
+        locks = [self.pt.get_cs_lock(cs) for cs in batch]
+        for lock in locks:
+            lock.acquire()
+        try:
+            if self.pt.debug:
+                print "Worker processing a batch of", len(batch), "ChangeSets"
+            
+            # the runs of each ChangeSet, the resources of each run and of
+            # the runs from each step to the end of the ChangeSet
+            runs = {}
+            needs = {}
+            remaining = {}
+            for cs in batch:
+                runs[cs] = self.change_runs(cs)
+                needs[cs] = []
+                for run in runs[cs]:
+                    resources = set()
+                    for c in run:
+                        resources |= self.change_resources(c)
+                    needs[cs].append(resources)
+                remaining[cs] = [set()]
+                for resources in reversed(needs[cs]):
+                    remaining[cs].insert(0, remaining[cs][0] | resources)
+            
+            steps = dict([(cs, 0) for cs in batch])
+            active = [cs for cs in batch if runs[cs]]
+            while active:
+                # collect the next run of each active ChangeSet by module,
+                # unless an earlier ChangeSet still needs its resources
+                rounds = {}
+                order = []
+                current = set()
+                blocked = set()
+                used = {}
+                for cs in active:
+                    step = steps[cs]
+                    run = runs[cs][step]
+                    subsystem = run[0].subsystem
+                    resources = needs[cs][step]
+                    if resources & blocked or [r for r in resources if used.get(r, subsystem) != subsystem]:
+                        blocked |= remaining[cs][step]
+                        continue
+                    blocked |= remaining[cs][step + 1]
+                    for r in resources:
+                        used[r] = subsystem
+                    current.add(cs)
+                    if subsystem not in rounds:
+                        rounds[subsystem] = []
+                        order.append(subsystem)
+                    rounds[subsystem].extend(run)
                 
-                if self.pt.debug:
-                    print "This ChangeSet =>", syspolicy.change.state_string(cs.get_state())
-                    print
+                for subsystem in order:
+                    self.perform_run(self.pt.module[subsystem], rounds[subsystem])
+                
+                # the ChangeSets that failed or ran out of Changes are done
+                for cs in current:
+                    steps[cs] += 1
+                active = [cs for cs in active if cs not in current or
+                          (len(runs[cs]) > steps[cs] and not
+                           [c for c in runs[cs][steps[cs] - 1] if c.state == syspolicy.change.STATE_FAILED])]
             
-            # report the ChangeSet as processed
-            self.queue.task_done()
+            # let the ChangeSets update their status
+            for cs in batch:
+                cs.check_state()
+                self.record_changeset(cs)
+                if self.pt.debug:
+                    print "ChangeSet", cs, "=>", syspolicy.change.state_string(cs.get_state())
+        finally:
+            for lock in locks:
+                lock.release()
+    
+    def change_runs(self, cs):
+        """
+        This function splits the Changes of a ChangeSet into runs of
+        consecutive Changes of the same module and operation, eg. the
+        set_quota Changes of the members of a group. The Changes of a run
+        don't depend on each other, so they are implemented together, and
+        a failure halts the ChangeSet after the run.
+        
+        @param cs: The ChangeSet
+        @return: List of the runs, as lists of Changes
+        """
+        runs = []
+        for c in cs.changes:
+            if runs and runs[-1][0].subsystem == c.subsystem and runs[-1][0].operation == c.operation:
+                runs[-1].append(c)
+            else:
+                runs.append([c])
+        return runs
+    
+    def perform_run(self, module, changes):
+        """
+        This function implements several Changes of a module together with
+        Module.perform_batch() and stores their states.
+        
+        @param module: The module implementing the Changes
+        @param changes: List of the Changes
+        """
+        if self.pt.debug:
+            print "Worker processing", len(changes), "Changes with module", module.name
+        
+        # try to implement the Changes
+        start = time.time()
+        try:
+            with span('perform_batch', module=module.name, changes=len(changes)):
+                states = module.perform_batch(changes)
+        except Exception, inst:
+            # in case it fails, print the error message
+            print "Worker encountered an exception while processing a batch of", module.name, "Changes\n", inst
+            states = [syspolicy.change.STATE_FAILED] * len(changes)
+        # the time of the batch is shared by its Changes
+        elapsed = (time.time() - start) / len(changes)
+        for c, state in zip(changes, states):
+            c.state = state
+            self.record_change(c, elapsed)
+
+    def record_change(self, change, elapsed):
+        """
+        This function records the latency and the resulting state of a
+        processed Change in the metrics.
+        
+        @param change: The processed Change
+        @param elapsed: Seconds spent implementing the Change
+        """
+        labels = {'subsystem': change.subsystem, 'operation': change.operation}
+        self.metrics.observe('syspolicy_change_seconds', elapsed, labels)
+        labels['state'] = syspolicy.change.state_string(change.state)
+        self.metrics.count('syspolicy_changes_total', labels)
+    
+    def record_changeset(self, cs):
+        """
+        This function records the time from enqueueing a processed
+        ChangeSet and its resulting state in the metrics.
+        
+        @param cs: The processed ChangeSet
+        """
+        now = time.time()
+        self.metrics.observe('syspolicy_changeset_seconds', now - self.enqueue_times.pop(cs, now))
+        self.metrics.count('syspolicy_changesets_total',
+                           {'state': syspolicy.change.state_string(cs.get_state())})
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of loading a large group policy with and without the YAML load cache
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import yaml
+import syspolicy.config
+from syspolicy.config import load_yaml, cache_filename
+
+groups = 20000
+if len(sys.argv) > 1:
+    groups = int(sys.argv[1])
+rounds = 3
+
+def timed(function, *args):
+    """
+    Run `function` `rounds` times and return the best time in seconds.
+    """
+    best = None
+    for i in range(rounds):
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def cold_load(filename):
+    """
+    Load the file through the cache after removing the cache file.
+    """
+    if os.path.exists(cache_filename(filename)):
+        os.remove(cache_filename(filename))
+    load_yaml(filename, cache=True)
+
+# generate a synthetic group policy
+policy = {'_default_': {'basedir': '/home', 'shell': '/bin/bash',
+                        'uid_min': 1000, 'uid_max': 2000,
+                        'userquota': {}, 'groupquota': {}}}
+for i in range(groups):
+    policy['group%d' % i] = {'shell': '/bin/sh', 'uid_min': 10000 + i,
+                             'userquota': {'/home': '1G', '/srv': ['100M', '200M']},
+                             'groupquota': {'/home': '5G'}}
+
+tempdir = tempfile.mkdtemp()
+filename = os.path.join(tempdir, 'groups.conf')
+try:
+    cf = file(filename, 'w')
+    yaml.dump(policy, cf, Dumper=syspolicy.config.Dumper, default_flow_style=False)
+    cf.close()
+
+    print "%d groups, %d bytes of YAML" % (groups, os.path.getsize(filename))
+    print "loader:", syspolicy.config.Loader.__name__
+    print '-' * 40
+
+    print "pure python parse: %.3fs" % timed(lambda: yaml.load(file(filename), Loader=yaml.Loader))
+    print "load_yaml without cache: %.3fs" % timed(load_yaml, filename, False)
+    print "load_yaml cold cache: %.3fs" % timed(cold_load, filename)
+
+    load_yaml(filename, cache=True)
+    print "load_yaml cache hit: %.3fs" % timed(load_yaml, filename, True)
+
+    assert load_yaml(filename, cache=True) == policy
+finally:
+    shutil.rmtree(tempdir)